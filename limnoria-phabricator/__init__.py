@@ -27,10 +27,12 @@ __contributors__ = {}
 __url__ = ''
 
 from . import config
+from . import report
 from . import plugin
 from imp import reload
 # In case we're being reloaded.
 reload(config)
+reload(report)
 reload(plugin)
 # Add more reloads here if you add third-party modules and want them to be
 # reloaded when this plugin is reloaded.  Don't forget to import them as well!
@@ -0,0 +1,343 @@
+import argparse
+import contextlib
+import json
+import os
+import random
+import re
+import statistics
+import threading
+import time
+import timeit
+import urllib.parse
+from collections import OrderedDict
+from plugin import PhabricatorReplyPrinter, PhabricatorStoryStringConstructor, PhabricatorStringFormatting, PhabricatorStoryPrinter, \
+    PhabricatorOutboundScheduler, PhabricatorStorySubscribers, PhabricatorInstance, PhabricatorInstanceScheduler, ConduitAPI, AsyncConduitAPI, \
+    ConduitConnectionPool, ConduitRecorder, ConduitReplayer
+from fake_conduit import FakeConduitData, FakeConduitServer
+
+# Measures the performance of the plugin without connecting to IRC or Phabricator.
+# The Conduit queries are answered by a local fake server with synthetic data.
+# Recorded Conduit traffic can be replayed instead, see cassetteMode.
+# Run with: python3 benchmark.py [--json results.json] [--cassette conduit.cassette.gz [--realtime]]
+
+# Chat lines resembling a busy development channel, few of which mention an object
+chatTemplates = [
+    "{nick}: did you see the new pathfinder branch?",
+    "I think the AI is broken again after the last commit",
+    "{nick}, can you review {ref} when you have time?",
+    "brb",
+    "lol",
+    "ok, the PDF of the design document is on the wiki",
+    "Dude, that D3D renderer issue again?",
+    "the patch at https://code.wildfiregames.com/{ref} needs a rebase",
+    "{nick}: thanks!",
+    "anyone up for a game tonight? 4v4 on Mainland",
+    "the translation strings are synced, {nick}",
+    "I uploaded the log to {ref}",
+    "hm, test_Pathfinder fails on Windows with MSVC 2015",
+    "good morning everyone",
+    "Phase 2 of the release process starts next week",
+]
+
+nicks = ["elexis", "bb", "Itms", "wraitii", "Stan`", "vladislavbelov", "Angen", "Freagarach"]
+
+def chatCorpus(size, seed=0):
+    rng = random.Random(seed)
+    corpus = []
+    for i in range(size):
+        ref = rng.choice(["D", "P"]) + str(rng.randint(1, 3000))
+        corpus.append(rng.choice(chatTemplates).format(nick=rng.choice(nicks), ref=ref))
+    return corpus
+
+# The scanning done by doPrivmsg before the single-pass scanner
+def legacyScan(txt):
+    revisions = OrderedDict.fromkeys(map(lambda d: d[1:], re.findall(r"\b(D\d+)\b", txt)), True)
+    pasteIDs = OrderedDict.fromkeys(map(lambda d: d[1:], re.findall(r"\b(P\d+)\b", txt)), True)
+    return revisions, pasteIDs
+
+def benchmarkMessageScan(corpusSize=10000, repeat=5):
+
+    corpus = chatCorpus(corpusSize)
+    mentioning = sum(PhabricatorReplyPrinter.scanReferences(txt) is not None for txt in corpus)
+
+    def scan():
+        for txt in corpus:
+            PhabricatorReplyPrinter.scanReferences(txt)
+
+    def legacy():
+        for txt in corpus:
+            legacyScan(txt)
+
+    results = {}
+    for name, function in (("doPrivmsg scan", scan), ("legacy scan", legacy)):
+        seconds = min(timeit.repeat(function, number=1, repeat=repeat))
+        results[name] = seconds / corpusSize * 1e9
+        print("{:<20} {:8.0f} ns per message".format(name, results[name]))
+
+    print(mentioning, "of", corpusSize, "messages mention an object")
+    return results
+
+# Throughput of parsing and rendering the recorded feed story texts
+def benchmarkStoryParsing(repeat=5, copies=200):
+
+    with open(os.path.join(os.path.dirname(__file__), "feed_corpus.json")) as corpusFile:
+        corpus = json.load(corpusFile) * copies
+
+    formatting = PhabricatorStringFormatting(bolding=True, obscureUsernames=True, htmlLinks=False)
+
+    def render():
+        for story in corpus:
+            PhabricatorStoryStringConstructor(
+                story["objType"],
+                None,
+                story["objID"],
+                story["objTitle"],
+                story["objLink"],
+                story["authorName"],
+                story["text"],
+                True,
+                True,
+                formatting,
+                False
+            ).constructStoryString()
+
+    seconds = min(timeit.repeat(render, number=1, repeat=repeat))
+    storiesPerSecond = len(corpus) / seconds
+    print("{:<20} {:8.0f} stories per second".format("story rendering", storiesPerSecond))
+    return storiesPerSecond
+
+# The plugin prints every pulled page, which would drown the results
+def quiet():
+    return contextlib.redirect_stdout(open(os.devnull, "w"))
+
+# Optionally records the traffic to the given cassette file
+def conduitClients(server, cassette=None):
+
+    transport = None
+    if cassette:
+        transport = ConduitRecorder(ConduitConnectionPool(server.url(), False, 10, 4, 60), cassette)
+
+    conduitAPI = ConduitAPI(server.url(), "benchmark-token", acceptInvalidSSLCert=False, httpTimeout=10, transport=transport)
+    return conduitAPI, AsyncConduitAPI(conduitAPI)
+
+def benchmarkStoryPrinter(conduitAPI, asyncConduitAPI, storyLimit, sleepTime, historyForwards=True, chronokey=0):
+    return PhabricatorStoryPrinter(
+        conduitAPI=conduitAPI,
+        asyncConduitAPI=asyncConduitAPI,
+        formatting=PhabricatorStringFormatting(bolding=True, obscureUsernames=True, htmlLinks=False),
+        storyLimit=storyLimit,
+        historyForwards=historyForwards,
+        timestampAfter=0,
+        timestampBefore=0,
+        sleepTime=sleepTime,
+        newsPrefix="",
+        printDate=False,
+        ignoredUsers=[],
+        filteredUsers=[],
+        notifyCommit=True,
+        notifyRetitle=True,
+        chronokey=chronokey,
+        chronokeyFile=None,
+        verbose=False)
+
+def latencySummary(samples):
+    return {
+        "samples": len(samples),
+        "medianMilliseconds": statistics.median(samples) * 1000,
+        "p95Milliseconds": statistics.quantiles(samples, n=20)[18] * 1000,
+        "maxMilliseconds": max(samples) * 1000
+    }
+
+def printLatency(name, summary):
+    print("{:<20} {:8.1f} ms median, {:.1f} ms p95".format(name, summary["medianMilliseconds"], summary["p95Milliseconds"]))
+
+# Stories per second pulled, resolved and rendered by pullSomeStories
+def benchmarkFeedThroughput(storyCount=2000, storyLimit=100, latency=0.005, cassette=None):
+
+    server = FakeConduitServer(FakeConduitData(storyCount), latency)
+    conduitAPI, asyncConduitAPI = conduitClients(server, cassette)
+    storyPrinter = benchmarkStoryPrinter(conduitAPI, asyncConduitAPI, storyLimit, 0)
+
+    pulled = 0
+    start = time.perf_counter()
+    with quiet():
+        while True:
+            if storyPrinter.pullSomeStories() is True or storyPrinter.lastPageSize == 0:
+                break
+            pulled += storyPrinter.lastPageSize
+    seconds = time.perf_counter() - start
+
+    results = {
+        "stories": pulled,
+        "seconds": seconds,
+        "storiesPerSecond": pulled / seconds,
+        "requests": dict(server.requestCounts)
+    }
+    print("{:<20} {:8.0f} stories per second".format("feed throughput", results["storiesPerSecond"]))
+
+    asyncConduitAPI.close()
+    conduitAPI.close()
+    server.close()
+    return results
+
+# Time until the replies to a chat message mentioning a differential and a paste are constructed
+def benchmarkReplyLatency(requests=200, latency=0.005):
+
+    data = FakeConduitData(0)
+    server = FakeConduitServer(data, latency)
+    conduitAPI, asyncConduitAPI = conduitClients(server)
+    formatting = PhabricatorStringFormatting(bolding=True, obscureUsernames=True, htmlLinks=False)
+    rng = random.Random(0)
+
+    samples = []
+    for _ in range(requests):
+        txt = "{nick}: have a look at D{differential}, the log is at P{paste}".format(
+            nick=rng.choice(nicks), differential=rng.choice(list(data.differentials)), paste=rng.choice(list(data.pastes)))
+
+        start = time.perf_counter()
+        PhabricatorReplyPrinter(txt=txt, conduitAPI=conduitAPI, formatting=formatting, asyncConduitAPI=asyncConduitAPI).getReplies()
+        samples.append(time.perf_counter() - start)
+
+    results = latencySummary(samples)
+    printLatency("reply latency", results)
+
+    asyncConduitAPI.close()
+    conduitAPI.close()
+    server.close()
+    return results
+
+# Records when the messages are queued, like the Irc object of the bot
+class BenchmarkIrc:
+
+    def __init__(self):
+        self.network = "benchmark"
+        self.zombie = False
+        self.queue = []
+        self.state = type("State", (), {})()
+        self.state.channels = {"#benchmark": None}
+        self.state.supported = {}
+        self.queued = threading.Event()
+        self.lastQueued = None
+
+    def queueMsg(self, msg):
+        self.lastQueued = time.perf_counter()
+        self.queued.set()
+
+# Time from a story appearing in the feed until its message is queued on the IRC connection.
+# The feed is queried right away like after a webhook request, so the poll interval isn't measured.
+def benchmarkEndToEnd(samples=100, latency=0.005):
+
+    data = FakeConduitData(10)
+    server = FakeConduitServer(data, latency)
+    conduitAPI, asyncConduitAPI = conduitClients(server)
+    storyPrinter = benchmarkStoryPrinter(conduitAPI, asyncConduitAPI, 100, 3600)
+
+    irc = BenchmarkIrc()
+    outbound = PhabricatorOutboundScheduler(rate=1000, burst=1000, highWaterMark=1000, verbose=False)
+    subscribers = PhabricatorStorySubscribers(outbound)
+    subscribers.subscribe(irc, [])
+
+    instance = PhabricatorInstance("", conduitAPI, asyncConduitAPI, storyPrinter, subscribers, [])
+    scheduler = PhabricatorInstanceScheduler(workers=1, verbose=False)
+
+    durations = []
+    with quiet():
+        scheduler.start([instance], 0)
+
+        # Wait until the stories that existed before were sent
+        while irc.queued.wait(1):
+            irc.queued.clear()
+
+        for _ in range(samples):
+            start = time.perf_counter()
+            data.addStories(1)
+            scheduler.wake(instance)
+
+            if not irc.queued.wait(10):
+                raise RuntimeError("The story wasn't sent within 10 seconds")
+            irc.queued.clear()
+            durations.append(irc.lastQueued - start)
+
+    results = latencySummary(durations)
+    printLatency("story to queueMsg", results)
+
+    scheduler.stop()
+    outbound.stop()
+    asyncConduitAPI.close()
+    conduitAPI.close()
+    server.close()
+    return results
+
+# Stories per second pulled, resolved and rendered by pullSomeStories from recorded traffic.
+# The story printer starts where the recording started, so that it repeats the recorded queries.
+def benchmarkCassette(filename, realTime=False):
+
+    replayer = ConduitReplayer(filename, realTime)
+    feedQueries = replayer.recordedRequests("/api/feed.query")
+    if not feedQueries:
+        print("The cassette contains no feed queries")
+        return None
+
+    firstQuery = dict(urllib.parse.parse_qsl(feedQueries[0]["b"]))
+    chronokey = firstQuery.get("before", firstQuery.get("after"))
+
+    conduitAPI = ConduitAPI("cassette", "cassette-token", acceptInvalidSSLCert=False, httpTimeout=10, transport=replayer)
+    asyncConduitAPI = AsyncConduitAPI(conduitAPI)
+    storyPrinter = benchmarkStoryPrinter(
+        conduitAPI,
+        asyncConduitAPI,
+        int(firstQuery["limit"]),
+        0,
+        historyForwards="after" not in firstQuery,
+        chronokey=int(chronokey) if chronokey is not None else None)
+
+    pulled = 0
+    start = time.perf_counter()
+    with quiet():
+        for _ in feedQueries:
+            if storyPrinter.pullSomeStories() is True:
+                break
+            pulled += storyPrinter.lastPageSize
+    seconds = time.perf_counter() - start
+
+    results = {
+        "stories": pulled,
+        "feedQueries": len(feedQueries),
+        "seconds": seconds,
+        "storiesPerSecond": pulled / seconds,
+        "realTime": realTime
+    }
+    print("{:<20} {:8.0f} stories per second".format("cassette replay", results["storiesPerSecond"]))
+
+    asyncConduitAPI.close()
+    return results
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description="Measures the performance of the plugin against a local fake Conduit server")
+    parser.add_argument("--stories", type=int, default=2000, help="number of feed stories to pull")
+    parser.add_argument("--latency", type=float, default=0.005, help="seconds the fake server waits before answering")
+    parser.add_argument("--samples", type=int, default=100, help="number of chat replies and stories whose latency is measured")
+    parser.add_argument("--json", help="file to write the results to, for comparisons with previous runs")
+    parser.add_argument("--cassette", help="only replay the feed queries recorded in this cassette")
+    parser.add_argument("--realtime", action="store_true", help="replay the cassette at the recorded speed")
+    parser.add_argument("--record", help="record the traffic of the feed throughput benchmark to this cassette")
+    arguments = parser.parse_args()
+
+    if arguments.cassette:
+        results = {
+            "cassette": benchmarkCassette(arguments.cassette, arguments.realtime)
+        }
+    else:
+        results = {
+            "latency": arguments.latency,
+            "messageScanNanoseconds": benchmarkMessageScan(),
+            "storyRenderingPerSecond": benchmarkStoryParsing(),
+            "feedThroughput": benchmarkFeedThroughput(storyCount=arguments.stories, latency=arguments.latency, cassette=arguments.record),
+            "replyLatency": benchmarkReplyLatency(requests=arguments.samples, latency=arguments.latency),
+            "endToEnd": benchmarkEndToEnd(samples=arguments.samples, latency=arguments.latency)
+        }
+
+    if arguments.json:
+        with open(arguments.json, "w") as resultFile:
+            json.dump(results, resultFile, indent=4, sort_keys=True)
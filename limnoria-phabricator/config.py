@@ -77,22 +77,124 @@ def configure(advanced):
     Phabricator.verbose.setValue(
         yn("Display spammy, verbose debug output?", default=False))
 
+# Which request to drop if too many are waiting
+class ShedPolicy(registry.OnlySomeStrings):
+    validStrings = ('oldest', 'newest')
+
+# Whether to record the Conduit traffic or to answer it from a recording
+class CassetteMode(registry.OnlySomeStrings):
+    validStrings = ('off', 'record', 'replay')
+
 # Register valid options
 
 Phabricator = conf.registerPlugin('Phabricator')
 
 conf.registerGlobalValue(Phabricator, 'phabricatorURL',
-    registry.String("", _("URL of a Phabricator instance.")))
+    registry.String("", _("URL of a Phabricator instance. It is reached with HTTPS unless it starts with http://")))
 
 conf.registerGlobalValue(Phabricator, 'phabricatorToken',
     registry.String("", _("Token to access Phabricators conduit API.")))
 
+conf.registerGlobalValue(Phabricator, 'cassetteMode',
+    CassetteMode("off", _("Whether to record the Conduit requests and responses to the cassette file, or to answer the requests from it instead of Phabricator. Further instances always query their Phabricator.")))
+
+conf.registerGlobalValue(Phabricator, 'cassetteFile',
+    registry.String("conduit.cassette.gz", _("File to record the Conduit traffic to or to replay it from. The API token is not recorded.")))
+
+conf.registerGlobalValue(Phabricator, 'cassetteRealTime',
+    registry.Boolean(False, _("Whether replayed responses arrive at their recorded offsets and take as long as the recorded ones, reproducing bursts and gaps, or are returned right away.")))
+
+conf.registerGlobalValue(Phabricator, 'instances',
+    registry.SpaceSeparatedListOfStrings("", _("Names of further Phabricator instances to follow, for example forks. Each one is configured in the instance.<name> group of this plugin.")))
+
+conf.registerGlobalValue(Phabricator, 'pollWorkers',
+    registry.PositiveInteger(2, _("Number of threads that poll the feeds of all instances.")))
+
+instanceGroup = conf.registerGroup(Phabricator, 'instance')
+
+# Registers the options of a further Phabricator instance.
+# All options that aren't listed here are shared with the instance configured at the top level.
+def registerInstance(name):
+
+    group = conf.registerGroup(instanceGroup, name)
+
+    conf.registerGlobalValue(group, 'phabricatorURL',
+        registry.String("", _("URL of the Phabricator instance.")))
+
+    conf.registerGlobalValue(group, 'phabricatorToken',
+        registry.String("", _("Token to access the conduit API of the instance.")))
+
+    conf.registerGlobalValue(group, 'chronokeyFile',
+        registry.String(name + "-chronokey.txt", _("Filename containing the chronological key of the most recently parsed update of the instance.")))
+
+    conf.registerGlobalValue(group, 'channels',
+        registry.SpaceSeparatedListOfStrings("", _("List of channels on which the bot posts updates of the instance. If empty, prints on each joined channel.")))
+
+    conf.registerGlobalValue(group, 'newsPrefix',
+        registry.String("News from " + name + ":", _("A string to be shown in front of every update notification of the instance")))
+
+    conf.registerGlobalValue(group, 'ignoredUsers',
+        registry.SpaceSeparatedListOfStrings("", _("Notify IRC users about updates of the instance of all users, excluding these (for example bots)")))
+
+    conf.registerGlobalValue(group, 'filteredUsers',
+        registry.SpaceSeparatedListOfStrings("", _("Only notify IRC users about updates of the instance of these users")))
+
+    return group
+
 conf.registerGlobalValue(Phabricator, 'acceptInvalidSSLCert',
     registry.Boolean(False, _("Whether to accept invalid SSL certificates.")))
 
 conf.registerGlobalValue(Phabricator, 'httpTimeout',
     registry.PositiveInteger(40, _("How long to wait for HTTP(S) responses until aborting the request.")))
 
+conf.registerGlobalValue(Phabricator, 'connectionPoolSize',
+    registry.PositiveInteger(4, _("How many idle HTTPS connections to keep open for reuse.")))
+
+conf.registerGlobalValue(Phabricator, 'connectionIdleTimeout',
+    registry.NonNegativeInteger(60, _("Number of seconds after which an unused HTTPS connection is closed instead of being reused.")))
+
+conf.registerGlobalValue(Phabricator, 'maxConcurrentRequests',
+    registry.PositiveInteger(4, _("How many Conduit API requests may be in flight at the same time, for example to look up authors and objects concurrently.")))
+
+conf.registerGlobalValue(Phabricator, 'phidCacheSize',
+    registry.PositiveInteger(5000, _("Maximum number of users and objects to remember, so that they don't have to be queried again.")))
+
+conf.registerGlobalValue(Phabricator, 'phidCacheUserTTL',
+    registry.NonNegativeInteger(86400, _("Number of seconds after which a remembered username is queried again. 0 disables caching of users.")))
+
+conf.registerGlobalValue(Phabricator, 'phidCacheObjectTTL',
+    registry.NonNegativeInteger(300, _("Number of seconds after which a remembered object title is queried again. 0 disables caching of objects.")))
+
+conf.registerGlobalValue(Phabricator, 'replyWorkers',
+    registry.PositiveInteger(2, _("Number of threads that look up the differentials and pastes mentioned in chat.")))
+
+conf.registerGlobalValue(Phabricator, 'replyQueueLimit',
+    registry.PositiveInteger(20, _("How many chat lookups may wait for a free thread before some are dropped.")))
+
+conf.registerGlobalValue(Phabricator, 'replyShedPolicy',
+    ShedPolicy("oldest", _("Whether to drop the oldest or the newest waiting chat lookup if the queue is full.")))
+
+conf.registerGlobalValue(Phabricator, 'replyDeadline',
+    registry.PositiveInteger(15, _("Number of seconds after which a reply to a chat message is not sent anymore.")))
+
+conf.registerGlobalValue(Phabricator, 'outboundRate',
+    registry.PositiveFloat(1.0, _("Number of messages per second that are sent to IRC on average. Replies to chat messages are sent before stories.")))
+
+conf.registerGlobalValue(Phabricator, 'outboundBurst',
+    registry.PositiveInteger(4, _("Number of messages that may be sent at once after a quiet period.")))
+
+conf.registerGlobalValue(Phabricator, 'outboundHighWaterMark',
+    registry.PositiveInteger(20, _("Number of messages waiting to be sent at which no further stories are pulled until the queue drains.")))
+
+conf.registerGlobalValue(Phabricator, 'replyCacheTTL',
+    registry.NonNegativeInteger(600, _("Number of seconds to remember the reply to a mentioned differential or paste. Updates seen in the feed refresh it earlier.")))
+
+conf.registerGlobalValue(Phabricator, 'replyNegativeCacheTTL',
+    registry.NonNegativeInteger(60, _("Number of seconds to remember that a mentioned differential or paste doesn't exist.")))
+
+conf.registerGlobalValue(Phabricator, 'replyCooldown',
+    registry.NonNegativeInteger(120, _("Number of seconds during which the same differential or paste is not announced again in the same channel.")))
+
 conf.registerGlobalValue(Phabricator, 'channels',
     registry.SpaceSeparatedListOfStrings("", _("List of channels on which the bot posts Phabricator updates. If empty, prints on each joined channel.")))
 
@@ -108,9 +210,30 @@ conf.registerGlobalValue(Phabricator, 'timestampAfter',
 conf.registerGlobalValue(Phabricator, 'timestampBefore',
     registry.NonNegativeInteger(0, _("If given, ignore messages before this timestamp")))
 
+conf.registerGlobalValue(Phabricator, 'backfillWorkers',
+    registry.PositiveInteger(1, _("If greater than 1 and both timestamps are given, fetch the stories of that time window with this many concurrent requests.")))
+
 conf.registerGlobalValue(Phabricator, 'sleepTime',
     registry.NonNegativeInteger(30, _("Notify IRC users about phabricator updates of all users, excluding these (for example bots)")))
 
+conf.registerGlobalValue(Phabricator, 'maxSleepTime',
+    registry.NonNegativeInteger(300, _("While no new stories appear, wait up to this many seconds between two queries. Full pages are followed by the next query immediately.")))
+
+conf.registerGlobalValue(Phabricator, 'sleepBackoffFactor',
+    registry.PositiveFloat(2.0, _("Factor by which the time between two queries grows while no new stories appear")))
+
+conf.registerGlobalValue(Phabricator, 'webhookPort',
+    registry.NonNegativeInteger(0, _("Port on which to accept Phabricator webhook requests, so that new stories are queried right away. 0 disables the listener. Polling continues with maxSleepTime to catch up with lost requests.")))
+
+conf.registerGlobalValue(Phabricator, 'webhookHost',
+    registry.String("127.0.0.1", _("Address on which to accept Phabricator webhook requests.")))
+
+conf.registerGlobalValue(Phabricator, 'webhookSecret',
+    registry.String("", _("HMAC key of the Phabricator webhook. Requests without a valid signature are rejected. The listener is not started without it.")))
+
+conf.registerGlobalValue(Phabricator, 'prefetchPages',
+    registry.NonNegativeInteger(2, _("Number of pages of stories that are fetched in the background while a full page is sent to IRC, so that a backlog of stories is drained faster. Each instance uses one more thread for it. 0 disables prefetching.")))
+
 conf.registerGlobalValue(Phabricator, 'newsPrefix',
     registry.String("News from the project:", _("A string to be shown in front of every Phabricator update notification")))
 
@@ -120,6 +243,30 @@ conf.registerGlobalValue(Phabricator, 'printDate',
 conf.registerGlobalValue(Phabricator, 'chronokeyFile',
     registry.String("chronokey.txt", _("Filename containing the chronological key of the most recently parsed phabricator update.")))
 
+conf.registerGlobalValue(Phabricator, 'digestWindow',
+    registry.NonNegativeInteger(60, _("Stories of the same author about the same object within this many seconds are sent as one line. 0 sends every story separately.")))
+
+conf.registerGlobalValue(Phabricator, 'chronokeySaveInterval',
+    registry.NonNegativeInteger(1000, _("Milliseconds between two saves of the chronological key while a page of stories is processed. It is always saved after a page.")))
+
+conf.registerGlobalValue(Phabricator, 'chronokeyFsync',
+    registry.Boolean(True, _("Whether to flush the chronological key file to the disk on every save, so that it survives power losses")))
+
+conf.registerGlobalValue(Phabricator, 'chronokeyHistory',
+    registry.PositiveInteger(5, _("Number of previous chronological keys kept in the file to recover from a damaged checkpoint")))
+
+conf.registerGlobalValue(Phabricator, 'archiveFile',
+    registry.String("", _("If given, every pulled story is stored in this SQLite database, which history queries read from before querying phabricator.")))
+
+conf.registerGlobalValue(Phabricator, 'searchResults',
+    registry.PositiveInteger(5, _("Number of archived stories the phabsearch command replies with per page")))
+
+conf.registerGlobalValue(Phabricator, 'reportDirectory',
+    registry.String("", _("Directory the phabreport command writes progress reports to. If empty, the command is disabled.")))
+
+conf.registerGlobalValue(Phabricator, 'reportProject',
+    registry.String("", _("Phabricator project whose members are listed first in progress reports")))
+
 conf.registerGlobalValue(Phabricator, 'ignoredUsers',
     registry.SpaceSeparatedListOfStrings("", _("Notify IRC users about phabricator updates of all users, excluding these (for example bots)")))
 
@@ -0,0 +1,234 @@
+import json
+import random
+import threading
+import time
+import urllib.parse
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+# Answers the Conduit methods used by the plugin with synthetic data, so that it can be measured without a Phabricator instance.
+# The server speaks plain HTTP, the plugin reaches it with the location "http://127.0.0.1:<port>".
+
+diffusionAuthorPHID = "PHID-APPS-PhabricatorDiffusionApplication"
+
+# Story texts of differential revisions, filled with author, ID and title
+differentialActions = [
+    "{author} created D{id}: {title}.",
+    "{author} updated the diff for D{id}: {title}.",
+    "{author} added inline comments to D{id}: {title}.",
+    "{author} added a comment to D{id}: {title}.",
+    "{author} requested changes to D{id}: {title}.",
+    "{author} accepted D{id}: {title}.",
+    "{author} planned changes to D{id}: {title}.",
+    "{author} closed D{id}: {title}.",
+]
+
+titleWords = ["Fix", "pathfinder", "formations", "AI", "ships", "renderer", "GUI", "lobby", "rmgen", "Atlas", "sound", "cleanup"]
+
+# Generates users, differential revisions, pastes, commits and the feed stories about them.
+# The same seed always yields the same data.
+class FakeConduitData:
+
+    def __init__(self, storyCount, userCount=20, differentialCount=500, pasteCount=100, commitRatio=0.1, seed=0,
+                 firstEpoch=1500000000, storyInterval=60):
+
+        self.rng = random.Random(seed)
+        self.firstEpoch = firstEpoch
+        self.storyInterval = storyInterval
+        self.commitRatio = commitRatio
+        self.lock = threading.Lock()
+
+        self.users = ["user" + str(i) for i in range(userCount)]
+        self.differentials = {str(i): self.__title() for i in range(1, differentialCount + 1)}
+        self.pastes = {str(i): "log" + str(i) + ".txt" for i in range(1, pasteCount + 1)}
+        self.commits = {}
+
+        # Ordered by chronokey, oldest first
+        self.stories = []
+        self.addStories(storyCount)
+
+    def __title(self):
+        return " ".join(self.rng.choice(titleWords) for _ in range(self.rng.randint(2, 6)))
+
+    # Appends stories after the newest one, returns their chronokeys
+    def addStories(self, count, epoch=None):
+
+        chronokeys = []
+        with self.lock:
+            for _ in range(count):
+                number = len(self.stories)
+                storyEpoch = epoch if epoch is not None else self.firstEpoch + number * self.storyInterval
+                chronokey = (storyEpoch << 32) + number
+
+                author = self.rng.randrange(len(self.users))
+                authorPHID = "PHID-USER-" + str(author)
+
+                if self.rng.random() < self.commitRatio:
+                    commitID = str(10000 + number)
+                    self.commits[commitID] = (self.__title(), self.users[author])
+                    objectPHID = "PHID-CMIT-" + commitID
+
+                    # Commits without Phabricator account are authored by Diffusion
+                    if self.rng.random() < 0.5:
+                        authorPHID = diffusionAuthorPHID
+                    text = "{author} committed rP{id}: {title} (authored by {author}).".format(
+                        author=self.users[author], id=commitID, title=self.commits[commitID][0])
+                else:
+                    differentialID = self.rng.choice(list(self.differentials))
+                    objectPHID = "PHID-DREV-" + differentialID
+                    text = self.rng.choice(differentialActions).format(
+                        author=self.users[author], id=differentialID, title=self.differentials[differentialID])
+
+                self.stories.append({
+                    "storyPHID": "PHID-STRY-" + str(number),
+                    "chronologicalKey": str(chronokey),
+                    "epoch": storyEpoch,
+                    "authorPHID": authorPHID,
+                    "objectPHID": objectPHID,
+                    "text": text
+                })
+                chronokeys.append(chronokey)
+
+        return chronokeys
+
+    # feed.query, "before" pages forwards in time and "after" backwards
+    def feed(self, params):
+
+        limit = int(params.get("limit", ["100"])[0])
+
+        with self.lock:
+            stories = self.stories
+            if "before" in params:
+                chronokey = int(params["before"][0])
+                stories = [story for story in stories if int(story["chronologicalKey"]) > chronokey][:limit]
+            elif "after" in params:
+                chronokey = int(params["after"][0])
+                stories = [story for story in stories if int(story["chronologicalKey"]) < chronokey][-limit:]
+            else:
+                stories = stories[-limit:]
+
+        # Phabricator lists the newest story first
+        return {story["storyPHID"]: story for story in reversed(stories)}
+
+    def phid(self, phid):
+
+        kind, _, number = phid[len("PHID-"):].partition("-")
+
+        if phid == diffusionAuthorPHID:
+            return {"name": "Diffusion", "fullName": "Diffusion", "typeName": "Application", "uri": "https://phabricator.test/diffusion/"}
+
+        if kind == "USER":
+            name = self.users[int(number)]
+            return {"name": name, "fullName": name, "typeName": "User", "uri": "https://phabricator.test/p/" + name + "/"}
+
+        if kind == "CMIT":
+            return {"name": "rP" + number, "fullName": "rP" + number + ": " + self.commits[number][0],
+                    "typeName": "Diffusion Commit", "uri": "https://phabricator.test/rP" + number}
+
+        if kind == "PSTE":
+            return {"name": "P" + number, "fullName": "P" + number + " " + self.pastes[number],
+                    "typeName": "Paste", "uri": "https://phabricator.test/P" + number}
+
+        return {"name": "D" + number, "fullName": "D" + number + ": " + self.differentials[number],
+                "typeName": "Differential Revision", "uri": "https://phabricator.test/D" + number}
+
+    def respond(self, path, params):
+
+        if path == "/api/feed.query":
+            return self.feed(params)
+
+        if path == "/api/phid.query":
+            return {phid: self.phid(phid) for phid in params.get("phids[]", [])}
+
+        if path == "/api/user.query":
+            userNames = params.get("usernames[]", [])
+            return [{"userName": name, "phid": "PHID-USER-" + str(i)} for i, name in enumerate(self.users) if name in userNames]
+
+        if path == "/api/differential.query":
+            return [{
+                "id": ID,
+                "phid": "PHID-DREV-" + ID,
+                "title": self.differentials[ID],
+                "uri": "https://phabricator.test/D" + ID,
+                "statusName": "Needs Review"
+            } for ID in params.get("ids[]", []) if ID in self.differentials]
+
+        if path == "/api/paste.query":
+            return {"PHID-PSTE-" + ID: {
+                "id": ID,
+                "title": self.pastes[ID],
+                "uri": "https://phabricator.test/P" + ID,
+                "authorPHID": "PHID-USER-" + str(int(ID) % len(self.users))
+            } for ID in params.get("ids[]", []) if ID in self.pastes}
+
+        if path == "/api/diffusion.querycommits":
+            return {"data": {
+                phid: {"author": self.commits[phid[len("PHID-CMIT-"):]][1]} for phid in params.get("phids[]", [])
+            }}
+
+        return None
+
+class FakeConduitRequestHandler(BaseHTTPRequestHandler):
+
+    # Keeps connections alive like Phabricator does
+    protocol_version = "HTTP/1.1"
+
+    # Sends the headers and the body in one packet, otherwise the delayed ACK of the client would be measured
+    disable_nagle_algorithm = True
+    wbufsize = -1
+
+    def log_message(self, format, *args):
+        pass
+
+    # The plugin sends its parameters as the body of a GET request
+    def do_GET(self):
+        self.__answer()
+
+    def do_POST(self):
+        self.__answer()
+
+    def __answer(self):
+
+        length = int(self.headers.get("Content-Length") or 0)
+        params = urllib.parse.parse_qs(self.rfile.read(length).decode())
+
+        server = self.server
+        with server.lock:
+            server.requestCounts[self.path] = server.requestCounts.get(self.path, 0) + 1
+
+        if server.latency:
+            time.sleep(server.latency)
+
+        result = server.data.respond(self.path, params)
+        if result is None:
+            body = {"result": None, "error_code": "ERR-CONDUIT-CALL", "error_info": "Unknown method " + self.path}
+        else:
+            body = {"result": result, "error_code": None, "error_info": None}
+
+        data = json.dumps(body).encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+# Serves the given data on a free local port with the given delay in seconds per request
+class FakeConduitServer(ThreadingHTTPServer):
+
+    daemon_threads = True
+
+    def __init__(self, data, latency=0):
+        super().__init__(("127.0.0.1", 0), FakeConduitRequestHandler)
+        self.data = data
+        self.latency = latency
+        self.lock = threading.Lock()
+        self.requestCounts = {}
+
+        self.thread = threading.Thread(target=self.serve_forever, daemon=True)
+        self.thread.start()
+
+    def url(self):
+        return "http://127.0.0.1:" + str(self.server_address[1])
+
+    def close(self):
+        self.shutdown()
+        self.server_close()
@@ -4,11 +4,14 @@
 ###
 
 import ssl
-import supybot.conf as conf
 import supybot.ircmsgs as ircmsgs
 import supybot.ircutils as ircutils
 import supybot.callbacks as callbacks
+from supybot.commands import *
 import http.client
+import http.server
+import hashlib
+import hmac
 import urllib.parse
 import socket
 import html
@@ -16,9 +19,24 @@ import html
 import time
 import datetime
 import threading
+import queue
+import asyncio
+import concurrent.futures
 import re
 import os.path
-from collections import OrderedDict
+import sqlite3
+import gzip
+import heapq
+import itertools
+from collections import OrderedDict, deque, namedtuple
+
+# Also allows to import the plugin outside of the bot, like test_progress.py does
+try:
+    from .report import PhabricatorProgressReport, reportWriters, reportedObjTypes, actionRanks
+    from .config import registerInstance
+except ImportError:
+    from report import PhabricatorProgressReport, reportWriters, reportedObjTypes, actionRanks
+    from config import registerInstance
 
 try:
     from supybot.i18n import PluginInternationalization
@@ -38,113 +56,523 @@ class Phabricator(callbacks.Plugin):
         self.__parent.__init__(irc)
         callbacks.Plugin.__init__(self, irc)
 
-        self.syncedChannels = []
-        self.thread = None
+        # Maps network name to the channels whose WHO reply arrived
+        self.syncedChannels = {}
+        self.started = False
 
         self.conduitAPI = ConduitAPI(
             self.registryValue("phabricatorURL"),
             self.registryValue("phabricatorToken"),
             self.registryValue("acceptInvalidSSLCert"),
             self.registryValue("httpTimeout"),
+            self.registryValue("connectionPoolSize"),
+            self.registryValue("connectionIdleTimeout"),
+            self.registryValue("phidCacheSize"),
+            self.registryValue("phidCacheUserTTL"),
+            self.registryValue("phidCacheObjectTTL"),
+            self.__createTransport()
         )
 
+        self.asyncConduitAPI = AsyncConduitAPI(
+            self.conduitAPI,
+            self.registryValue("maxConcurrentRequests"))
+
+        self.archive = None
+        if self.registryValue("archiveFile"):
+            self.archive = PhabricatorStoryArchive(self.registryValue("archiveFile"))
+
+        # Held while phabreport writes a report
+        self.reportLock = threading.Lock()
+
         self.formatting = PhabricatorStringFormatting(True, self.registryValue("obscureUsernames"), False)
 
-        self.storyPrinter = PhabricatorStoryPrinter(
+        self.outbound = PhabricatorOutboundScheduler(
+            rate=self.registryValue("outboundRate"),
+            burst=self.registryValue("outboundBurst"),
+            highWaterMark=self.registryValue("outboundHighWaterMark"),
+            verbose=self.registryValue("verbose"))
+
+        self.subscribers = PhabricatorStorySubscribers(self.outbound)
+
+        self.replyCache = PhabricatorReplyCache(
+            ttl=self.registryValue("replyCacheTTL"),
+            negativeTTL=self.registryValue("replyNegativeCacheTTL"),
+            cooldown=self.registryValue("replyCooldown"))
+
+        self.storyPrinter = self.__createStoryPrinter(
             conduitAPI=self.conduitAPI,
+            asyncConduitAPI=self.asyncConduitAPI,
+            replyCache=self.replyCache,
+            archive=self.archive,
+            newsPrefix=self.registryValue("newsPrefix"),
+            ignoredUsers=self.registryValue("ignoredUsers"),
+            filteredUsers=self.registryValue("filteredUsers"),
+            chronokeyFile=self.registryValue("chronokeyFile"))
+
+        # The instance configured at the top level of the plugin, followed by further named ones
+        self.instances = [PhabricatorInstance("", self.conduitAPI, self.asyncConduitAPI, self.storyPrinter, self.subscribers, self.registryValue("channels"))]
+        for name in self.registryValue("instances"):
+            self.instances.append(self.__createInstance(name))
+
+        self.scheduler = PhabricatorInstanceScheduler(
+            workers=self.registryValue("pollWorkers"),
+            verbose=self.registryValue("verbose"))
+
+        # With webhooks, polling only catches up with stories whose webhook request got lost
+        self.webhookListener = None
+        if self.registryValue("webhookPort"):
+            if not self.registryValue("webhookSecret"):
+                print("Not starting the webhook listener without webhookSecret")
+            else:
+                try:
+                    self.webhookListener = PhabricatorWebhookListener(
+                        host=self.registryValue("webhookHost"),
+                        port=self.registryValue("webhookPort"),
+                        secret=self.registryValue("webhookSecret"),
+                        onPush=self.__wakeInstance,
+                        verbose=self.registryValue("verbose"))
+                except OSError as e:
+                    print("Could not start the webhook listener, polling only:", e)
+
+        self.replyWorkers = PhabricatorReplyWorkers(
+            workers=self.registryValue("replyWorkers"),
+            queueLimit=self.registryValue("replyQueueLimit"),
+            shedPolicy=self.registryValue("replyShedPolicy"),
+            deadline=self.registryValue("replyDeadline"),
+            verbose=self.registryValue("verbose")
+        )
+
+    # Records the Conduit traffic of the top level instance to a cassette or answers it from one, see cassetteMode.
+    # Returns None to use the default transport.
+    def __createTransport(self):
+
+        mode = self.registryValue("cassetteMode")
+        if mode == "off":
+            return None
+
+        filename = self.registryValue("cassetteFile")
+        if mode == "replay":
+            return ConduitReplayer(filename, self.registryValue("cassetteRealTime"))
+
+        return ConduitRecorder(
+            ConduitConnectionPool(
+                self.registryValue("phabricatorURL"),
+                self.registryValue("acceptInvalidSSLCert"),
+                self.registryValue("httpTimeout"),
+                self.registryValue("connectionPoolSize"),
+                self.registryValue("connectionIdleTimeout")),
+            filename)
+
+    # Creates a story printer with the options shared by all instances
+    def __createStoryPrinter(self, conduitAPI, asyncConduitAPI, replyCache, archive, newsPrefix, ignoredUsers, filteredUsers, chronokeyFile):
+        return PhabricatorStoryPrinter(
+            conduitAPI=conduitAPI,
+            asyncConduitAPI=asyncConduitAPI,
+            replyCache=replyCache,
             formatting=self.formatting,
-            channels=self.registryValue("channels"),
             storyLimit=self.registryValue("storyLimit"),
             historyForwards=self.registryValue("historyForwards"),
             timestampAfter=self.registryValue("timestampAfter"),
             timestampBefore=self.registryValue("timestampBefore"),
             sleepTime=self.registryValue("sleepTime"),
-            newsPrefix=self.registryValue("newsPrefix"),
+            maxSleepTime=self.registryValue("maxSleepTime"),
+            sleepBackoffFactor=self.registryValue("sleepBackoffFactor"),
+            prefetchPages=self.registryValue("prefetchPages"),
+            archive=archive,
+            newsPrefix=newsPrefix,
             printDate=self.registryValue("printDate"),
-            ignoredUsers=self.registryValue("ignoredUsers"),
-            filteredUsers=self.registryValue("filteredUsers"),
+            ignoredUsers=ignoredUsers,
+            filteredUsers=filteredUsers,
             notifyCommit=self.registryValue("notifyCommit"),
             notifyRetitle=self.registryValue("notifyRetitle"),
-            chronokeyFile=self.registryValue("chronokeyFile"),
+            chronokeyFile=chronokeyFile,
+            chronokeySaveInterval=self.registryValue("chronokeySaveInterval"),
+            chronokeyFsync=self.registryValue("chronokeyFsync"),
+            chronokeyHistory=self.registryValue("chronokeyHistory"),
+            digestWindow=self.registryValue("digestWindow"),
             chronokey=None,
-            verbose=self.registryValue("verbose")
+            verbose=self.registryValue("verbose"),
+            backfillWorkers=self.registryValue("backfillWorkers")
+        )
+
+    # Further instances have their own connections, caches and chronokey, but share the worker threads.
+    # Chat replies, the archive and reports only use the top level instance.
+    def __createInstance(self, name):
+
+        registerInstance(name)
+        option = lambda key: self.registryValue("instance." + name + "." + key)
+
+        conduitAPI = ConduitAPI(
+            option("phabricatorURL"),
+            option("phabricatorToken"),
+            self.registryValue("acceptInvalidSSLCert"),
+            self.registryValue("httpTimeout"),
+            self.registryValue("connectionPoolSize"),
+            self.registryValue("connectionIdleTimeout"),
+            self.registryValue("phidCacheSize"),
+            self.registryValue("phidCacheUserTTL"),
+            self.registryValue("phidCacheObjectTTL"),
         )
 
-    # Respond to channel and private messages
+        asyncConduitAPI = AsyncConduitAPI(conduitAPI, sharedWith=self.asyncConduitAPI)
+
+        storyPrinter = self.__createStoryPrinter(
+            conduitAPI=conduitAPI,
+            asyncConduitAPI=asyncConduitAPI,
+            replyCache=None,
+            archive=None,
+            newsPrefix=option("newsPrefix"),
+            ignoredUsers=option("ignoredUsers"),
+            filteredUsers=option("filteredUsers"),
+            chronokeyFile=option("chronokeyFile"))
+
+        return PhabricatorInstance(name, conduitAPI, asyncConduitAPI, storyPrinter, PhabricatorStorySubscribers(self.outbound), option("channels"))
+
+    # Called by the webhook listener, the path of the request names the instance
+    def __wakeInstance(self, path):
+
+        name = path.strip("/")
+        for instance in self.instances:
+            if instance.name == name:
+                self.scheduler.wake(instance)
+                return
+
+        print("Received webhook request for unknown instance", repr(name))
+
+    def die(self):
+        self.scheduler.stop()
+        self.replyWorkers.stop()
+        self.outbound.stop()
+        if self.webhookListener:
+            self.webhookListener.close()
+        for instance in self.instances:
+            instance.close()
+        if self.archive:
+            self.archive.close()
+        self.__parent.die()
+
+    # Respond to channel and private messages.
+    # The lookup happens on a worker thread, so that the message dispatch never waits for Phabricator.
     def doPrivmsg(self, irc, msg):
 
-        # TODO: check whether it works with actual PMs
-        channel = msg.args[0]
-        strings = PhabricatorReplyPrinter(
+        # Most chat messages don't mention any object
+        references = PhabricatorReplyPrinter.scanReferences(msg.args[1])
+        if references is None:
+            return
+
+        channel = msg.args[0] if irc.isChannel(msg.args[0]) else msg.nick
+        replyPrinter = PhabricatorReplyPrinter(
             txt=msg.args[1],
             conduitAPI=self.conduitAPI,
-            formatting=self.formatting
-        ).getReplies()
+            formatting=self.formatting,
+            asyncConduitAPI=self.asyncConduitAPI,
+            references=references,
+            replyCache=self.replyCache,
+            channel=channel
+        )
+
+        self.replyWorkers.submit(replyPrinter.getReplies, lambda strings: self.__reply(irc, channel, strings, replyPrinter))
 
+    # Replies that were dropped past their deadline don't start the cooldown of their objects
+    def __reply(self, irc, channel, strings, replyPrinter):
         for strng in strings:
-            irc.queueMsg(ircmsgs.privmsg(channel, strng))
+            self.outbound.sendReply(irc, channel, strng)
+        replyPrinter.announceReplies()
+
+    def phabsearch(self, irc, msg, args, opts, words):
+        """[--page <number>] <words>
+
+        Searches the text, object titles and author names of the archived Phabricator stories.
+        A word ending with * matches every word starting with it.
+        """
+
+        if not self.archive:
+            irc.error(_("The story archive is disabled, see the archiveFile option."))
+            return
+
+        if not self.archive.searchable:
+            irc.error(_("The SQLite library doesn't support full-text search."))
+            return
+
+        page = dict(opts).get("page", 1)
+        resultCount = self.registryValue("searchResults")
+
+        # Query one more result to know whether there is a next page
+        rows = self.archive.search(words, (page - 1) * resultCount, resultCount + 1)
+
+        if len(rows) == 0:
+            irc.reply(_("No stories found."))
+            return
+
+        for row in rows[:resultCount]:
+            irc.reply(self.__renderSearchResult(*row), prefixNick=False)
+
+        if len(rows) > resultCount:
+            irc.reply(_("More results with --page %d") % (page + 1), prefixNick=False)
+
+    phabsearch = wrap(phabsearch, [getopts({"page": "positiveInt"}), "text"])
+
+    # Renders an archived story like the feed does, so that the names of the mentioned users are obscured too
+    def __renderSearchResult(self, epoch, objectPHID, text, authorName, objType, objID, objTitle, objLink):
+
+        string = None
+        if objType is not None and authorName is not None:
+            string, _ = PhabricatorStoryStringConstructor(
+                objType,
+                objectPHID,
+                objID,
+                objTitle,
+                objLink,
+                authorName,
+                text,
+                True,
+                True,
+                self.formatting,
+                self.registryValue("verbose")
+            ).constructStoryString()
+
+        # Stories that the feed doesn't announce are replied verbatim, except for the author name
+        if string is None:
+            if authorName:
+                text = text.replace(authorName, self.formatting.obscureAuthorName(authorName))
+            string = text + (" " + self.formatting.formatLink(objLink) if objLink else "")
+
+        return datetime.datetime.fromtimestamp(epoch).strftime('[%Y-%m-%d] ') + string
+
+    def phabreport(self, irc, msg, args, opts, start, end):
+        """[--format text|markdown|html] <start date> [<end date>]
+
+        Writes a progress report of the Phabricator activity between the given dates (YYYY-MM-DD)
+        to the configured report directory. The end date defaults to now.
+        Only the owner of the bot can write reports, one at a time.
+        """
+
+        reportDirectory = self.registryValue("reportDirectory")
+        if not reportDirectory:
+            irc.error(_("The report directory is not configured, see the reportDirectory option."))
+            return
+
+        try:
+            start = datetime.datetime.strptime(start, "%Y-%m-%d")
+            end = datetime.datetime.strptime(end, "%Y-%m-%d") if end else datetime.datetime.now()
+        except ValueError:
+            irc.error(_("Dates must be given as YYYY-MM-DD."))
+            return
+
+        writerClass = reportWriters[dict(opts).get("format", "text")]
+        filename = os.path.join(reportDirectory, "report-" + start.strftime("%Y-%m-%d") + "-" + end.strftime("%Y-%m-%d") + "." + writerClass.fileExtension)
+
+        if not self.reportLock.acquire(blocking=False):
+            irc.error(_("A report is being written already, please wait until it is finished."))
+            return
+
+        # Pulling the stories can take a while, don't block the bot meanwhile
+        def writeReport():
+            try:
+                self.__writeReport(irc, filename, writerClass, start, end)
+            finally:
+                self.reportLock.release()
+
+        threading.Thread(target=writeReport, daemon=True).start()
+
+    phabreport = wrap(phabreport, [
+        "owner",
+        getopts({"format": ("literal", tuple(reportWriters))}),
+        "somethingWithoutSpaces",
+        optional("somethingWithoutSpaces")])
+
+    # Writes the report to the given file and tells the user about the outcome.
+    # Incomplete reports are removed.
+    def __writeReport(self, irc, filename, writerClass, start, end):
+
+        try:
+            with open(filename, "w") as stream:
+                written = writeProgressReport(
+                    conduitAPI=self.conduitAPI,
+                    asyncConduitAPI=self.asyncConduitAPI,
+                    archive=self.archive,
+                    writer=writerClass(stream),
+                    start=start,
+                    end=end,
+                    projectName=self.registryValue("reportProject"),
+                    ignoredUsers=self.registryValue("ignoredUsers"),
+                    backfillWorkers=max(1, self.registryValue("backfillWorkers")),
+                    verbose=self.registryValue("verbose"))
+        except OSError as e:
+            irc.error(_("Could not write the report: %s") % e)
+            return
+        except PhabricatorBackfillError as e:
+            os.remove(filename)
+            irc.error(_("Could not query the stories of the report: %s") % e)
+            return
+
+        if written:
+            irc.reply(_("Report written to %s") % filename)
+        else:
+            os.remove(filename)
+            irc.error(_("Could not query the team members of the project"))
 
     def do315(self, irc, msg):
 
         print("do315 in ", msg.args[1])
         print("current channels:", irc.state.channels.items())
 
-        self.syncedChannels.append(msg.args[1])
+        syncedChannels = self.syncedChannels.setdefault(irc.network, [])
+        syncedChannels.append(msg.args[1])
 
         # Don't send messages before all channels were synced
         for (channel, _) in irc.state.channels.items():
-            if channel not in self.syncedChannels:
+            if channel not in syncedChannels:
                 return
 
         print("all channels synced", msg.args[1])
 
         # Notify about recent phabricator stories
-        if self.thread:
-            print("thread still already running")
+        for instance in self.instances:
+            instance.subscribers.subscribe(irc, instance.channels)
+
+        # One scheduler polls the feeds for all networks
+        if self.started:
+            print("scheduler already running")
             return
 
-        self.thread = threading.Thread(target=self.storyPrinter.printStoriesForever, args=(irc,), daemon=True)
-        self.thread.start()
+        self.started = True
+        self.scheduler.start(self.instances, self.registryValue("sleepTime"))
 
     def doPart(self, irc, msg):
-        if msg.nick != conf.supybot.nick:
+        if not ircutils.strEqual(msg.nick, irc.nick):
             return
 
+        syncedChannels = self.syncedChannels.get(irc.network, [])
         for channel in msg.args[0].split(','):
-            if channel in self.syncedChannels:
+            if channel in syncedChannels:
                 print("parting from ", channel)
-                self.syncedChannels.remove(channel)
+                syncedChannels.remove(channel)
+
+        # Stop posting stories to a network without channels
+        if not syncedChannels:
+            for instance in self.instances:
+                instance.subscribers.unsubscribe(irc)
 
 class PhabricatorReplyPrinter:
 
-    def __init__(self, txt, conduitAPI, formatting):
+    # Finds differential and paste IDs (D123, P45) in one pass
+    referencePattern = re.compile(r"\b([DP])(\d+)\b")
+
+    # A leading word boundary prevents the regex engine from skipping ahead to the
+    # candidate characters, so lines without any candidate are rejected by this one first
+    candidatePattern = re.compile(r"[DP]\d")
+
+    def __init__(self, txt, conduitAPI, formatting, asyncConduitAPI=None, references=None, replyCache=None, channel=None):
         self.txt = txt
         self.conduitAPI = conduitAPI
         self.formatting = formatting
+        self.replyCache = replyCache
+        self.channel = channel
+        self.ownsAsyncConduitAPI = asyncConduitAPI is None
+        self.asyncConduitAPI = asyncConduitAPI or AsyncConduitAPI(conduitAPI)
+        self.references = references if references is not None else self.scanReferences(txt)
+
+        # IDs of the objects that getReplies returned a reply for
+        self.repliedIDs = []
+
+    # Stops the threads of the AsyncConduitAPI if the printer created it
+    def close(self):
+        if self.ownsAsyncConduitAPI:
+            self.asyncConduitAPI.close()
+
+    # Returns the IDs mentioned in the text, ordered and without duplicates, grouped by object type.
+    # Returns None without allocating anything if there are none.
+    @classmethod
+    def scanReferences(cls, txt):
+
+        match = cls.candidatePattern.search(txt)
+        if match is None:
+            return None
 
-    def getReplies(self):
-        return \
-            self.__differentialReplies() + \
-            self.__pasteReplies()
+        references = {
+            "D": OrderedDict(),
+            "P": OrderedDict()
+        }
 
-    # Display the title and URL of all differential IDs appearing in the text (D123)
-    def __differentialReplies(self):
+        for objType, objID in cls.referencePattern.findall(txt):
+            references[objType][objID] = True
 
-        matches = re.findall(r"\b(D\d+)\b", self.txt)
-        revisions = list(map(lambda d: d[1:], matches))
-        revisions = OrderedDict.fromkeys(revisions, True)
+        if not references["D"] and not references["P"]:
+            return None
 
-        if revisions is None or len(revisions) == 0 or list(revisions)[0] == "":
-            #print("Fix differnetial revision regex for", self.txt)
-            return []
+        return references
 
-        results = self.conduitAPI.queryDifferentials(revisions)
-        if results is None:
+    # Looks up differentials and pastes concurrently,
+    # unless they were announced in this channel recently or are cached
+    def getReplies(self):
+
+        if self.references is None:
             return []
 
+        objIDs = [objType + objID for objType in ("D", "P") for objID in self.references[objType]]
+
+        if self.replyCache and self.channel:
+            objIDs = [objID for objID in objIDs if not self.replyCache.isCoolingDown(self.channel, objID)]
+
+        replies = {}
+        missingIDs = {"D": [], "P": []}
+        for objID in objIDs:
+            found, string = self.replyCache.lookup(objID) if self.replyCache else (False, None)
+            if found:
+                replies[objID] = string
+            else:
+                missingIDs[objID[0]].append(objID[1:])
+
+        differentialReplies, pasteReplies = self.asyncConduitAPI.gather(
+            self.__differentialReplies(missingIDs["D"]),
+            self.__pasteReplies(missingIDs["P"]))
+
+        replies.update(differentialReplies)
+        replies.update(pasteReplies)
+
         strings = []
+        self.repliedIDs = []
+        for objID in objIDs:
+            string = replies.get(objID)
+            if string is None:
+                continue
+
+            strings.append(string)
+            self.repliedIDs.append(objID)
+
+        return strings
+
+    # Starts the cooldown of the objects of the last replies, called once they were actually sent
+    def announceReplies(self):
+        if self.replyCache and self.channel:
+            for objID in self.repliedIDs:
+                self.replyCache.announce(self.channel, objID)
+
+    # Remembers the replies, including that some IDs don't exist
+    def __storeReplies(self, objType, IDs, replies, objectPHIDs):
+
+        if not self.replyCache:
+            return
+
+        for ID in IDs:
+            self.replyCache.store(objType + ID, replies.get(objType + ID), objectPHIDs.get(objType + ID))
+
+    # Display the title and URL of all differential IDs appearing in the text (D123)
+    async def __differentialReplies(self, revisions):
+
+        if len(revisions) == 0:
+            return {}
+
+        results = await self.asyncConduitAPI.queryDifferentials(revisions)
+        if results is None:
+            return {}
+
+        replies = {}
+        objectPHIDs = {}
         for result in results:
 
+            objectPHIDs["D" + result["id"]] = result["phid"]
             replyStringConstructor = PhabricatorReplyStringConstructor(
                 objID="D" + result["id"],
                 objLink=result["uri"],
@@ -152,26 +580,22 @@ class PhabricatorReplyPrinter:
                 formatting=self.formatting
             )
 
-            strings.append(replyStringConstructor.constructDifferentialReplyString(
+            replies["D" + result["id"]] = replyStringConstructor.constructDifferentialReplyString(
                 statusName=result["statusName"]
-            ))
-
-        return strings
+            )
 
-    # Display the title and URL of all differential IDs appearing in the text (D123)
-    def __pasteReplies(self):
+        self.__storeReplies("D", revisions, replies, objectPHIDs)
+        return replies
 
-        pasteIDs = re.findall(r"\b(P\d+)\b", self.txt)
-        pasteIDs = list(map(lambda d: d[1:], pasteIDs))
-        pasteIDs = OrderedDict.fromkeys(pasteIDs, True)
+    # Display the title, author and URL of all paste IDs appearing in the text (P123)
+    async def __pasteReplies(self, pasteIDs):
 
-        if pasteIDs is None or len(pasteIDs) == 0 or list(pasteIDs)[0] == "":
-            #print("Fix paste regex for", self.txt)
-            return []
+        if len(pasteIDs) == 0:
+            return {}
 
-        results = self.conduitAPI.queryPastesByID(pasteIDs)
+        results = await self.asyncConduitAPI.queryPastesByID(pasteIDs)
         if results is None:
-            return []
+            return {}
 
         authorPHIDs = []
         for pastePHID in results:
@@ -179,287 +603,2191 @@ class PhabricatorReplyPrinter:
             if authorPHID not in authorPHIDs:
                 authorPHIDs.append(authorPHID)
 
-        authorNames = self.conduitAPI.queryAuthorNames(authorPHIDs)
+        authorNames = await self.asyncConduitAPI.queryAuthorNames(authorPHIDs)
         if authorNames is None:
-            return []
+            return {}
 
-        strings = []
-        for pasteID in pasteIDs:
-            for pastePHID in results:
+        replies = {}
+        objectPHIDs = {}
+        for pastePHID in results:
 
-                result = results[pastePHID]
+            result = results[pastePHID]
+            objectPHIDs["P" + result["id"]] = pastePHID
 
-                if result["id"] == pasteID:
-                    replyStringConstructor = PhabricatorReplyStringConstructor(
-                        objID="P" + result["id"],
-                        objTitle=result["title"],
-                        objLink=result["uri"],
-                        formatting=self.formatting
-                    )
+            replyStringConstructor = PhabricatorReplyStringConstructor(
+                objID="P" + result["id"],
+                objTitle=result["title"],
+                objLink=result["uri"],
+                formatting=self.formatting
+            )
 
-                    strings.append(replyStringConstructor.constructPasteReplyString(
-                        authorName=authorNames[result["authorPHID"]]
-                    ))
+            replies["P" + result["id"]] = replyStringConstructor.constructPasteReplyString(
+                authorName=authorNames[result["authorPHID"]]
+            )
 
-        return strings
+        self.__storeReplies("P", pasteIDs, replies, objectPHIDs)
+        return replies
 
-# Constructs human-readable strings and optionally posts them to IRC.
-# Allows testing of the querying and printing without actually connecting to IRC.
-class PhabricatorStoryPrinter:
+# Remembers the replies to recently mentioned objects and which IDs don't exist,
+# and which objects were announced in which channel recently.
+class PhabricatorReplyCache:
 
-    def __init__(self,
-                 conduitAPI,
-                 formatting,
-                 channels,
-                 storyLimit,
-                 historyForwards,
-                 timestampBefore,
-                 timestampAfter,
-                 sleepTime,
-                 newsPrefix,
-                 printDate,
-                 ignoredUsers,
-                 filteredUsers,
-                 notifyCommit,
-                 notifyRetitle,
-                 chronokeyFile,
-                 chronokey,
-                 verbose
-                ):
+    def __init__(self, ttl, negativeTTL, cooldown, maxSize=1000):
+        self.ttl = ttl
+        self.negativeTTL = negativeTTL
+        self.cooldown = cooldown
+        self.maxSize = maxSize
 
-        self.conduitAPI = conduitAPI
-        self.channels = channels
-        self.formatting = formatting
+        self.lock = threading.Lock()
+        self.replies = OrderedDict()
+        self.objIDs = {}
+        self.announcements = OrderedDict()
 
-        self.storyLimit = storyLimit
-        self.historyForwards = historyForwards
-        self.timestampBefore = timestampBefore
-        self.timestampAfter = timestampAfter
-        self.sleepTime = sleepTime
-        self.newsPrefix = newsPrefix
-        self.printDate = printDate
-        self.ignoredUsers = ignoredUsers
-        self.filteredUsers = filteredUsers
-        self.notifyCommit = notifyCommit
-        self.notifyRetitle = notifyRetitle
-        self.chronokeyFile = chronokeyFile
-        self.chronokey = chronokey
+    # Returns whether the object is cached and its reply, which is None if the object doesn't exist
+    def lookup(self, objID):
+
+        with self.lock:
+            entry = self.replies.get(objID)
+            if entry is None:
+                return False, None
+
+            expiry, string, _ = entry
+            if expiry <= time.monotonic():
+                self.__remove(objID)
+                return False, None
+
+            return True, string
+
+    # The PHID allows to invalidate the reply when the object shows up in the feed
+    def store(self, objID, string, objectPHID=None):
+
+        ttl = self.ttl if string is not None else self.negativeTTL
+        if ttl == 0:
+            return
+
+        with self.lock:
+            self.__remove(objID)
+            self.replies[objID] = (time.monotonic() + ttl, string, objectPHID)
+            if objectPHID is not None:
+                self.objIDs[objectPHID] = objID
+
+            while len(self.replies) > self.maxSize:
+                self.__remove(next(iter(self.replies)))
+
+    # Forget objects that were modified
+    def invalidatePHIDs(self, objectPHIDs):
+        with self.lock:
+            for objectPHID in objectPHIDs:
+                objID = self.objIDs.get(objectPHID)
+                if objID is not None:
+                    self.__remove(objID)
+
+    def __remove(self, objID):
+        entry = self.replies.pop(objID, None)
+        if entry is not None and entry[2] is not None:
+            self.objIDs.pop(entry[2], None)
+
+    def isCoolingDown(self, channel, objID):
+        with self.lock:
+            announced = self.announcements.get((channel, objID))
+            return announced is not None and time.monotonic() - announced < self.cooldown
+
+    def announce(self, channel, objID):
+
+        if self.cooldown == 0:
+            return
+
+        with self.lock:
+            now = time.monotonic()
+            self.announcements[(channel, objID)] = now
+            self.announcements.move_to_end((channel, objID))
+
+            # Announcements are ordered by time, so the expired ones come first
+            while self.announcements:
+                oldest = next(iter(self.announcements.values()))
+                if now - oldest < self.cooldown and len(self.announcements) <= self.maxSize:
+                    break
+                self.announcements.popitem(last=False)
+
+secondsPerDay = 86400
+
+# Phabricator chronological keys carry the epoch of the story in their upper 32 bits
+def chronokeyToEpoch(chronokey):
+    return chronokey >> 32
+
+# Returns the smallest chronological key of the given second
+def epochToChronokey(epoch):
+    return int(epoch) << 32
+
+# Runs the lookups of chat replies on a few worker threads.
+# If too many lookups are waiting, either the oldest or the newest one is dropped,
+# and replies that would arrive after the deadline are not sent anymore.
+class PhabricatorReplyWorkers:
+
+    def __init__(self, workers, queueLimit, shedPolicy, deadline, verbose):
+        self.queueLimit = queueLimit
+        self.shedPolicy = shedPolicy
+        self.deadline = deadline
         self.verbose = verbose
 
-        self.chronokeyEpoch = None
+        self.condition = threading.Condition()
+        self.queue = deque()
+        self.stopped = False
 
-    # Repeatedly query and print new stories on phabricator
-    def printStoriesForever(self, irc):
+        self.threads = [threading.Thread(target=self.__work, daemon=True) for _ in range(workers)]
+        for thread in self.threads:
+            thread.start()
 
-        self.chronokey = self.__loadChronokey()
+    # Schedules lookup() and passes its result to deliver(), unless it arrives too late.
+    # Returns False if the request was dropped immediately.
+    def submit(self, lookup, deliver):
+
+        with self.condition:
+            if len(self.queue) >= self.queueLimit:
+                if self.shedPolicy == "newest":
+                    print("Reply queue full, dropping new request")
+                    return False
+
+                print("Reply queue full, dropping oldest request")
+                self.queue.popleft()
+
+            self.queue.append((time.monotonic() + self.deadline, lookup, deliver))
+            self.condition.notify()
+
+        return True
+
+    def stop(self):
+        with self.condition:
+            self.stopped = True
+            self.queue.clear()
+            self.condition.notify_all()
+
+    def __work(self):
 
         while True:
+            with self.condition:
+                while not self.queue and not self.stopped:
+                    self.condition.wait()
+
+                if self.stopped:
+                    return
+
+                deadline, lookup, deliver = self.queue.popleft()
+
+            if time.monotonic() > deadline:
+                print("Dropping reply request that waited past its deadline")
+                continue
+
             try:
-                if self.printSomeStories(irc):
+                results = lookup()
+            except Exception as e:
+                print("Reply lookup failed:", e)
+                continue
+
+            if time.monotonic() > deadline:
+                print("Dropping reply that arrived past its deadline")
+                continue
+
+            deliver(results)
+
+# Passes the stories of the one feed poller to every subscribed IRC network,
+# so that the number of Conduit queries doesn't grow with the number of networks
+class PhabricatorStorySubscribers:
+
+    def __init__(self, outbound):
+        self.outbound = outbound
+        self.lock = threading.Lock()
+
+        # Maps network name to the Irc object and the channels to post to, all joined channels if empty
+        self.subscribers = {}
+
+    def subscribe(self, irc, channels):
+        with self.lock:
+            self.subscribers[irc.network] = (irc, channels)
+
+    def unsubscribe(self, irc):
+        with self.lock:
+            self.subscribers.pop(irc.network, None)
+
+    def publish(self, strings):
+        for irc, channels in self.__current():
+            targets = [channel for (channel, _) in irc.state.channels.items() if not channels or channel in channels]
+            for string in strings:
+                self.outbound.sendNews(irc, targets, string)
+
+    def waitForCapacity(self):
+        for irc, _ in self.__current():
+            self.outbound.waitForCapacity(irc)
+
+    def __current(self):
+        with self.lock:
+            # Forget networks the bot gave up on
+            for network, (irc, _) in list(self.subscribers.items()):
+                if getattr(irc, "zombie", False):
+                    print("Unsubscribing", network, "from stories")
+                    del self.subscribers[network]
+
+            return list(self.subscribers.values())
+
+# The messages waiting to be sent to one IRC network and the token bucket pacing them
+class PhabricatorOutboundNetwork:
+
+    def __init__(self, burst):
+        self.queues = (deque(), deque())
+        self.tokens = burst
+        self.lastRefill = time.monotonic()
+
+    # Returns the queue of the message to be sent next or None
+    def nextQueue(self):
+        return next((queue for queue in self.queues if queue), None)
+
+# Paces the messages sent to IRC with a token bucket per network, so that a backlog of stories doesn't flood the server.
+# Messages are only handed to the bot when its own send queue for that network is empty, so that replies to chat messages
+# waiting here are always sent before the news that were queued earlier. A busy network doesn't hold back the others.
+# A story for several channels is sent as one PRIVMSG with comma-separated targets if the server allows it.
+class PhabricatorOutboundScheduler:
+
+    replyPriority = 0
+    newsPriority = 1
+
+    # Longest IRC line including the line break
+    maxLineLength = 512
+
+    # Seconds between two checks whether the send queue of the bot emptied
+    busyPollInterval = 0.1
+
+    def __init__(self, rate, burst, highWaterMark, verbose):
+        self.rate = rate
+        self.burst = burst
+        self.highWaterMark = highWaterMark
+        self.verbose = verbose
+
+        self.condition = threading.Condition()
+
+        # Maps network name to PhabricatorOutboundNetwork
+        self.networks = {}
+        self.stopped = False
+
+        self.thread = threading.Thread(target=self.__work, daemon=True)
+        self.thread.start()
+
+    def sendReply(self, irc, channel, string):
+        self.__enqueue(self.replyPriority, irc, ircmsgs.privmsg(channel, string))
+
+    def sendNews(self, irc, channels, string):
+        for targets in self.__groupTargets(irc, channels, string):
+            self.__enqueue(self.newsPriority, irc, ircmsgs.privmsg(",".join(targets), string))
+
+    # Blocks while too many messages wait to be sent to the network,
+    # so that the feed doesn't pull more stories than can be sent soon
+    def waitForCapacity(self, irc):
+        with self.condition:
+            while not self.stopped and self.__depth(irc) >= self.highWaterMark:
+                if self.verbose:
+                    print("Outbound queue of", irc.network, "above", self.highWaterMark, "messages, pausing the feed")
+                self.condition.wait(1)
+
+    def stop(self):
+        with self.condition:
+            self.stopped = True
+            for network in self.networks.values():
+                for queue in network.queues:
+                    queue.clear()
+            self.condition.notify_all()
+
+    def __enqueue(self, priority, irc, msg):
+        with self.condition:
+            network = self.networks.get(irc.network)
+            if network is None:
+                network = self.networks[irc.network] = PhabricatorOutboundNetwork(self.burst)
+            network.queues[priority].append((irc, msg))
+            self.condition.notify_all()
+
+    # Number of news waiting here and messages waiting in the send queue of the bot for the network of the given Irc object
+    def __depth(self, irc):
+        network = self.networks.get(irc.network)
+        news = len(network.queues[self.newsPriority]) if network else 0
+        return news + len(getattr(irc, "queue", ()))
+
+    # Splits the channels into groups that fit into one PRIVMSG
+    def __groupTargets(self, irc, channels, string):
+
+        maxTargets = self.__maxTargets(irc)
+        # "PRIVMSG " + targets + " :" + string + "\r\n"
+        maxTargetsLength = self.maxLineLength - len("PRIVMSG  :\r\n") - len(string.encode())
+
+        groups = []
+        for channel in channels:
+            if groups and (maxTargets is None or len(groups[-1]) < maxTargets) and \
+                    len(",".join(groups[-1] + [channel]).encode()) <= maxTargetsLength:
+                groups[-1].append(channel)
+            else:
+                groups.append([channel])
+
+        return groups
+
+    # Returns the number of targets of a PRIVMSG announced by the server in the TARGMAX or MAXTARGETS tokens, None if unlimited
+    def __maxTargets(self, irc):
+
+        supported = irc.state.supported
+
+        targmax = supported.get("targmax")
+        if targmax:
+            for limit in targmax.split(","):
+                command, _, value = limit.partition(":")
+                if command.upper() == "PRIVMSG":
+                    return int(value) if value else None
+            return 1
+
+        return supported.get("maxtargets") or 1
+
+    # Returns 0 if a message may be sent to the network now, otherwise the seconds until it may
+    def __takeToken(self, network):
+
+        now = time.monotonic()
+        network.tokens = min(self.burst, network.tokens + (now - network.lastRefill) * self.rate)
+        network.lastRefill = now
+
+        if network.tokens < 1:
+            return (1 - network.tokens) / self.rate
+
+        network.tokens -= 1
+        return 0
+
+    # Sends the next message of every network that is neither busy nor out of tokens
+    def __work(self):
+
+        while True:
+            sending = []
+            with self.condition:
+                if self.stopped:
                     return
 
-            except KeyboardInterrupt:
-                return
-            except:
-                raise
+                # Seconds until the next network may send, None if nothing is waiting
+                timeout = None
+
+                for network in self.networks.values():
+                    queue = network.nextQueue()
+                    if queue is None:
+                        continue
+
+                    irc, msg = queue[0]
+                    delay = self.busyPollInterval if len(getattr(irc, "queue", ())) > 0 else self.__takeToken(network)
+                    if delay > 0:
+                        timeout = delay if timeout is None else min(timeout, delay)
+                        continue
+
+                    queue.popleft()
+                    sending.append((irc, msg))
+
+                if not sending:
+                    self.condition.wait(timeout)
+                    continue
+
+                self.condition.notify_all()
+
+            for irc, msg in sending:
+                irc.queueMsg(msg)
+
+# Decides how long to wait before querying the next page of the feed.
+# A full page means more stories are waiting, so the next one is queried right away.
+# While the feed is quiet, the delay grows exponentially up to maxSleepTime,
+# and drops back to sleepTime as soon as a new story appears.
+class PhabricatorPollScheduler:
+
+    def __init__(self, sleepTime, maxSleepTime, backoffFactor):
+        self.sleepTime = sleepTime
+        self.maxSleepTime = max(sleepTime, maxSleepTime)
+        self.backoffFactor = backoffFactor
+        self.idleSleepTime = sleepTime
+
+    def nextDelay(self, pageSize, storyLimit):
+
+        if pageSize > 0:
+            self.idleSleepTime = self.sleepTime
+            return 0 if pageSize >= storyLimit else self.sleepTime
+
+        delay = self.idleSleepTime
+        self.idleSleepTime = min(max(self.idleSleepTime * self.backoffFactor, self.sleepTime), self.maxSleepTime)
+        return delay
+
+# A followed Phabricator installation and the networks its stories are posted to
+class PhabricatorInstance:
+
+    def __init__(self, name, conduitAPI, asyncConduitAPI, storyPrinter, subscribers, channels):
+        self.name = name
+        self.conduitAPI = conduitAPI
+        self.asyncConduitAPI = asyncConduitAPI
+        self.storyPrinter = storyPrinter
+        self.subscribers = subscribers
+        self.channels = channels
+
+    # Returns the seconds until the next poll or None if there is nothing left to poll
+    def poll(self):
+        return self.storyPrinter.pollStories(self.subscribers)
+
+    def close(self):
+        self.storyPrinter.close()
+        self.asyncConduitAPI.close()
+        self.conduitAPI.close()
+
+# Polls the feeds of all instances from one thread, running the queries on a few shared worker threads.
+# The first polls are spread over the given time, so that the instances don't query at the same moment,
+# and every instance is polled again after the delay its story printer asks for.
+class PhabricatorInstanceScheduler:
+
+    def __init__(self, workers, verbose):
+        self.verbose = verbose
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=workers)
+
+        self.condition = threading.Condition()
+
+        # Heap of due time, insertion order and instance; entries whose due time changed since are skipped
+        self.queue = []
+        self.dueTimes = {}
+        self.order = itertools.count()
+
+        # Instances being polled and the ones to poll again right after that
+        self.polling = set()
+        self.woken = set()
+
+        self.stopped = False
+        self.thread = threading.Thread(target=self.__run, daemon=True)
+
+    def start(self, instances, spread):
+
+        now = time.monotonic()
+        with self.condition:
+            for i, instance in enumerate(instances):
+                self.__schedule(instance, now + spread * i / len(instances))
+
+        self.thread.start()
+
+    # Polls the instance as soon as possible
+    def wake(self, instance):
+        with self.condition:
+            if instance in self.polling:
+                self.woken.add(instance)
+            elif instance in self.dueTimes:
+                self.__schedule(instance, time.monotonic())
+
+    def stop(self):
+        with self.condition:
+            self.stopped = True
+            self.condition.notify_all()
+        self.executor.shutdown(wait=False)
+
+    def __schedule(self, instance, dueTime):
+        self.dueTimes[instance] = dueTime
+        heapq.heappush(self.queue, (dueTime, next(self.order), instance))
+        self.condition.notify_all()
+
+    def __run(self):
+
+        with self.condition:
+            while not self.stopped:
+
+                if not self.queue:
+                    self.condition.wait()
+                    continue
+
+                dueTime, _, instance = self.queue[0]
+                if self.dueTimes.get(instance) != dueTime:
+                    heapq.heappop(self.queue)
+                    continue
+
+                delay = dueTime - time.monotonic()
+                if delay > 0:
+                    self.condition.wait(delay)
+                    continue
+
+                heapq.heappop(self.queue)
+                del self.dueTimes[instance]
+                self.polling.add(instance)
+                self.executor.submit(self.__poll, instance)
+
+    def __poll(self, instance):
+
+        try:
+            delay = instance.poll()
+        except Exception as e:
+            print("Polling", instance.name or "Phabricator", "failed:", e)
+            delay = instance.storyPrinter.sleepTime
+
+        with self.condition:
+            self.polling.discard(instance)
+
+            if self.stopped or delay is None:
+                return
+
+            if instance in self.woken:
+                self.woken.discard(instance)
+                delay = 0
+
+            if self.verbose:
+                print("Polling", instance.name or "Phabricator", "again in", delay, "seconds")
+
+            self.__schedule(instance, time.monotonic() + delay)
+
+# Returns the signature Phabricator sends along with webhook requests
+def webhookSignature(secret, body):
+    return hmac.new(secret.encode(), body, hashlib.sha256).hexdigest()
+
+# Accepts the webhook requests that Phabricator (for example a Herald webhook) sends when something changed.
+# Requests are only accepted with a valid signature made with the shared secret.
+# The path of the request is passed on, so that one listener can serve several instances.
+# The payload merely triggers querying the feed right away; the stories are still pulled from the saved chronokey,
+# so stories announced while the listener was unreachable are caught up with by the next query.
+class PhabricatorWebhookListener:
+
+    signatureHeader = "X-Phabricator-Webhook-Signature"
+
+    # Largest accepted request body in bytes
+    maxBodySize = 1 << 20
+
+    def __init__(self, host, port, secret, onPush, verbose):
+        self.secret = secret
+        self.onPush = onPush
+        self.verbose = verbose
+
+        listener = self
+
+        class RequestHandler(http.server.BaseHTTPRequestHandler):
+
+            def do_POST(self):
+                listener.handleRequest(self)
+
+            # Don't write every request to stderr
+            def log_message(self, format, *args):
+                pass
+
+        self.server = http.server.ThreadingHTTPServer((host, port), RequestHandler)
+        self.server.daemon_threads = True
+        self.port = self.server.server_address[1]
+
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+
+    def handleRequest(self, request):
+
+        try:
+            length = int(request.headers.get("Content-Length") or 0)
+        except ValueError:
+            length = -1
+
+        if length < 0 or length > self.maxBodySize:
+            self.__respond(request, 413)
+            return
+
+        body = request.rfile.read(length)
+
+        if not hmac.compare_digest(webhookSignature(self.secret, body), request.headers.get(self.signatureHeader, "")):
+            print("Rejecting webhook request with invalid signature from", request.client_address[0])
+            self.__respond(request, 403)
+            return
+
+        if self.verbose:
+            print("Received webhook request", body[:200])
+
+        self.onPush(request.path)
+        self.__respond(request, 200)
+
+    def __respond(self, request, status):
+        request.send_response(status)
+        request.send_header("Content-Length", "0")
+        request.end_headers()
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+# Saves the chronokey to a file without rewriting it for every story.
+# Updates are written at most once per interval and whenever flush() is called, for example after every page.
+# The file is replaced atomically and also lists some previous chronokeys, newest first,
+# so that a damaged checkpoint can be recovered from.
+class PhabricatorChronokeyCheckpoint:
+
+    def __init__(self, filename, saveInterval, fsync, historySize, verbose):
+        self.filename = filename
+        self.saveInterval = saveInterval / 1000
+        self.fsync = fsync
+        self.historySize = historySize
+        self.verbose = verbose
+
+        self.lock = threading.Lock()
+        self.history = []
+        self.pending = None
+        self.lastSave = 0
+
+    # Returns the most recent readable chronokey or None
+    def load(self):
+
+        if not os.path.isfile(self.filename):
+            print(self.filename, "not found, starting at 0")
+            return None
+
+        with open(self.filename, "r") as checkpointFile:
+            lines = checkpointFile.read().split()
+
+        for line in lines:
+            try:
+                chronokey = int(line)
+            except ValueError:
+                print("Skipping damaged chronokey checkpoint", repr(line))
+                continue
+
+            if chronokey not in self.history:
+                self.history.append(chronokey)
+
+        self.history = self.history[:self.historySize]
+
+        return self.history[0] if self.history else None
+
+    def update(self, chronokey):
+        with self.lock:
+            self.pending = chronokey
+            if time.monotonic() - self.lastSave >= self.saveInterval:
+                self.__save()
+
+    def flush(self):
+        with self.lock:
+            if self.pending is not None:
+                self.__save()
+
+    def __save(self):
+
+        if self.verbose:
+            print("Saving chronokey", self.pending)
+
+        self.history = [self.pending] + [chronokey for chronokey in self.history if chronokey != self.pending]
+        self.history = self.history[:self.historySize]
+        self.pending = None
+        self.lastSave = time.monotonic()
+
+        temporaryFilename = self.filename + ".tmp"
+        with open(temporaryFilename, "w") as checkpointFile:
+            checkpointFile.write("".join(str(chronokey) + "\n" for chronokey in self.history))
+            if self.fsync:
+                checkpointFile.flush()
+                os.fsync(checkpointFile.fileno())
+
+        os.replace(temporaryFilename, self.filename)
+
+        # Persist the rename too
+        if self.fsync and hasattr(os, "O_DIRECTORY"):
+            directory = os.open(os.path.dirname(os.path.abspath(self.filename)), os.O_RDONLY | os.O_DIRECTORY)
+            try:
+                os.fsync(directory)
+            finally:
+                os.close(directory)
+
+# Constructs human-readable strings and optionally posts them to IRC.
+# Allows testing of the querying and printing without actually connecting to IRC.
+class PhabricatorStoryPrinter:
+
+    # Author of commits without phabricator account
+    diffusionAuthorPHID = "PHID-APPS-PhabricatorDiffusionApplication"
+
+    # Story texts of actions that change the title of the object
+    titleChangePattern = re.compile(r" (retitled|renamed|updated the title for) ")
+
+    def __init__(self,
+                 conduitAPI,
+                 formatting,
+                 storyLimit,
+                 historyForwards,
+                 timestampBefore,
+                 timestampAfter,
+                 sleepTime,
+                 newsPrefix,
+                 printDate,
+                 ignoredUsers,
+                 filteredUsers,
+                 notifyCommit,
+                 notifyRetitle,
+                 chronokeyFile,
+                 chronokey,
+                 verbose,
+                 asyncConduitAPI=None,
+                 backfillWorkers=1,
+                 replyCache=None,
+                 maxSleepTime=None,
+                 sleepBackoffFactor=2,
+                 prefetchPages=0,
+                 archive=None,
+                 chronokeySaveInterval=1000,
+                 chronokeyFsync=True,
+                 chronokeyHistory=5,
+                 digestWindow=0
+                ):
+
+        self.conduitAPI = conduitAPI
+        self.ownsAsyncConduitAPI = asyncConduitAPI is None
+        self.asyncConduitAPI = asyncConduitAPI or AsyncConduitAPI(conduitAPI)
+        self.formatting = formatting
+
+        self.storyLimit = storyLimit
+        self.historyForwards = historyForwards
+        self.timestampBefore = timestampBefore
+        self.timestampAfter = timestampAfter
+        self.sleepTime = sleepTime
+        self.newsPrefix = newsPrefix
+        self.printDate = printDate
+        self.ignoredUsers = set(ignoredUsers or ())
+        self.filteredUsers = set(filteredUsers or ())
+        self.notifyCommit = notifyCommit
+        self.notifyRetitle = notifyRetitle
+        self.chronokeyFile = chronokeyFile
+        self.checkpoint = PhabricatorChronokeyCheckpoint(chronokeyFile, chronokeySaveInterval, chronokeyFsync, chronokeyHistory, verbose) \
+            if chronokeyFile else None
+        self.chronokey = chronokey
+        self.verbose = verbose
+        self.backfillWorkers = backfillWorkers
+        self.replyCache = replyCache
+        self.prefetchPages = prefetchPages
+        self.digestWindow = digestWindow
+        self.archive = archive
+
+        self.chronokeyEpoch = None
+
+        # Number of stories returned by the last feed query, regardless of the filters, or 0 if the query failed
+        self.lastPageSize = 0
+        self.pollScheduler = PhabricatorPollScheduler(
+            sleepTime,
+            maxSleepTime if maxSleepTime is not None else sleepTime,
+            sleepBackoffFactor)
+
+        # Allows to filter stories by the author PHID before any object is queried
+        self.knownAuthorNames = {}
+        self.loadedFilteredAuthors = False
+
+        # Pages fetched in the background while a full page is printed, see pullSomeStories
+        self.prefetchedPages = queue.Queue()
+        self.prefetching = False
+        self.prefetchExecutor = concurrent.futures.ThreadPoolExecutor(max_workers=1) if prefetchPages > 0 else None
+
+        # Whether pollStories loaded the chronokey already
+        self.resumed = False
+
+    # Repeatedly query and print new stories on phabricator
+    def printStoriesForever(self, subscribers):
+
+        self.chronokey = self.__loadChronokey()
+
+        # A past time window can be fetched in parallel
+        if self.backfillWorkers > 1 and self.timestampAfter != 0 and self.timestampBefore != 0:
+            for stories in self.backfillStories():
+                self.__printStories(subscribers, stories)
+            return
+
+        while True:
+            try:
+                if self.printSomeStories(subscribers):
+                    return
+
+            except KeyboardInterrupt:
+                return
+            except:
+                raise
+
+    def printSomeStories(self, subscribers):
+
+        delay = self.__printSomeStories(subscribers)
+        if delay is None:
+            return True
+
+        time.sleep(delay)
+        return False
+
+    # Prints the next page of stories for callers that decide themselves when to poll, like PhabricatorInstanceScheduler.
+    # Returns the number of seconds until the next page should be queried or None if the time window was printed completely.
+    def pollStories(self, subscribers):
+
+        if not self.resumed:
+            self.resumed = True
+            self.chronokey = self.__loadChronokey()
+
+            if self.backfillWorkers > 1 and self.timestampAfter != 0 and self.timestampBefore != 0:
+                for stories in self.backfillStories():
+                    self.__printStories(subscribers, stories)
+                return None
+
+        return self.__printSomeStories(subscribers)
+
+    def __printSomeStories(self, subscribers):
+
+        stories = self.pullSomeStories()
+        if stories is True:
+            return None
+
+        self.__printStories(subscribers, stories)
+
+        delay = self.pollScheduler.nextDelay(self.lastPageSize, self.storyLimit)
+        if self.verbose:
+            print("Received", self.lastPageSize, "stories, next query in", delay, "seconds")
+
+        return delay
+
+    # Stops the threads of the AsyncConduitAPI if the printer created it and the prefetching thread
+    def close(self):
+        if self.ownsAsyncConduitAPI:
+            self.asyncConduitAPI.close()
+        if self.prefetchExecutor:
+            self.prefetchExecutor.shutdown(wait=False)
+
+    def __printStories(self, subscribers, stories):
+
+        strings = [string for string, _, _, _, _ in stories]
+        for string in strings:
+            print(string)
+
+        if subscribers:
+            subscribers.publish(strings)
+
+            # Don't pull the next page while the previous stories wait to be sent
+            subscribers.waitForCapacity()
+
+    # Pulls some stories on phabricator that are more recent or older than the current chronokey.
+    # Fetches the refered authors and differentials.
+    # Returns a list of human-readable strings to be posted in irc and the updated chronokey or
+    # Returns True if all stories in that timeframe have been processed already.
+    def pullSomeStories(self):
+
+        self.chronokey = self.__seekTimeWindow(self.chronokey)
+
+        page = self.__takePrefetchedPage(self.chronokey)
+        if page is None:
+            page = self.__fetchPage(self.chronokey)
+
+        if page is True:
+            return True
+
+        # A page that could not be resolved is queried again, after the delay of an empty poll
+        stories, resolved = page
+        self.lastPageSize = len(stories) if resolved is not None else 0
+
+        # More stories are waiting, fetch them while the stories of this page are sent to IRC
+        if self.prefetchExecutor and not self.prefetching and self.lastPageSize >= self.storyLimit:
+            self.prefetching = True
+            self.prefetchExecutor.submit(self.__prefetchPages, self.__lastChronokey(self.chronokey, stories))
+
+        return self.__renderPage(page)
+
+    # Runs in the background and fetches up to prefetchPages pages following the given chronokey,
+    # until a page is not full. Passes each page (or the exception that stopped it) to the polling thread,
+    # together with the chronokey it follows and whether it is the last one.
+    # The chronokey is only updated and saved when the stories are printed, as without prefetching.
+    def __prefetchPages(self, chronokey):
+
+        try:
+            for i in range(self.prefetchPages):
+                page = self.__fetchPage(chronokey)
+
+                last = page is True or page[1] is None or len(page[0]) < self.storyLimit or i == self.prefetchPages - 1
+                self.prefetchedPages.put((chronokey, page, last))
+
+                if last:
+                    return
+
+                chronokey = self.__lastChronokey(chronokey, page[0])
+
+                if self.verbose:
+                    print("Prefetched", len(page[0]), "stories")
+
+        except Exception as e:
+            self.prefetchedPages.put((chronokey, e, True))
+
+    # Returns the prefetched page following the given chronokey or None if it wasn't prefetched
+    def __takePrefetchedPage(self, chronokey):
+
+        while self.prefetching:
+            fetchedChronokey, page, last = self.prefetchedPages.get()
+            if last:
+                self.prefetching = False
+
+            if isinstance(page, Exception):
+                raise page
+
+            if fetchedChronokey == chronokey:
+                return page
+
+        return None
+
+    # Queries the stories following the given chronokey and resolves their authors and objects.
+    # Returns the stories and the resolved data, which is None if a query failed, or
+    # Returns True if all stories in that timeframe have been processed already.
+    def __fetchPage(self, chronokey):
+
+        # Recognize a finished time window without querying the feed again
+        if chronokey is not None:
+            chronokeyEpoch = chronokeyToEpoch(chronokey)
+            if self.historyForwards and self.timestampBefore != 0 and chronokeyEpoch > self.timestampBefore or \
+               not self.historyForwards and self.timestampAfter != 0 and chronokeyEpoch < self.timestampAfter:
+                if self.verbose:
+                    print("Finished, chronokey is ", chronokey)
+                return True
+
+        stories, _, _ = self.conduitAPI.queryFeed(chronokey, self.storyLimit, self.historyForwards)
+        if stories is None:
+            return [], None
+
+        resolved = self.__resolveStories(stories)
+        if resolved is None:
+            return stories, None
+
+        if self.archive:
+            self.__archiveStories(stories, resolved)
+            self.archive.extendCoverage(*self.__pageCoverage(chronokey, stories))
+
+        if not self.historyForwards and len(stories) == 0:
+            if self.verbose:
+                print("No more stories found")
+            return True
+
+        # No story of the past time window can appear anymore
+        if self.historyForwards and len(stories) == 0 and self.timestampBefore != 0 and self.timestampBefore < time.time():
+            if self.verbose:
+                print("No more stories found before", self.timestampBefore)
+            return True
+
+        return stories, resolved
+
+    # Returns the chronokey the next page is queried from, once the given stories were processed
+    def __lastChronokey(self, chronokey, stories):
+
+        chronokeys = [story[1] for story in stories]
+        if chronokey is not None:
+            chronokeys.append(chronokey)
+
+        if len(chronokeys) == 0:
+            return None
+
+        return max(chronokeys) if self.historyForwards else min(chronokeys)
+
+    # Returns the human-readable strings of a fetched page
+    def __renderPage(self, page):
+
+        stories, resolved = page
+        if resolved is None:
+            return []
+
+        # We can't do anything with the transaction PHIDs! Not even getting the sub-URL of the modified object
+        # https://secure.phabricator.com/T5873
+        # transactions = queryObjects(allTransactionPHIDs)
+
+        authorNames, objects, commitAuthors = resolved
+        return self.__renderStories(stories, authorNames, objects, commitAuthors)
+
+    # Fetches all stories of the time window using several concurrent workers.
+    # Yields the same lists as pullSomeStories, in the order of traversal.
+    def backfillStories(self):
+
+        firstChronokey, lastChronokey = self.__timeWindowChronokeys()
+
+        if not self.archive:
+            yield from self.__backfillStories(firstChronokey, lastChronokey)
+            return
+
+        # Only the parts of the time window that are missing in the archive are queried
+        for archived, start, end in self.__archiveRanges(firstChronokey, lastChronokey):
+            if archived:
+                yield from self.__archivedStories(start, end)
+            else:
+                yield from self.__backfillStories(start, end)
+
+    # Yields the rendered stories of the most significant action of every author on every object of the time window,
+    # as determined by the daily aggregates of the archive. Only the stories missing in the archive are queried.
+    def aggregatedStories(self):
+
+        firstChronokey, lastChronokey = self.__timeWindowChronokeys()
+
+        for archived, start, end in self.__archiveRanges(firstChronokey, lastChronokey):
+            if not archived:
+                for _ in self.__backfillStories(start, end):
+                    pass
+
+        rows = self.archive.mostSignificantStories(firstChronokey, lastChronokey)
+
+        for i in range(0, len(rows), self.storyLimit):
+            yield self.__renderArchivedStories(rows[i:i + self.storyLimit])
+
+    # Returns the chronokeys surrounding the time window (exclusive)
+    def __timeWindowChronokeys(self):
+
+        timestampBefore = self.timestampBefore if self.timestampBefore != 0 else time.time()
+        firstChronokey = epochToChronokey(self.timestampAfter) - 1
+        lastChronokey = epochToChronokey(timestampBefore + 1)
+
+        # Resume from the saved chronokey
+        if self.chronokey is not None:
+            if self.historyForwards:
+                firstChronokey = max(firstChronokey, self.chronokey)
+            else:
+                lastChronokey = min(lastChronokey, self.chronokey)
+
+        return firstChronokey, lastChronokey
+
+    # Queries the stories with a chronokey between the given ones (exclusive)
+    def __backfillStories(self, firstChronokey, lastChronokey):
+
+        backfill = PhabricatorFeedBackfill(self.conduitAPI, self.storyLimit, self.backfillWorkers, self.verbose)
+
+        page = []
+        for story in backfill.stories(firstChronokey, lastChronokey, self.historyForwards):
+            page.append(story)
+            if len(page) < self.storyLimit:
+                continue
+
+            yield self.__resolveAndRenderStories(page)
+            page = []
+
+        if page:
+            yield self.__resolveAndRenderStories(page)
+
+        # A failed query raises, so no story is missing here
+        if self.archive:
+            self.archive.extendCoverage(firstChronokey + 1, lastChronokey - 1)
+
+    def __resolveAndRenderStories(self, stories):
+
+        resolved = self.__resolveStories(stories)
+        if resolved is None:
+            return []
+
+        if self.archive:
+            self.__archiveStories(stories, resolved)
+
+        authorNames, objects, commitAuthors = resolved
+        return self.__renderStories(stories, authorNames, objects, commitAuthors)
+
+    # Splits the chronokeys between the given ones (exclusive) into the parts that are archived and those that are not,
+    # in the order of traversal. Yields whether the part is archived and its bounds (exclusive).
+    def __archiveRanges(self, firstChronokey, lastChronokey):
+
+        coverage = self.archive.coverage()
+
+        if coverage is None or coverage[1] <= firstChronokey or coverage[0] >= lastChronokey:
+            ranges = [(False, firstChronokey, lastChronokey)]
+        else:
+            archivedFirst = max(firstChronokey, coverage[0] - 1)
+            archivedLast = min(lastChronokey, coverage[1] + 1)
+            ranges = [
+                (False, firstChronokey, archivedFirst + 1),
+                (True, archivedFirst, archivedLast),
+                (False, archivedLast - 1, lastChronokey)
+            ]
+
+        # Drop the empty parts
+        ranges = [(archived, start, end) for archived, start, end in ranges if end - start > 1]
+
+        if not self.historyForwards:
+            ranges.reverse()
+
+        if self.verbose:
+            print("Archive coverage", coverage, "ranges", ranges)
+
+        return ranges
+
+    # Yields the archived stories between the given chronokeys (exclusive), rendered page by page
+    def __archivedStories(self, firstChronokey, lastChronokey):
+
+        page = []
+        for row in self.archive.stories(firstChronokey, lastChronokey, self.historyForwards):
+            page.append(row)
+            if len(page) < self.storyLimit:
+                continue
+
+            yield self.__renderArchivedStories(page)
+            page = []
+
+        if page:
+            yield self.__renderArchivedStories(page)
+
+    def __renderArchivedStories(self, rows):
+
+        stories = []
+        authorNames = {}
+        objects = {}
+        commitAuthors = {}
+
+        for row in rows:
+            story = row[:6]
+            _, _, _, authorPHID, objectPHID, _ = story
+            authorName, objType, objID, objTitle, objLink = row[6:]
+            stories.append(story)
+
+            if authorName is not None:
+                authorNames[authorPHID] = authorName
+                if authorPHID == self.diffusionAuthorPHID:
+                    commitAuthors[objectPHID] = authorName
+
+            if objType is not None:
+                objects[objectPHID] = objType, objID, objTitle, objLink
+
+        return self.__renderStories(stories, authorNames, objects, commitAuthors)
+
+    # Stores the stories with their resolved names, commits with the name of their actual author
+    def __archiveStories(self, stories, resolved):
+
+        authorNames, objects, commitAuthors = resolved
+
+        rows = []
+        for story in stories:
+            _, _, _, authorPHID, objectPHID, _ = story
+
+            authorName = authorNames.get(authorPHID)
+            if authorPHID == self.diffusionAuthorPHID:
+                authorName = commitAuthors.get(objectPHID, authorName)
+
+            rows.append(story + (authorName,) + tuple(objects.get(objectPHID, (None, None, None, None))))
+
+        self.archive.store(rows)
+
+    # Returns the first and last chronokey (inclusive) of the stories that are known to be complete after querying this page
+    def __pageCoverage(self, chronokey, stories):
+
+        chronokeys = [story[1] for story in stories]
+
+        # The most recent stories
+        if chronokey is None:
+            if len(chronokeys) == 0:
+                return None, None
+            return min(chronokeys), max(chronokeys)
+
+        if self.historyForwards:
+            if len(chronokeys) == 0:
+                return None, None
+            return chronokey + 1, max(chronokeys)
+
+        # A partial page going backwards means that there are no older stories
+        if len(chronokeys) < self.storyLimit:
+            return 0, chronokey - 1
+
+        return min(chronokeys), chronokey - 1
+
+    # Returns the names of the authors and the objects referenced by the given stories,
+    # except for the stories that are filtered anyway
+    def __resolveStories(self, stories):
+
+        # Don't print the previous title of renamed objects
+        self.conduitAPI.invalidatePHIDs([story[4] for story in stories if self.titleChangePattern.search(story[5])])
+
+        # Chat replies must not show the previous status or title of updated objects
+        if self.replyCache:
+            self.replyCache.invalidatePHIDs([story[4] for story in stories])
+
+        # The archive keeps the names of all stories
+        if not self.archive:
+            stories = self.__filterUnresolvedStories(stories)
+
+        objectPHIDs = list(OrderedDict.fromkeys(story[4] for story in stories))
+        authorPHIDs = list(OrderedDict.fromkeys(story[3] for story in stories))
+
+        # Commits without phabricator account are authored by Diffusion,
+        # their actual authors are queried in one batch too
+        commitPHIDs = list(OrderedDict.fromkeys(story[4] for story in stories if story[3] == self.diffusionAuthorPHID))
+
+        if self.verbose and len(commitPHIDs):
+            print("Fallback: Querying the authors of", len(commitPHIDs), "commits without phabricator account")
+
+        # Authors, objects and commit authors are independent of each other
+        authorNames, objects, commitAuthors = self.asyncConduitAPI.gather(
+            self.asyncConduitAPI.queryAuthorNames(authorPHIDs),
+            self.asyncConduitAPI.queryObjects(objectPHIDs),
+            self.asyncConduitAPI.queryCommitAuthors(commitPHIDs))
+
+        if authorNames is None or objects is None or commitAuthors is None:
+            return None
+
+        self.knownAuthorNames.update(authorNames)
+
+        if self.verbose:
+            print("PHID cache:", self.conduitAPI.phidCache.stats())
+
+        return authorNames, objects, commitAuthors
+
+    # Constructs the strings of the stories that pass the filters
+    def __renderStories(self, stories, authorNames, objects, commitAuthors):
+
+        # Sort by timestamp
+        storiesSorted = sorted(stories, key=lambda story: story[1], reverse=not self.historyForwards)
+
+        strings = []
+
+        # Maps author name and object ID to the index of the string, the epoch of the first story,
+        # the action phrases and the string constructor of stories that were merged
+        digests = {}
+
+        for story in storiesSorted:
+
+            # Extract the objects referenced by this particular story
+            _, newChronokey, epoch, authorPHID, objectPHID, text = story
+
+            # This story was filtered before its object was queried
+            if objectPHID not in objects or authorPHID not in authorNames:
+                self.__updateChronokey(newChronokey, epoch)
+                continue
+
+            objType, objID, objTitle, objLink = objects[objectPHID]
+            authorName = commitAuthors.get(objectPHID, authorNames[authorPHID]) if authorPHID == self.diffusionAuthorPHID else authorNames[authorPHID]
+
+            # Remember most recently actually printed story (in the specified chronological order)
+            self.__updateChronokey(newChronokey, epoch)
+
+            if self.__filterDate(epoch, True) or self.__filterUser(authorName):
+                continue
+
+            # Create a string from the parsed story data and referenced objects
+            stringConstructor = PhabricatorStoryStringConstructor(
+                objType,
+                objectPHID,
+                objID,
+                objTitle,
+                objLink,
+                authorName,
+                text,
+                self.notifyCommit,
+                self.notifyRetitle,
+                self.formatting,
+                self.verbose
+            )
+            storyString = stringConstructor.constructStoryString()
+
+            try:
+                string, action = storyString
+            except TypeError:
+                print("constructStoryString returned non-iterable", storyString, "from", text)
+                continue
+
+            if string is None:
+                continue
+
+            # Send one line for a burst of actions of the same author on the same object
+            digest = digests.get((authorName, objID))
+            if digest is not None and abs(epoch - digest[1]) <= self.digestWindow and stringConstructor.actionPhrase is not None:
+                index, firstEpoch, phrases, firstConstructor = digest
+                if stringConstructor.actionPhrase not in phrases:
+                    phrases.append(stringConstructor.actionPhrase)
+                string = self.__datePrefix(firstEpoch) + self.newsPrefix + firstConstructor.constructDigestString(phrases)
+                strings[index] = (string, authorName, objID, objType, action)
+                continue
+
+            if self.digestWindow and stringConstructor.actionPhrase is not None:
+                digests[(authorName, objID)] = (len(strings), epoch, [stringConstructor.actionPhrase], stringConstructor)
+
+            string = self.__datePrefix(epoch) + self.newsPrefix + string
+            strings.append((string, authorName, objID, objType, action))
+
+        # Save the state after processing every page, so that we don't lose the state after a crash
+        if self.checkpoint:
+            self.checkpoint.flush()
+
+        return strings
+
+    def __datePrefix(self, epoch):
+        return datetime.datetime.fromtimestamp(epoch).strftime('[%Y-%m-%d %H:%M:%S] ') if self.printDate else ""
+
+    # Start at the boundary of the time window instead of paging through
+    # all stories between now (or the saved chronokey) and the time window
+    def __seekTimeWindow(self, chronokey):
+
+        if self.historyForwards and self.timestampAfter != 0:
+            # The feed returns stories with a greater chronokey than the given one
+            windowChronokey = epochToChronokey(self.timestampAfter) - 1
+            if chronokey is None or chronokey < windowChronokey:
+                if self.verbose:
+                    print("Seeking to chronokey", windowChronokey)
+                chronokey = windowChronokey
+
+        if not self.historyForwards and self.timestampBefore != 0:
+            # The feed returns stories with a smaller chronokey than the given one
+            windowChronokey = epochToChronokey(self.timestampBefore + 1)
+            if chronokey is None or chronokey > windowChronokey:
+                if self.verbose:
+                    print("Seeking to chronokey", windowChronokey)
+                chronokey = windowChronokey
+
+        return chronokey
+
+    # Drops the stories that are too old, too recent or of filtered authors before their objects are queried.
+    # Authors are recognized by their PHID if the name was queried before.
+    def __filterUnresolvedStories(self, stories):
+
+        self.__loadFilteredAuthors()
+
+        return [story for story in stories if not self.__filterDate(story[2], False) and not self.__filterAuthorPHID(story[3])]
+
+    def __filterAuthorPHID(self, authorPHID):
+
+        # The actual author of commits without phabricator account is only known after querying the commit
+        if authorPHID == self.diffusionAuthorPHID:
+            return False
+
+        authorName = self.knownAuthorNames.get(authorPHID)
+        return authorName is not None and self.__filterUser(authorName)
+
+    # Look up the PHIDs of the ignored and filtered users once.
+    # Bots that are not users, like Harbormaster, become known when their first story is resolved.
+    def __loadFilteredAuthors(self):
+
+        if self.loadedFilteredAuthors:
+            return
+
+        userPHIDs = self.conduitAPI.queryUserPHIDs(sorted(self.ignoredUsers | self.filteredUsers))
+        if userPHIDs is None:
+            return
+
+        for userName, userPHID in userPHIDs.items():
+            self.knownAuthorNames[userPHID] = userName
+
+        self.loadedFilteredAuthors = True
+
+    def __filterUser(self, authorName):
+
+        if authorName in self.ignoredUsers:
+            if self.verbose:
+                print("Skipping blocked user", authorName)
+            return True
+
+        if self.filteredUsers and authorName not in self.filteredUsers:
+            if self.verbose:
+                print("Skipping non-filtered user", authorName)
+            return True
+
+        return False
+
+    def __filterDate(self, timestamp, debugPrint):
+
+        if self.timestampAfter != 0 and timestamp < self.timestampAfter:
+            if self.verbose:
+                print("Skipping story that is too old")
+            return True
+
+        if self.timestampBefore != 0 and timestamp > self.timestampBefore:
+            if self.verbose:
+                print("Skipping story that is too recent")
+            return True
+
+        return False
+
+    # Remember the chronological entry of the most recently
+    # processed or printed update on phabricator
+    # Returns None or number
+    def __loadChronokey(self):
+
+        if self.checkpoint is None:
+            return self.chronokey
+
+        chronokey = self.checkpoint.load()
+        if chronokey is None:
+            return self.chronokey
+
+        return chronokey
+
+    def __updateChronokey(self, newChronokey, newEpoch):
+
+        if self.chronokeyEpoch is None:
+            self.chronokeyEpoch = newEpoch
+
+        if self.chronokey is None:
+            if self.verbose:
+                print("Initializing chronokey with", newChronokey)
+            self.chronokey = newChronokey
+            return
+
+        previous = self.chronokey
+        if self.historyForwards:
+            self.chronokey = max(self.chronokey, newChronokey)
+            self.chronokeyEpoch = max(self.chronokeyEpoch, newEpoch)
+        else:
+            self.chronokey = min(self.chronokey, newChronokey)
+            self.chronokeyEpoch  = min(self.chronokeyEpoch, newEpoch)
+
+        if previous == self.chronokey:
+            return
+
+        if self.verbose:
+            print("New chronokey:", self.chronokey)
+
+        if self.checkpoint:
+            self.checkpoint.update(self.chronokey)
+
+# Streams the stories of the given time window into a progress report.
+# The members of the given project are listed first.
+# Returns False if the team members could not be queried.
+# Raises PhabricatorBackfillError if the stories could not be queried.
+def writeProgressReport(conduitAPI, writer, start, end, projectName, ignoredUsers, archive=None, asyncConduitAPI=None, backfillWorkers=4, verbose=False):
+
+    teamMembers = []
+    if projectName:
+        teamMembers = conduitAPI.queryProjectMembers(projectName)
+        if teamMembers is None:
+            return False
+
+    storyPrinter = PhabricatorStoryPrinter(
+        conduitAPI=conduitAPI,
+        asyncConduitAPI=asyncConduitAPI,
+        archive=archive,
+        formatting=PhabricatorStringFormatting(bolding=False, obscureUsernames=False, htmlLinks=writer.htmlLinks),
+        storyLimit=200,
+        historyForwards=True,
+        timestampAfter=start.timestamp(),
+        timestampBefore=end.timestamp(),
+        sleepTime=0,
+        newsPrefix="",
+        printDate=True,
+        ignoredUsers=ignoredUsers,
+        filteredUsers=None,
+        notifyCommit=True,
+        notifyRetitle=False,
+        chronokey=None,
+        chronokeyFile=None,
+        verbose=verbose,
+        backfillWorkers=backfillWorkers
+    )
+
+    report = PhabricatorProgressReport(teamMembers)
+
+    # The report is assembled from the daily aggregates of the archive
+    try:
+        if archive:
+            report.addStories(storyPrinter.aggregatedStories())
+        else:
+            report.addStories(storyPrinter.backfillStories())
+    finally:
+        storyPrinter.close()
+
+    report.write(writer, "Generic Progress Report in the time between " + start.strftime("%c") + " and " + end.strftime("%c"))
+
+    return True
+
+# Raised when a page of a past time window could not be queried, so that no incomplete history is returned
+class PhabricatorBackfillError(Exception):
+    pass
+
+# Fetches the stories between two chronological keys by splitting the range into
+# segments that are paged through concurrently, since the cursor of each page
+# depends on the previous page. Streams the stories back in chronological order.
+class PhabricatorFeedBackfill:
+
+    # Don't waste requests on segments that hardly contain any stories
+    minSegmentDuration = 3600
+
+    # Long time windows are split into days, so that a segment doesn't grow with the window
+    maxSegmentDuration = 86400
+
+    # A segment with more stories than storyLimit * segmentPages is returned in parts
+    segmentPages = 5
+
+    def __init__(self, conduitAPI, storyLimit, workers, verbose, retries=3, retryDelay=1, maxBufferedStories=5000):
+        self.conduitAPI = conduitAPI
+        self.storyLimit = storyLimit
+        self.workers = workers
+        self.verbose = verbose
+        self.retries = retries
+        self.retryDelay = retryDelay
+
+        # Every fetched part of a segment holds less than segmentStoryLimit + storyLimit stories,
+        # so the look-ahead is limited by the number of stories that may wait to be yielded
+        self.segmentStoryLimit = storyLimit * self.segmentPages
+        self.lookAhead = max(workers, maxBufferedStories // self.segmentStoryLimit)
+
+    # Yields the stories with a chronokey between the given ones (exclusive),
+    # chronologically forwards or backwards
+    def stories(self, firstChronokey, lastChronokey, forwards):
+
+        segments = self.__segments(firstChronokey, lastChronokey, forwards)
+
+        if self.verbose:
+            print("Backfilling with", self.workers, "workers, fetching up to", self.lookAhead, "segments ahead")
+
+        previousChronokey = None
+
+        with concurrent.futures.ThreadPoolExecutor(max_workers=self.workers) as executor:
+
+            # Only fetch a few segments ahead, so that memory remains bounded
+            pending = deque()
+            try:
+                while True:
+                    for segment in segments:
+                        pending.append(executor.submit(self.__fetchSegment, *segment, forwards))
+                        if len(pending) >= self.lookAhead:
+                            break
+
+                    if not pending:
+                        return
+
+                    stories, rest = pending.popleft().result()
+
+                    # The rest of a segment with many stories precedes the following segments
+                    if rest is not None:
+                        pending.appendleft(executor.submit(self.__fetchSegment, *rest, forwards))
+
+                    previousChronokey = yield from self.__yieldSegment(stories, previousChronokey, forwards)
+
+            # Don't query the remaining segments if one failed or the caller stopped early
+            finally:
+                for future in pending:
+                    future.cancel()
+
+    # Drops the stories that were already returned at the seam of the previous segment
+    def __yieldSegment(self, stories, previousChronokey, forwards):
+
+        for story in stories:
+            chronokey = story[1]
+            if previousChronokey is not None and (chronokey <= previousChronokey if forwards else chronokey >= previousChronokey):
+                continue
+
+            previousChronokey = chronokey
+            yield story
+
+        return previousChronokey
+
+    # Yields the segments (start, end] in the order of traversal, where the last segment ends before lastChronokey.
+    # Short ranges are split among the workers, long ones into days.
+    def __segments(self, firstChronokey, lastChronokey, forwards):
+
+        duration = chronokeyToEpoch(lastChronokey) - chronokeyToEpoch(firstChronokey)
+        segmentDuration = max(self.minSegmentDuration, min(self.maxSegmentDuration, duration // (4 * self.workers)))
+        segmentLength = epochToChronokey(segmentDuration)
+
+        length = lastChronokey - 1 - firstChronokey
+        count = max(1, -(-length // segmentLength))
+        bounds = lambda i: firstChronokey + min(length, segmentLength * i)
+
+        for i in range(count) if forwards else reversed(range(count)):
+            yield bounds(i), bounds(i + 1)
+
+    # Returns the stories of the segment (start, end] in the order of traversal, at most about segmentStoryLimit of them,
+    # and the rest of the segment that still has to be fetched or None.
+    # Raises PhabricatorBackfillError if a page still can't be queried after some retries.
+    def __fetchSegment(self, startChronokey, endChronokey, forwards):
+
+        stories = []
+
+        # The feed returns the stories after or before the given chronokey (exclusive)
+        chronokey = startChronokey if forwards else endChronokey + 1
+        attempt = 0
+
+        while True:
+            page, _, _ = self.conduitAPI.queryFeed(chronokey, self.storyLimit, forwards)
+            if page is None:
+                attempt += 1
+                if attempt > self.retries:
+                    raise PhabricatorBackfillError("Could not query the feed " + ("after" if forwards else "before") + " chronokey " + str(chronokey))
+
+                if self.verbose:
+                    print("Querying the feed at", chronokey, "failed, retrying")
+
+                time.sleep(self.retryDelay * attempt)
+                continue
+
+            attempt = 0
+            page = sorted(page, key=lambda story: story[1], reverse=not forwards)
+
+            for story in page:
+                if story[1] > endChronokey if forwards else story[1] <= startChronokey:
+                    return stories, None
+                stories.append(story)
+
+            if len(page) < self.storyLimit:
+                return stories, None
+
+            chronokey = page[-1][1]
+
+            if len(stories) >= self.segmentStoryLimit:
+                return stories, (chronokey, endChronokey) if forwards else (startChronokey, chronokey - 1)
+
+# Stores the pulled stories in a local SQLite database together with the resolved names,
+# so that history queries and reports don't download the same stories again.
+# Also remembers the range of chronokeys of which all stories are archived.
+class PhabricatorStoryArchive:
+
+    columns = ("storyPHID", "chronokey", "epoch", "authorPHID", "objectPHID", "text",
+               "authorName", "objType", "objID", "objTitle", "objLink")
+
+    def __init__(self, filename):
+
+        self.lock = threading.Lock()
+
+        # Written by the feed thread, read by the command threads
+        self.connection = sqlite3.connect(filename, check_same_thread=False)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("PRAGMA synchronous=NORMAL")
+
+        # Replacing a story has to remove it from the full-text index too
+        self.connection.execute("PRAGMA recursive_triggers=ON")
+
+        with self.connection:
+            self.connection.execute(
+                "CREATE TABLE IF NOT EXISTS stories ("
+                "chronokey INTEGER PRIMARY KEY, storyPHID TEXT, epoch INTEGER, authorPHID TEXT, objectPHID TEXT, text TEXT, "
+                "authorName TEXT, objType TEXT, objID TEXT, objTitle TEXT, objLink TEXT)")
+            self.connection.execute("CREATE INDEX IF NOT EXISTS storiesAuthor ON stories (authorPHID, chronokey)")
+            self.connection.execute("CREATE INDEX IF NOT EXISTS storiesAuthorName ON stories (authorName, chronokey)")
+            self.connection.execute("CREATE INDEX IF NOT EXISTS storiesObject ON stories (objectPHID, chronokey)")
+            self.connection.execute(
+                "CREATE TABLE IF NOT EXISTS coverage ("
+                "id INTEGER PRIMARY KEY CHECK (id = 0), firstChronokey INTEGER, lastChronokey INTEGER)")
+
+        self.searchable = self.__createSearchIndex()
+        self.__createDailyAggregates()
+
+    # Indexes the story texts, object titles and author names for full-text search.
+    # The index only references the rows of the stories table and is kept up to date by triggers.
+    # Returns False if SQLite was built without FTS5.
+    def __createSearchIndex(self):
+
+        exists = self.connection.execute("SELECT 1 FROM sqlite_master WHERE name = 'storiesSearch'").fetchone() is not None
+
+        try:
+            with self.connection:
+                self.connection.execute(
+                    "CREATE VIRTUAL TABLE IF NOT EXISTS storiesSearch USING fts5("
+                    "text, objTitle, authorName, content='stories', content_rowid='chronokey')")
+        except sqlite3.OperationalError as e:
+            print("Full-text search unavailable:", e)
+            return False
+
+        with self.connection:
+            self.connection.execute(
+                "CREATE TRIGGER IF NOT EXISTS storiesSearchInsert AFTER INSERT ON stories BEGIN "
+                "INSERT INTO storiesSearch (rowid, text, objTitle, authorName) VALUES (new.chronokey, new.text, new.objTitle, new.authorName); "
+                "END")
+            self.connection.execute(
+                "CREATE TRIGGER IF NOT EXISTS storiesSearchDelete AFTER DELETE ON stories BEGIN "
+                "INSERT INTO storiesSearch (storiesSearch, rowid, text, objTitle, authorName) VALUES ('delete', old.chronokey, old.text, old.objTitle, old.authorName); "
+                "END")
+
+            # Index the stories that were archived before full-text search existed
+            if not exists:
+                self.connection.execute("INSERT INTO storiesSearch (storiesSearch) VALUES ('rebuild')")
+
+        return True
+
+    # Returns the epoch, object PHID, text, author name and object of the best matching stories containing all of the given words.
+    # The words are quoted, so that no user input is interpreted as query syntax.
+    def search(self, words, offset, limit):
+
+        terms = []
+        for word in words.split():
+            prefix = word.endswith("*")
+            word = word.rstrip("*")
+            if word:
+                terms.append('"' + word.replace('"', '""') + '"' + ("*" if prefix else ""))
+
+        if len(terms) == 0:
+            return []
+
+        with self.lock:
+            return self.connection.execute(
+                "SELECT stories.epoch, stories.objectPHID, stories.text, stories.authorName, "
+                "stories.objType, stories.objID, stories.objTitle, stories.objLink FROM storiesSearch "
+                "JOIN stories ON stories.chronokey = storiesSearch.rowid "
+                "WHERE storiesSearch MATCH ? ORDER BY storiesSearch.rank LIMIT ? OFFSET ?",
+                (" ".join(terms), limit, offset)).fetchall()
+
+    # Remembers the most significant action of every author on every object per day (UTC),
+    # so that reports don't have to process every story of their time window
+    def __createDailyAggregates(self):
+
+        exists = self.connection.execute("SELECT 1 FROM sqlite_master WHERE name = 'dailyActions'").fetchone() is not None
+
+        with self.connection:
+            self.connection.execute(
+                "CREATE TABLE IF NOT EXISTS dailyActions ("
+                "day INTEGER, authorName TEXT, objID TEXT, rank INTEGER, chronokey INTEGER, "
+                "PRIMARY KEY (day, authorName, objID))")
+
+            # Aggregate the stories that were archived before the aggregates existed
+            if not exists:
+                for rows in self.__batches(self.connection.execute("SELECT " + ", ".join(self.columns) + " FROM stories")):
+                    self.__aggregate(rows)
+
+    def close(self):
+        with self.lock:
+            self.connection.close()
+
+    # Stores rows of the given columns, replacing previously archived versions of the same stories
+    def store(self, rows):
+
+        if len(rows) == 0:
+            return
+
+        with self.lock, self.connection:
+            self.connection.executemany(
+                "INSERT OR REPLACE INTO stories (" + ", ".join(self.columns) + ") VALUES (" + ", ".join("?" * len(self.columns)) + ")",
+                rows)
+            self.__aggregate(rows)
+
+    # Keeps the most significant action of the day, the earliest story if equally significant
+    def __aggregate(self, rows):
+
+        actions = []
+        for row in rows:
+            rank = reportedActionRank(*row[4:])
+            if rank is not None:
+                _, chronokey, _, _, _, _, authorName, _, objID, _, _ = row
+                actions.append((chronokeyToEpoch(chronokey) // secondsPerDay, authorName, objID, rank, chronokey))
+
+        self.connection.executemany(
+            "INSERT INTO dailyActions (day, authorName, objID, rank, chronokey) VALUES (?, ?, ?, ?, ?) "
+            "ON CONFLICT (day, authorName, objID) DO UPDATE SET rank = excluded.rank, chronokey = excluded.chronokey "
+            "WHERE excluded.rank < rank OR excluded.rank = rank AND excluded.chronokey < chronokey",
+            actions)
+
+    def __batches(self, cursor, batchSize=1000):
+        while True:
+            rows = cursor.fetchmany(batchSize)
+            if not rows:
+                return
+            yield rows
+
+    # Returns the archived rows of the most significant action of every author on every object
+    # between the given chronokeys (exclusive), in chronological order.
+    # Complete days are taken from the aggregates, only the stories of the partial days at both ends are ranked.
+    def mostSignificantStories(self, firstChronokey, lastChronokey):
+
+        firstDay = chronokeyToEpoch(firstChronokey) // secondsPerDay
+        if epochToChronokey(firstDay * secondsPerDay) <= firstChronokey:
+            firstDay += 1
+
+        lastDay = chronokeyToEpoch(lastChronokey) // secondsPerDay
+
+        if firstDay >= lastDay:
+            firstDay = lastDay = None
+            partialRanges = [(firstChronokey, lastChronokey)]
+        else:
+            partialRanges = [
+                (firstChronokey, epochToChronokey(firstDay * secondsPerDay)),
+                (epochToChronokey(lastDay * secondsPerDay) - 1, lastChronokey)
+            ]
+
+        # Maps author name and object ID to rank and chronokey
+        best = {}
+
+        def merge(authorName, objID, rank, chronokey):
+            previous = best.get((authorName, objID))
+            if previous is None or (rank, chronokey) < previous:
+                best[(authorName, objID)] = (rank, chronokey)
+
+        with self.lock:
+            if firstDay is not None:
+                for authorName, objID, rank, chronokey in self.connection.execute(
+                        "SELECT authorName, objID, rank, chronokey FROM dailyActions WHERE day >= ? AND day < ?", (firstDay, lastDay)):
+                    merge(authorName, objID, rank, chronokey)
+
+            for start, end in partialRanges:
+                for row in self.connection.execute(
+                        "SELECT " + ", ".join(self.columns) + " FROM stories WHERE chronokey > ? AND chronokey < ?", (start, end)):
+                    rank = reportedActionRank(*row[4:])
+                    if rank is not None:
+                        merge(row[6], row[8], rank, row[1])
+
+            chronokeys = sorted(chronokey for _, chronokey in best.values())
+
+            rows = []
+            for i in range(0, len(chronokeys), 500):
+                batch = chronokeys[i:i + 500]
+                rows += self.connection.execute(
+                    "SELECT " + ", ".join(self.columns) + " FROM stories WHERE chronokey IN (" + ", ".join("?" * len(batch)) + ") ORDER BY chronokey",
+                    batch).fetchall()
+
+        return rows
+
+    # Returns the first and last chronokey (inclusive) of which all stories are archived, or None
+    def coverage(self):
+        with self.lock:
+            return self.connection.execute("SELECT firstChronokey, lastChronokey FROM coverage").fetchone()
+
+    # Adds the given range of completely archived chronokeys (inclusive) to the coverage.
+    # Ranges that are separated from the current coverage by a gap are ignored,
+    # unless the archive was empty.
+    def extendCoverage(self, firstChronokey, lastChronokey):
+
+        if firstChronokey is None or firstChronokey > lastChronokey:
+            return
+
+        with self.lock, self.connection:
+            coverage = self.connection.execute("SELECT firstChronokey, lastChronokey FROM coverage").fetchone()
+
+            if coverage is not None:
+                if firstChronokey > coverage[1] + 1 or lastChronokey < coverage[0] - 1:
+                    return
+
+                firstChronokey = min(firstChronokey, coverage[0])
+                lastChronokey = max(lastChronokey, coverage[1])
+
+            self.connection.execute(
+                "INSERT OR REPLACE INTO coverage (id, firstChronokey, lastChronokey) VALUES (0, ?, ?)",
+                (firstChronokey, lastChronokey))
+
+    # Yields the archived rows with a chronokey between the given ones (exclusive),
+    # chronologically forwards or backwards
+    def stories(self, firstChronokey, lastChronokey, forwards, batchSize=1000):
+
+        query = "SELECT " + ", ".join(self.columns) + " FROM stories WHERE chronokey > ? AND chronokey < ? " + \
+            "ORDER BY chronokey " + ("ASC" if forwards else "DESC") + " LIMIT ?"
+
+        # Page through the rows, so that neither the lock is held nor all rows are loaded at once
+        while True:
+            with self.lock:
+                rows = self.connection.execute(query, (firstChronokey, lastChronokey, batchSize)).fetchall()
+
+            yield from rows
+
+            if len(rows) < batchSize:
+                return
+
+            if forwards:
+                firstChronokey = rows[-1][1]
+            else:
+                lastChronokey = rows[-1][1]
+
+# Returns the rank of the action of the story in progress reports, or None if it isn't reported
+def reportedActionRank(objectPHID, text, authorName, objType, objID, objTitle, objLink):
+
+    if objType not in reportedObjTypes or authorName is None:
+        return None
+
+    _, action = PhabricatorStoryStringConstructor(
+        objType, objectPHID, objID, objTitle, objLink, authorName, text,
+        True, False, PhabricatorStringFormatting(False, False, False), False).constructStoryString()
+
+    return actionRanks.get(action)
+
+# Keeps HTTP/1.1 keep-alive connections to the Phabricator host open,
+# so that consecutive queries don't repeat the TCP and TLS handshakes.
+# Shared by the feed thread and the reply path, hence guarded by a lock.
+# This is the default transport of ConduitAPI. Other transports provide the same request() and close() methods.
+class ConduitConnectionPool:
+
+    # Errors raised when the server silently closed a kept-alive socket
+    staleConnectionErrors = (
+        http.client.RemoteDisconnected,
+        http.client.CannotSendRequest,
+        http.client.BadStatusLine,
+        ConnectionResetError,
+        ConnectionAbortedError,
+        BrokenPipeError,
+        ssl.SSLEOFError,
+        ssl.SSLZeroReturnError
+    )
+
+    def __init__(self, phabricatorURL, acceptInvalidSSLCert, httpTimeout, poolSize, idleTimeout):
+        self.phabricatorURL = phabricatorURL
+        self.httpTimeout = httpTimeout
 
-    def printSomeStories(self, irc):
+        # A location without scheme is reached with HTTPS.
+        # "http://" allows plain HTTP, for example to the local server of benchmark.py
+        scheme, _, self.host = phabricatorURL.rpartition("://")
+        self.host = self.host.rstrip("/")
+        self.plainHTTP = scheme.lower() == "http"
+        self.poolSize = poolSize
+        self.idleTimeout = idleTimeout
 
-        stories = self.pullSomeStories()
-        if stories is True:
-            return True
+        # Loading the certificate store is expensive, so all connections share one context
+        self.sslContext = ssl._create_unverified_context() if acceptInvalidSSLCert else ssl.create_default_context()
 
-        for story in stories:
-            string, _, _, _, _ = story
-            print(string)
-            if irc:
-                for (channel,_) in irc.state.channels.items():
-                    if not self.channels or channel in self.channels:
-                        irc.queueMsg(ircmsgs.privmsg(channel, string))
+        self.lock = threading.Lock()
+        self.idleConnections = []
 
-        time.sleep(self.sleepTime)
-        return False
+    # Sends the request on a kept-alive connection if possible and
+    # returns the status, reason and the complete response body.
+    # Reconnects once if the server has dropped a reused connection meanwhile.
+    def request(self, method, path, body, headers):
 
-    # Pulls some stories on phabricator that are more recent or older than the current chronokey.
-    # Fetches the refered authors and differentials.
-    # Returns a list of human-readable strings to be posted in irc and the updated chronokey or
-    # Returns True if all stories in that timeframe have been processed already.
-    def pullSomeStories(self):
+        conn, reused = self.__acquire()
 
-        if self.chronokeyEpoch:
-            if self.historyForwards and self.timestampBefore != 0 and self.chronokeyEpoch > self.timestampBefore or \
-               not self.historyForwards and self.timestampAfter != 0 and self.chronokeyEpoch < self.timestampAfter:
-                if self.verbose:
-                    print("Finished, chronokey is ", self.chronokey)
-                return True
+        try:
+            response, data = self.__send(conn, method, path, body, headers)
+        except self.staleConnectionErrors:
+            conn.close()
+            if not reused:
+                raise
 
-        stories, objectPHIDs, authorPHIDs = self.conduitAPI.queryFeed(self.chronokey, self.storyLimit, self.historyForwards)
+            conn = self.__connect()
+            try:
+                response, data = self.__send(conn, method, path, body, headers)
+            except:
+                conn.close()
+                raise
+        except:
+            conn.close()
+            raise
 
-        authorNames = self.conduitAPI.queryAuthorNames(authorPHIDs)
-        if authorNames is None:
-            return []
+        if response.will_close:
+            conn.close()
+        else:
+            self.__release(conn)
 
-        objects = self.conduitAPI.queryObjects(objectPHIDs)
-        if objects is None:
-            return []
+        return response.status, response.reason, data
 
-        if not self.historyForwards and len(stories) == 0:
-            if self.verbose:
-                print("No more stories found")
-            return True
+    # Closes all idle connections, for example when unloading the plugin
+    def close(self):
+        with self.lock:
+            connections = self.idleConnections
+            self.idleConnections = []
 
-        # We can't do anything with the transaction PHIDs! Not even getting the sub-URL of the modified object
-        # https://secure.phabricator.com/T5873
-        # transactions = queryObjects(allTransactionPHIDs)
+        for conn, _ in connections:
+            conn.close()
 
-        # Sort by timestamp
-        storiesSorted = sorted(stories, key=lambda story: story[1], reverse=not self.historyForwards)
+    def __send(self, conn, method, path, body, headers):
+        conn.request(method, path, body, headers)
+        response = conn.getresponse()
 
-        strings = []
-        for story in storiesSorted:
+        # The response must be consumed entirely before the connection can be reused
+        return response, response.read()
 
-            # Extract the objects referenced by this particular story
-            _, newChronokey, epoch, authorPHID, objectPHID, text = story
-            objType, objID, objTitle, objLink = objects[objectPHID]
-            authorName = authorNames[authorPHID]
+    def __connect(self):
 
-            # TODO: move this to queryAuthorNames
-            if authorPHID == "PHID-APPS-PhabricatorDiffusionApplication":
-                if self.verbose:
-                    print("Fallback: Commit without phabricator account: [" + text + "]")
-                authorName = self.conduitAPI.queryCommitsByPHIDs(objectPHID)
-                if authorName is None:
-                    return []
-                authorName = authorName.get("data")[objectPHID]["author"]
+        if self.plainHTTP:
+            return http.client.HTTPConnection(self.host, timeout=self.httpTimeout)
 
-            # Remember most recently actually printed story (in the specified chronological order)
-            self.__updateChronokey(newChronokey, epoch)
+        return http.client.HTTPSConnection(
+            self.host,
+            context=self.sslContext,
+            timeout=self.httpTimeout)
 
-            if self.__filterDate(epoch, True) or self.__filterUser(authorName):
-                continue
+    # Returns the most recently used connection that didn't expire yet,
+    # or a new connection if there is none
+    def __acquire(self):
 
-            # Create a string from the parsed story data and referenced objects
-            storyString = PhabricatorStoryStringConstructor(
-                objType,
-                objectPHID,
-                objID,
-                objTitle,
-                objLink,
-                authorName,
-                text,
-                self.notifyCommit,
-                self.notifyRetitle,
-                self.formatting,
-                self.verbose
-            ).constructStoryString()
+        with self.lock:
+            now = time.monotonic()
+            expired = [conn for conn, lastUsed in self.idleConnections if now - lastUsed >= self.idleTimeout]
+            self.idleConnections = [(conn, lastUsed) for conn, lastUsed in self.idleConnections if now - lastUsed < self.idleTimeout]
+            conn = self.idleConnections.pop()[0] if self.idleConnections else None
 
-            try:
-                string, action = storyString
-            except TypeError:
-                print("constructStoryString returned non-iterable", storyString, "from", text)
-                continue
+        for expiredConn in expired:
+            expiredConn.close()
 
-            if string is None:
-                continue
+        if conn is not None:
+            return conn, True
 
-            datePrefix = datetime.datetime.fromtimestamp(epoch).strftime('[%Y-%m-%d %H:%M:%S] ') if self.printDate else ""
-            string = datePrefix + self.newsPrefix + string
-            strings.append((string, authorName, objID, objType, action))
+        return self.__connect(), False
 
-        return strings
+    def __release(self, conn):
 
-    def __filterUser(self, authorName):
+        with self.lock:
+            if len(self.idleConnections) < self.poolSize:
+                self.idleConnections.append((conn, time.monotonic()))
+                return
 
-        if self.ignoredUsers is not None and authorName in self.ignoredUsers:
-            if self.verbose:
-                print("Skipping blocked user", authorName)
-            return True
+        conn.close()
 
-        if self.filteredUsers and len(self.filteredUsers) and authorName not in self.filteredUsers:
-            if self.verbose:
-                print("Skipping non-filtered user", authorName)
-            return True
+# Removes the API token from a request body, so that cassettes can be shared and
+# replayed with any token
+def cassetteRequestBody(body):
+    return urllib.parse.urlencode([(key, value) for key, value in urllib.parse.parse_qsl(body, keep_blank_values=True) if key != "api.token"])
 
-        return False
+# Passes the requests to another transport and saves every request with its response and timing to a cassette file.
+# A cassette is a gzip compressed file with one JSON object per line: a header, then one line per request
+# with the offset from the start of the recording ("t") and the duration ("d") in seconds.
+# Failed requests are recorded with the kind of error, so that timeouts can be replayed too.
+class ConduitRecorder:
 
-    def __filterDate(self, timestamp, debugPrint):
+    def __init__(self, transport, filename):
+        self.transport = transport
+        self.lock = threading.Lock()
+        self.start = time.monotonic()
+        self.cassette = gzip.open(filename, "wt", encoding="utf-8")
+        self.__write({"cassette": 1, "created": int(time.time())})
 
-        if self.timestampAfter != 0 and timestamp < self.timestampAfter:
-            if self.verbose:
-                print("Skipping story that is too old")
-            return True
+    def request(self, method, path, body, headers):
 
-        if self.timestampBefore != 0 and timestamp > self.timestampBefore:
-            if self.verbose:
-                print("Skipping story that is too recent")
-            return True
+        entry = {"m": method, "p": path, "b": cassetteRequestBody(body)}
+        start = time.monotonic()
 
-        return False
+        try:
+            status, reason, data = self.transport.request(method, path, body, headers)
+        except socket.timeout:
+            self.__record(entry, start, {"e": "timeout"})
+            raise
+        except (OSError, http.client.HTTPException) as e:
+            self.__record(entry, start, {"e": "connection", "r": str(e)})
+            raise
 
-    # Remember the chronological entry of the most recently
-    # processed or printed update on phabricator
-    # Returns None or number
-    def __loadChronokey(self):
+        # Undecodable bytes survive the JSON encoding as escaped surrogates
+        self.__record(entry, start, {"s": status, "r": reason, "data": data.decode("utf-8", "surrogateescape")})
+        return status, reason, data
 
-        if self.chronokeyFile is None:
-            return self.chronokey
+    def close(self):
+        self.transport.close()
+        with self.lock:
+            self.cassette.close()
+
+    def __record(self, entry, start, response):
+        entry["t"] = round(start - self.start, 4)
+        entry["d"] = round(time.monotonic() - start, 4)
+        entry.update(response)
+        self.__write(entry)
+
+    def __write(self, entry):
+        with self.lock:
+            if not self.cassette.closed:
+                self.cassette.write(json.dumps(entry, separators=(",", ":")) + "\n")
 
-        if not os.path.isfile(self.chronokeyFile):
-            print(self.chronokeyFile, "not found, starting at 0")
-            return self.chronokey
+# Answers requests from a cassette written by ConduitRecorder, without any connection.
+# Identical requests are answered with their recordings in the recorded order, the last one is repeated after that.
+# With realTime, every answer is delayed until its recorded offset from the start of the replay and then takes
+# as long as the recorded request did, so that bursts and gaps are reproduced. Otherwise it is returned right away.
+# Requests that weren't recorded are answered with status 404.
+class ConduitReplayer:
+
+    def __init__(self, filename, realTime=False):
+        self.realTime = realTime
+        self.lock = threading.Lock()
+        self.start = time.monotonic()
 
-        return int(open(self.chronokeyFile, 'r').read())
+        # Maps method, path and body to the recorded responses that were not replayed yet
+        self.responses = {}
+        self.entries = []
 
-    # Save the state immediately after processing a message,
-    # so that we don't lose the state after a crash
-    def __saveChronokey(self, chronokey):
+        with gzip.open(filename, "rt", encoding="utf-8") as cassette:
+            for line in cassette:
+                entry = json.loads(line)
+                if "p" not in entry:
+                    continue
+
+                self.entries.append(entry)
+                self.responses.setdefault((entry["m"], entry["p"], entry["b"]), deque()).append(entry)
+
+    def request(self, method, path, body, headers):
+
+        with self.lock:
+            responses = self.responses.get((method, path, cassetteRequestBody(body)))
+            entry = None
+            if responses:
+                entry = responses.popleft() if len(responses) > 1 else responses[0]
+
+        if entry is None:
+            return 404, "Not recorded", b""
+
+        if self.realTime:
+            time.sleep(max(0, self.start + entry["t"] - time.monotonic()) + entry["d"])
+
+        if entry.get("e") == "timeout":
+            raise socket.timeout("recorded timeout")
+
+        if "e" in entry:
+            raise ConnectionError(entry["r"])
+
+        return entry["s"], entry["r"], entry["data"].encode("utf-8", "surrogateescape")
+
+    # Returns the recorded requests of the given path in the recorded order
+    def recordedRequests(self, path):
+        return [entry for entry in self.entries if entry["p"] == path]
+
+    def close(self):
+        pass
+
+# Bounded least-recently-used cache of phid.query results.
+# Users are practically never renamed while object titles change frequently,
+# so both kinds of PHIDs expire after a different duration.
+class PHIDCache:
+
+    userPHIDPrefixes = ("PHID-USER-", "PHID-APPS-")
+
+    def __init__(self, maxSize, userTTL, objectTTL):
+        self.maxSize = maxSize
+        self.userTTL = userTTL
+        self.objectTTL = objectTTL
+
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    # Returns the cached results and the list of PHIDs that have to be queried
+    def lookup(self, phids):
+
+        results = {}
+        missingPHIDs = []
 
-        if self.verbose:
-            print("Saving chronokey", chronokey)
+        with self.lock:
+            now = time.monotonic()
+            for phid in phids:
+                entry = self.entries.get(phid)
 
-        text_file = open(self.chronokeyFile, "w")
-        text_file.write(str(chronokey) + "\n")
-        text_file.close()
+                if entry is not None and entry[0] > now:
+                    self.entries.move_to_end(phid)
+                    results[phid] = entry[1]
+                    self.hits += 1
+                    continue
+
+                if entry is not None:
+                    del self.entries[phid]
 
-    def __updateChronokey(self, newChronokey, newEpoch):
+                if phid not in missingPHIDs:
+                    missingPHIDs.append(phid)
+                self.misses += 1
 
-        if self.chronokeyEpoch is None:
-            self.chronokeyEpoch = newEpoch
+        return results, missingPHIDs
 
-        if self.chronokey is None:
-            if self.verbose:
-                print("Initializing chronokey with", newChronokey)
-            self.chronokey = newChronokey
-            return
+    def store(self, results):
 
-        previous = self.chronokey
-        if self.historyForwards:
-            self.chronokey = max(self.chronokey, newChronokey)
-            self.chronokeyEpoch = max(self.chronokeyEpoch, newEpoch)
-        else:
-            self.chronokey = min(self.chronokey, newChronokey)
-            self.chronokeyEpoch  = min(self.chronokeyEpoch, newEpoch)
+        with self.lock:
+            now = time.monotonic()
+            for phid in results:
+                ttl = self.userTTL if phid.startswith(self.userPHIDPrefixes) else self.objectTTL
+                if ttl == 0:
+                    continue
 
-        if previous == self.chronokey:
-            return
+                self.entries[phid] = (now + ttl, results[phid])
+                self.entries.move_to_end(phid)
 
-        if self.verbose:
-            print("New chronokey:", self.chronokey)
+            while len(self.entries) > self.maxSize:
+                self.entries.popitem(last=False)
+                self.evictions += 1
 
-        if self.chronokeyFile:
-            self.__saveChronokey(self.chronokey)
+    def invalidate(self, phids):
+        with self.lock:
+            for phid in phids:
+                self.entries.pop(phid, None)
+
+    def stats(self):
+        with self.lock:
+            return {
+                "size": len(self.entries),
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions
+            }
 
 # Provides some abstraction and parsing of the RESTful Phabricator API
 import json
 class ConduitAPI:
 
-    def __init__(self, phabricatorURL, phabricatorToken, acceptInvalidSSLCert, httpTimeout):
+    # The transport sends the requests, by default a ConduitConnectionPool
+    def __init__(self, phabricatorURL, phabricatorToken, acceptInvalidSSLCert, httpTimeout, connectionPoolSize=4, connectionIdleTimeout=60,
+                 phidCacheSize=5000, phidCacheUserTTL=86400, phidCacheObjectTTL=300, transport=None):
         self.phabricatorToken = phabricatorToken
         self.phabricatorURL = phabricatorURL
         self.acceptInvalidSSLCert = acceptInvalidSSLCert
         self.httpTimeout = httpTimeout
 
-    # Send an HTTPS GET request to the phabricator location and
+        self.transport = transport or ConduitConnectionPool(
+            phabricatorURL,
+            acceptInvalidSSLCert,
+            httpTimeout,
+            connectionPoolSize,
+            connectionIdleTimeout)
+
+        self.phidCache = PHIDCache(phidCacheSize, phidCacheUserTTL, phidCacheObjectTTL)
+
+        # The author of a commit never changes
+        self.commitAuthorCache = PHIDCache(phidCacheSize, phidCacheUserTTL, phidCacheUserTTL)
+
+        # Team members change about as rarely as user names
+        self.projectMemberCache = PHIDCache(phidCacheSize, phidCacheUserTTL, phidCacheUserTTL)
+
+    def close(self):
+        self.transport.close()
+
+    # Send a GET request to the phabricator location and
     # return the interpreted JSON object
     def queryAPI(self, path, params):
 
@@ -478,26 +2806,20 @@ class ConduitAPI:
             "Charset": "utf-8"
         }
 
-        conn = http.client.HTTPSConnection(
-            self.phabricatorURL,
-            context=ssl._create_unverified_context() if self.acceptInvalidSSLCert else None,
-            timeout=self.httpTimeout)
-
         try:
-            conn.request("GET", path, urllib.parse.urlencode(params, True), headers)
-            response = conn.getresponse()
+            status, reason, data = self.transport.request("GET", path, urllib.parse.urlencode(params, True), headers)
         # This is supposedly TimeoutError, but not when testing
         except socket.timeout:
             print("Timeout at", path)
             return None
+        except (OSError, http.client.HTTPException) as e:
+            print("Connection error at", path, e)
+            return None
 
-        if response.status != 200:
-            print(response.status, response.reason)
-            conn.close()
+        if status != 200:
+            print(status, reason)
             return None
 
-        data = response.read()
-        conn.close()
         data = json.loads(data.decode("utf-8"))
 
         if data["error_code"] is not None:
@@ -509,12 +2831,43 @@ class ConduitAPI:
 
     # Return some information about arbitrary objects, like
     # differntials, users, commits, transactions, ...
+    # Only the PHIDs that are not cached are queried, in one batch.
     def queryPHIDs(self, phids):
 
         if len(phids) == 0:
             return []
 
-        return self.queryAPI("/api/phid.query", {"phids[]": phids})
+        results, missingPHIDs = self.phidCache.lookup(phids)
+
+        if len(missingPHIDs) == 0:
+            return results
+
+        missingResults = self.queryAPI("/api/phid.query", {"phids[]": missingPHIDs})
+
+        if missingResults is None:
+            return None
+
+        self.phidCache.store(missingResults)
+        results.update(missingResults)
+
+        return results
+
+    # Returns a dictionary mapping the given usernames to their PHIDs
+    def queryUserPHIDs(self, userNames):
+
+        if len(userNames) == 0:
+            return {}
+
+        results = self.queryAPI("/api/user.query", {"usernames[]": userNames})
+
+        if results is None:
+            return None
+
+        return {result["userName"]: result["phid"] for result in results}
+
+    # Forget the cached information about objects that were modified
+    def invalidatePHIDs(self, phids):
+        self.phidCache.invalidate(phids)
 
     # Retrieve account names of the given author URLs
     def queryAuthorNames(self, authorPHIDs):
@@ -537,7 +2890,7 @@ class ConduitAPI:
         results = self.queryPHIDs(objectPHIDs)
 
         if results is None:
-            return []
+            return None
 
         objects = {}
 
@@ -576,6 +2929,55 @@ class ConduitAPI:
             "phids[]": PHIDs
         })
 
+    # Returns a dictionary mapping the given commit PHIDs to the names of their authors,
+    # as recorded by the version control system
+    def queryCommitAuthors(self, commitPHIDs):
+
+        if len(commitPHIDs) == 0:
+            return {}
+
+        commitAuthors, missingPHIDs = self.commitAuthorCache.lookup(commitPHIDs)
+
+        if len(missingPHIDs) == 0:
+            return commitAuthors
+
+        results = self.queryCommitsByPHIDs(missingPHIDs)
+
+        if results is None:
+            return None
+
+        # PHP encodes an empty map as an empty list
+        commits = results.get("data") or {}
+
+        missingAuthors = {commitPHID: commit["author"] for commitPHID, commit in commits.items()}
+        self.commitAuthorCache.store(missingAuthors)
+        commitAuthors.update(missingAuthors)
+
+        return commitAuthors
+
+    # Returns the usernames of the members of the given project
+    def queryProjectMembers(self, projectName):
+
+        cached, _ = self.projectMemberCache.lookup([projectName])
+        if projectName in cached:
+            return cached[projectName]
+
+        results = self.queryAPI("/api/project.query", {"names[]": [projectName]})
+
+        if results is None:
+            return None
+
+        memberPHIDs = [memberPHID for project in results["data"].values() for memberPHID in project["members"]]
+
+        memberNames = self.queryAuthorNames(memberPHIDs)
+        if memberNames is None:
+            return None
+
+        memberNames = sorted(memberNames.values(), key=str.lower)
+        self.projectMemberCache.store({projectName: memberNames})
+
+        return memberNames
+
     # Returns object PHID, authorName, uri, summary, epoch
     def queryPastesByID(self, IDs):
         return self.queryAPI("/api/paste.query", {
@@ -603,7 +3005,7 @@ class ConduitAPI:
         results = self.queryAPI("/api/feed.query", arguments)
 
         if results is None:
-            return [], [], []
+            return None, None, None
 
         stories = []
         authorPHIDs = []
@@ -636,6 +3038,67 @@ class ConduitAPI:
 
         return stories, objectPHIDs, authorPHIDs #, allTransactionPHIDs
 
+# Runs independent Conduit queries concurrently, for example the authors and objects of a feed page.
+# The blocking ConduitAPI calls are executed on a bounded thread pool by an event loop
+# living in its own thread, so both the feed thread and the reply path can await several queries at once.
+class AsyncConduitAPI:
+
+    # Instances following further Phabricator installations can share the threads of another AsyncConduitAPI
+    def __init__(self, conduitAPI, maxConcurrentRequests=4, sharedWith=None):
+        self.conduitAPI = conduitAPI
+        self.ownsThreads = sharedWith is None
+
+        if sharedWith:
+            self.executor = sharedWith.executor
+            self.loop = sharedWith.loop
+            return
+
+        # Caps the number of requests in flight
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=maxConcurrentRequests)
+
+        self.loop = asyncio.new_event_loop()
+        self.thread = threading.Thread(target=self.loop.run_forever, daemon=True)
+        self.thread.start()
+
+    # Blocks the calling thread until all given coroutines finished,
+    # returns their results in the given order
+    def gather(self, *coroutines):
+        return asyncio.run_coroutine_threadsafe(self.__gather(coroutines), self.loop).result()
+
+    def close(self):
+        if not self.ownsThreads:
+            return
+
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.executor.shutdown(wait=False)
+
+    async def __gather(self, coroutines):
+        return await asyncio.gather(*coroutines)
+
+    async def __run(self, function, *args):
+        return await self.loop.run_in_executor(self.executor, function, *args)
+
+    async def queryFeed(self, chronokey, storyLimit, historyForwards):
+        return await self.__run(self.conduitAPI.queryFeed, chronokey, storyLimit, historyForwards)
+
+    async def queryAuthorNames(self, authorPHIDs):
+        return await self.__run(self.conduitAPI.queryAuthorNames, authorPHIDs)
+
+    async def queryObjects(self, objectPHIDs):
+        return await self.__run(self.conduitAPI.queryObjects, objectPHIDs)
+
+    async def queryDifferentials(self, IDs):
+        return await self.__run(self.conduitAPI.queryDifferentials, IDs)
+
+    async def queryCommitsByPHIDs(self, PHIDs):
+        return await self.__run(self.conduitAPI.queryCommitsByPHIDs, PHIDs)
+
+    async def queryCommitAuthors(self, commitPHIDs):
+        return await self.__run(self.conduitAPI.queryCommitAuthors, commitPHIDs)
+
+    async def queryPastesByID(self, IDs):
+        return await self.__run(self.conduitAPI.queryPastesByID, IDs)
+
 class PhabricatorStringFormatting:
 
     def __init__(self, bolding, obscureUsernames, htmlLinks):
@@ -678,8 +3141,151 @@ class PhabricatorReplyStringConstructor:
             self.formatting.bold("Title:") + " " + self.objTitle+ " " + \
             self.formatting.formatLink(self.objLink)
 
+# The result of parsing the text of a feed story:
+# the action identifier, the operands that follow the object (for example the added reviewer)
+# and how the object was referred to, or None if the reference wasn't found
+ParsedStoryAction = namedtuple("ParsedStoryAction", ("action", "operands", "objectReference"))
+
+# Parses the "text" property of feed.query results, which is necessary since transactions can't be queried yet.
+# The grammar of every object type is compiled once into one pattern that recognizes all supported actions.
+class PhabricatorStoryParser:
+
+    # Supported actions per object type and the pattern of the operands following the object reference
+    # TODO: lookup the file that contains the strings, add remaining strings
+    grammar = {
+        "Differential Revision": (
+            ("created", None),
+            ("retitled", None),
+            ("closed", r" by committing (?P<commit>[^:\s]+)"),
+            ("accepted", None),
+            ("awarded", r" an? (?P<token>.+) token\.$"),
+            ("resigned from", None),
+            ("abandoned", None),
+            ("reclaimed", None),
+            ("commandeered", None),
+            ("added a dependency for", None),
+            ("added a dependent revision for", None),
+            ("removed a project from", None),
+            ("planned changes to", None),
+            ("requested review of", None),
+            ("added a reviewer for", r": (?P<reviewer>.+)\.$"),
+            ("added reviewers for", r": (?P<reviewers>.+)\.$"),
+            ("removed a reviewer for", None),
+            ("edited reviewers for", None),
+            ("removed 1 commit(s)", None),
+            ("added 1 commit(s)", None),
+            ("failed to build", None),
+            ("added a comment to", None),
+            ("added inline comments to", None),
+            ("updated", None),
+            ("updated the summary of", None),
+            ("updated the diff for", None),
+            ("updated subscribers of", None),
+            ("updated the Trac tickets for", None),
+            ("updated the test plan for", None),
+            ("requested changes to", None),
+            ("changed the visibility for", None),
+            ("set the repository for", None),
+        ),
+        "Diffusion Commit": (
+            ("committed", None),
+            ("added a comment to", None),
+            ("added inline comments to", None),
+            ("raised a concern with", None),
+            ("accepted", None),
+            ("added auditors to", r": (?P<auditors>.+)\.$"),
+            ("edited edges for", None),
+            ("added an edge to", None),
+            ("requested verification of", None),
+            ("updated subscribers of", None),
+            # TODO awarded
+        ),
+        "Paste": (
+            ("created", None),
+            ("edited", None),
+            ("archived", None),
+            ("added a comment to", None),
+            ("updated the title for", None),
+            ("updated the language for", None),
+            ("changed the visibility for", None),
+        ),
+        "Project": (
+            # TODO: created
+            ("added a member for", r": (?P<member>.+)\.$"),
+            ("added members for", r": (?P<members>.+)\.$"),
+            ("changed the edit policy for", None),
+        ),
+    }
+
+    def __init__(self):
+
+        # Maps object types to the pattern matching any action and the operand patterns of each action
+        self.compiledGrammar = {}
+
+        for objType, actions in self.grammar.items():
+
+            # Longer actions first, so that "updated" doesn't shadow "updated the diff for"
+            names = sorted((action for action, _ in actions), key=len, reverse=True)
+            actionPattern = re.compile("(" + "|".join(map(re.escape, names)) + ")(?= |$)")
+
+            operandPatterns = {}
+            for action, operandPattern in actions:
+                operandPatterns[action] = re.compile(operandPattern) if operandPattern is not None else None
+
+            self.compiledGrammar[objType] = actionPattern, operandPatterns
+
+    # Returns a ParsedStoryAction, or None if the action is not supported
+    def parse(self, objType, objID, objTitle, authorName, text):
+
+        compiledGrammar = self.compiledGrammar.get(objType)
+        if compiledGrammar is None:
+            return None
+
+        actionPattern, operandPatterns = compiledGrammar
+
+        # The text starts with the name of the author
+        match = actionPattern.match(text, len(authorName) + 1)
+        if match is None:
+            return None
+
+        action = match.group(1)
+        start = match.end() + 1
+
+        # Objects are referred to as "D123: Title", "P123 Title" (notice the missing colon), "Title" or "D123"
+        if text.startswith(objID, start):
+            end = start + len(objID)
+            if text.startswith(": " + objTitle, end):
+                end += 2 + len(objTitle)
+            elif text.startswith(" " + objTitle, end):
+                end += 1 + len(objTitle)
+        elif text.startswith(objTitle, start):
+            end = start + len(objTitle)
+        else:
+            return ParsedStoryAction(action, {}, None)
+
+        operandPattern = operandPatterns[action]
+        operandMatch = operandPattern.match(text, end) if operandPattern is not None else None
+
+        return ParsedStoryAction(action, operandMatch.groupdict() if operandMatch else {}, text[start:end])
+
+storyParser = PhabricatorStoryParser()
+
 class PhabricatorStoryStringConstructor:
 
+    # How actions with operands are phrased, the remaining actions are printed as they are
+    actionPhrases = {
+        "added a reviewer for": "added {reviewer} as a reviewer for",
+        "added reviewers for": "added {reviewers} as reviewers for",
+        "awarded": "gave a {token} award to",
+        "added a member for": "added {member} as a member to",
+    }
+
+    # Operands that are lists of usernames
+    userOperands = ("reviewer", "reviewers", "member", "members")
+
+    # Words connecting an action to the object, omitted when several actions share the object
+    actionPrepositions = ("for", "to", "with", "on", "of")
+
     def __init__(self, objType, objectPHID, objID, objTitle, objLink, authorName, text, notifyCommit, notifyRetitle, formatting, verbose):
         self.objType = objType
         self.objectPHID = objectPHID
@@ -693,233 +3299,146 @@ class PhabricatorStoryStringConstructor:
         self.notifyRetitle = notifyRetitle
         self.verbose = verbose
 
-        # Clumsy parsing of the "text" property of the feed.query api results, since transactionPHIDs can't be queried yet
-        self.action = self.text[len(self.authorName + " "):]
+        # Phrase of the action if the generic story format was used
+        self.actionPhrase = None
 
     # Returns the string and the action identifier
     def constructStoryString(self):
 
+        parsed = storyParser.parse(self.objType, self.objID, self.objTitle, self.authorName, self.text)
+
         if self.objType == "Differential Revision":
-            return self.__constructDifferentialRevisionStoryString()
+            return self.__constructDifferentialRevisionStoryString(parsed)
 
         if self.objType == "Diffusion Commit":
-            return self.__constructCommitStoryString()
+            return self.__constructCommitStoryString(parsed)
 
         if self.objType == "Paste":
-            return self.__constructPasteStoryString()
+            return self.__constructPasteStoryString(parsed)
 
         if self.objType == "Project":
-            return self.__constructProjectStoryString()
+            return self.__constructProjectStoryString(parsed)
 
         if self.objType == "Image Macro":
-            return self.__constructImageMacroStoryString()
+            return None, None
 
         print("Unexpected object type '" + self.objType + "'", self.objectPHID)
         return None, None
 
-    def __constructDifferentialRevisionStoryString(self):
-
-        # TODO: lookup the file that contains the strings, link it, add remaining strings
-        supportedActions = (
-            "created",
-            "retitled",
-            "closed",
-            "accepted",
-            "awarded",
-            "resigned from",
-            "abandoned",
-            "reclaimed",
-            "commandeered",
-            "added a dependency for",
-            "added a dependent revision for",
-            "removed a project from",
-            "planned changes to",
-            "requested review of",
-            "added a reviewer for",
-            "removed a reviewer for",
-            "edited reviewers for",
-            "removed 1 commit(s)",
-            "added 1 commit(s)",
-            # TODO: removed reviewers for?
-            "failed to build",
-            "added reviewers for", # TODO: that query is messed up e​l​e​x​i​s added reviewers for D188: Whales shou D188 (Whales should not block ships) <https://code.wildfiregames.com/D188>.
-            "added a comment to", # TODO: extra space
-            "added inline comments to",
-            "updated",
-            "updated the summary of",
-            "updated the diff for",
-            "updated subscribers of",
-            "updated the Trac tickets for",
-            "updated the test plan for",
-            "requested changes to",
-            "changed the visibility for",
-            "set the repository for",
-        )
-
-        if not self.action.startswith(supportedActions):
-            print("WARNING! unsupported differential revision action:", self.action)
+    def __constructDifferentialRevisionStoryString(self, parsed):
 
-        # contrary to other actions, this one extends the string by the added reviewer
-        if self.action.startswith("added a reviewer for"):
-            return self.__constructDifferentialRevisionReviewerAddedStoryString(), "added a reviewer for"
+        if parsed is None:
+            return self.__constructUnsupportedDifferentialRevisionStoryString()
 
-        if self.action.startswith("closed"):
-            return self.__constructDifferentialRevisionCloseStoryString(), "closed"
-
-        if self.action.startswith("set the repository for"):
-            return self.__constructDifferentialRevisionSetRepositoryStoryString(), "set the repository for"
+        if parsed.action == "retitled" and not self.notifyRetitle:
+            # We don't print the previous title which is sent by the conduitAPI
+            if self.verbose:
+                print("Skipping retitle of", self.objID)
+            return None, parsed.action
 
-        if self.action.startswith("awarded"):
-            return self.__constructDifferentialRevisionAwardedStoryString(), "awarded"
+        return self.__constructGenericStoryString(self.__phraseAction(parsed)), parsed.action
 
-        if self.action.startswith("retitled"):
-            return self.__constructDifferentialRevisionRetitleStoryString(), "retitled"
+    # Assumes that all other actions have the same format
+    def __constructUnsupportedDifferentialRevisionStoryString(self):
 
-        # All other cases are assumed to have this format
-        action = self.action[:-len(" " + self.objID + ": " + self.objTitle + ".")]
+        suffix = " " + self.objID + ": " + self.objTitle + "."
+        if not self.text.endswith(suffix):
+            print("Unsupported differential revision story:", self.text)
+            return None, None
 
-        string = self.formatting.obscureAuthorName(self.authorName) + " " + \
-            action + " " + \
-            self.formatting.bold(self.objID) + " (" + self.objTitle + ") " + \
-            self.formatting.formatLink(self.objLink)
+        action = self.text[len(self.authorName + " "):-len(suffix)]
 
-        return string, action
+        if self.verbose:
+            print("Unsupported differential revision action:", action)
 
-    def __constructGenericStoryString(self, action):
-        string = self.formatting.obscureAuthorName(self.authorName) + \
-            " " + action + " " + \
-            self.formatting.bold(self.objID) + " (" + self.objTitle + ") " + \
-            self.formatting.formatLink(self.objLink)
-        return string
+        return self.__constructGenericStoryString(action), action
 
-    def __constructDifferentialRevisionRetitleStoryString(self):
+    def __constructCommitStoryString(self, parsed):
 
-        # We don't print the previous title which is sent by the conduitAPI
-        if not self.notifyRetitle:
+        if parsed is None:
             if self.verbose:
-                print("Skipping retitle of", self.objID)
-            return None
-        return self.__constructGenericStoryString("retitled")
-
-    def __constructDifferentialRevisionReviewerAddedStoryString(self):
-        # TODO: broken string: e​l​e​x​i​s added e​O​b​j​e​c​t​s​:​ ​e​l​e​x​i​s as a reviewer for D189 (Extending rmgen lib's SimpleGroup's place method to avoid collision of included SimpleObjects) <https://code.wildfiregames.com/D189>.
-        addedReviewer = self.action[len("added a reviewer for" + " " + self.objID + ": " + self.objTitle + ": "):-len(".")]
-        return self.__constructGenericStoryString(
-            "added " + \
-            self.formatting.obscureAuthorName(addedReviewer) + \
-            " as a reviewer for")
-
-    def __constructDifferentialRevisionAwardedStoryString(self):
-        token = self.action[len("awarded " + self.objID + ": " + self.objTitle + " a "):-len(" token.")]
-        return self.__constructGenericStoryString("gave a " + token + " award to ")
-
-    def __constructDifferentialRevisionCloseStoryString(self):
-
-        #by = self.action[len("closed " + self.objID + ": " + self.objTitle):-len(".")]
-
-        #if not by:
-        return self.__constructGenericStoryString("closed")
-
-        #commitID = by[len(" by committing"):].split(":", 1)[0]
-        #return self.__constructGenericStoryString("closed by committing " + commitID)
-
-    def __constructDifferentialRevisionSetRepositoryStoryString(self):
-        # This cuts off the repetition of the object title in the action string
-        return self.__constructGenericStoryString("set the repository for")
-
-    def __constructCommitStoryString(self):
-
-        supportedActions = (
-            "committed",
-            "added a comment to",
-            "added inline comments to",
-            "raised a concern with",
-            "accepted",
-            "added auditors to", # TODO: contains auditor name
-            "edited edges for",
-            "added an edge to",
-            "requested verification of",
-            "updated subscribers of",
-            # TODO awarded
-        )
-
-        if self.action.startswith("committed"):
-            if not self.notifyCommit:
-                if self.verbose:
-                    print("Skipping commit", self.objID, self.objTitle)
-                return None, None
-            return self.__constructGenericStoryString("committed"), "committed"
-
-        for action in supportedActions:
-            if self.action.startswith(action):
-                return self.__constructGenericStoryString(action), action
+                print("Unknown commit story type:", self.text)
+            return None, None
 
-        print("Unknown commit story type:", self.action)
-        return None, None
+        if parsed.action == "committed" and not self.notifyCommit:
+            if self.verbose:
+                print("Skipping commit", self.objID, self.objTitle)
+            return None, None
 
-    def __constructPasteStoryString(self):
+        return self.__constructGenericStoryString(self.__phraseAction(parsed)), parsed.action
 
-        supportedActions = (
-            "created",
-            "edited",
-            "archived",
-            "added a comment to",
-            "updated the title for",
-            "updated the language for",
-            "changed the visibility for"
-        )
+    def __constructPasteStoryString(self, parsed):
 
-        if not self.action.startswith(supportedActions):
-            print("Unknown paste story type:", self.action)
+        if parsed is None:
+            if self.verbose:
+                print("Unknown paste story type:", self.text)
             return None, None
 
-        # Notice the missing colon between ID and Title
-        action = self.action[:-len(" " + self.objID + " " + self.objTitle)]
-
-        return self.__constructGenericStoryString(action), action
+        return self.__constructGenericStoryString(parsed.action), parsed.action
 
     # Almost never new projects are created, so meh
-    def __constructProjectStoryString(self):
+    def __constructProjectStoryString(self, parsed):
+
+        if parsed is None:
+            if self.verbose:
+                print("Unsupported project story action:", self.text)
+            return None, None
 
-        # TODO: created
+        if parsed.action == "added a member for":
+            return self.__constructGenericStoryString(self.__phraseAction(parsed)), parsed.action
 
-        addedMemberAction = "added a member for"
-        if self.action.startswith(addedMemberAction):
-            addedMember = self.action[len(addedMemberAction + " " + self.objTitle + ": "):-len(".")]
-            return self.__constructGenericStoryString(
-                "added " + \
-                self.formatting.obscureAuthorName(addedMember) + " " + \
-                "as a member to"
-            ), addedMemberAction
-            # TODO: should the one above really contain the objectID?
-            #return self.formatting.obscureAuthorName(self.authorName) + " " + \
-            #    "added " + \
-            #    self.formatting.obscureAuthorName(addedMember) + " " + \
-            #    "as a member to " + \
-            #    self.formatting.bold(self.objTitle) + " " \
-            #    self.formatting.formatLink(self.objLink)
-
-        addedMembersAction = "added members for"
-        if self.action.startswith(addedMembersAction):
-            addedMembers = self.action[len(addedMembersAction + " " + self.objTitle + ": "):-len(".")].split(", ")
+        if parsed.action == "added members for":
             return self.formatting.obscureAuthorName(self.authorName) + " " + \
                 "added " + \
-                ", ".join(map(lambda member: self.formatting.obscureAuthorName(member), addedMembers)) + " " + \
+                self.__formatUsers(parsed.operands.get("members", "")) + " " + \
                 "as members to " + \
                 self.formatting.bold(self.objTitle) + " " + \
-                self.formatting.formatLink(self.objLink), addedMembersAction
+                self.formatting.formatLink(self.objLink), parsed.action
 
-        editPolicyAction = "changed the edit policy for"
-        if self.action.startswith(editPolicyAction):
-            return self.formatting.obscureAuthorName(self.authorName) + " " + \
-                editPolicyAction + " " + \
-                self.formatting.bold(self.objTitle) + " " + \
-                self.formatting.formatLink(self.objLink), editPolicyAction
+        return self.formatting.obscureAuthorName(self.authorName) + " " + \
+            parsed.action + " " + \
+            self.formatting.bold(self.objTitle) + " " + \
+            self.formatting.formatLink(self.objLink), parsed.action
 
-        print("Unsupported project story action:", self.action)
-        return None, None
+    # Inserts the operands into the phrase of the action
+    def __phraseAction(self, parsed):
 
-    def __constructImageMacroStoryString(self):
-        return None, None
+        phrase = self.actionPhrases.get(parsed.action)
+        if phrase is None:
+            return parsed.action
+
+        operands = dict(parsed.operands)
+        for operand in self.userOperands:
+            if operand in operands:
+                operands[operand] = self.__formatUsers(operands[operand])
+
+        try:
+            return phrase.format(**operands)
+        except KeyError:
+            return parsed.action
+
+    def __formatUsers(self, users):
+        return ", ".join(map(self.formatting.obscureAuthorName, users.split(", ")))
+
+    # Lists the given action phrases of the author in one string, for example
+    # "elexis updated the diff, added inline comments to D123 (...)"
+    def constructDigestString(self, phrases):
+
+        connected = []
+        for phrase in phrases[:-1]:
+            words = phrase.split(" ")
+            if len(words) > 1 and words[-1] in self.actionPrepositions:
+                phrase = " ".join(words[:-1])
+            connected.append(phrase)
+
+        return self.__constructGenericStoryString(", ".join(connected + phrases[-1:]))
+
+    def __constructGenericStoryString(self, action):
+        self.actionPhrase = action
+        string = self.formatting.obscureAuthorName(self.authorName) + \
+            " " + action + " " + \
+            self.formatting.bold(self.objID) + " (" + self.objTitle + ") " + \
+            self.formatting.formatLink(self.objLink)
+        return string
 
 Class = Phabricator
@@ -0,0 +1,150 @@
+###
+# Copyright (c) 2017, elexis
+# All rights reserved.
+###
+
+import html
+
+# Generates progress reports from a stream of rendered phabricator stories.
+# Only the most significant action of every author on every object is kept,
+# so the memory used depends on the number of touched objects, not on the number of stories.
+
+# Types of objects that are reported
+reportedObjTypes = ("Differential Revision", "Diffusion Commit")
+
+# Actions that are reported, the most significant one first
+actionOrder = [
+    "committed",
+    "closed",
+    "created",
+    "updated the diff for",
+    "planned changes to",
+    "accepted",
+    "requested changes to",
+    "raised a concern with",
+    "added a comment to",
+    "added inline comments to",
+    "abandoned",
+]
+
+actionRanks = {action: rank for rank, action in enumerate(actionOrder)}
+
+class PhabricatorProgressReport:
+
+    def __init__(self, teamMembers):
+        self.teamMembers = set(teamMembers or ())
+
+        # Maps author name to a dictionary from object ID to rank, arrival and string of the most significant story
+        self.authorObjects = {}
+        self.storyCount = 0
+
+    # Accepts the tuples returned by PhabricatorStoryPrinter.pullSomeStories
+    def add(self, story):
+
+        string, authorName, objID, objType, action = story
+
+        if objType not in reportedObjTypes:
+            return
+
+        rank = actionRanks.get(action)
+        if rank is None:
+            return
+
+        objects = self.authorObjects.setdefault(authorName, {})
+        previous = objects.get(objID)
+
+        if previous is None or rank < previous[0]:
+            objects[objID] = (rank, self.storyCount, string)
+
+        self.storyCount += 1
+
+    def addStories(self, pages):
+        for stories in pages:
+            for story in stories:
+                self.add(story)
+
+    # Team members first, then everyone else, the stories of every author ordered by significance
+    def write(self, writer, title):
+
+        writer.begin(title)
+
+        teamAuthors = sorted((authorName for authorName in self.authorObjects if authorName in self.teamMembers), key=str.lower)
+        otherAuthors = sorted((authorName for authorName in self.authorObjects if authorName not in self.teamMembers), key=str.lower)
+
+        for authorName in teamAuthors:
+            self.__writeAuthor(writer, authorName)
+
+        if teamAuthors and otherAuthors:
+            writer.paragraph("Progress by non-team members:")
+
+        for authorName in otherAuthors:
+            self.__writeAuthor(writer, authorName)
+
+        writer.end()
+
+    def __writeAuthor(self, writer, authorName):
+        stories = sorted(self.authorObjects[authorName].values())
+        writer.authorStories(authorName, [string for _, _, string in stories])
+
+# Writes the report to a stream, subclasses decide about the markup
+class PhabricatorReportWriter:
+
+    # Whether the story strings should contain HTML links
+    htmlLinks = False
+
+    fileExtension = "txt"
+
+    def __init__(self, stream):
+        self.stream = stream
+
+    def begin(self, title):
+        self.paragraph(title)
+
+    def end(self):
+        pass
+
+    def paragraph(self, txt):
+        self.stream.write(txt + "\n\n")
+
+    def authorStories(self, authorName, strings):
+        self.stream.write(authorName + ":\n")
+        for string in strings:
+            self.stream.write("  " + string + "\n")
+        self.stream.write("\n")
+
+class PhabricatorMarkdownReportWriter(PhabricatorReportWriter):
+
+    fileExtension = "md"
+
+    def begin(self, title):
+        self.stream.write("# " + title + "\n\n")
+
+    def authorStories(self, authorName, strings):
+        self.stream.write("## " + authorName + "\n\n")
+        for string in strings:
+            self.stream.write("* " + string + "\n")
+        self.stream.write("\n")
+
+# Uses the spoiler markup of the Wildfire Games forums
+class PhabricatorHTMLReportWriter(PhabricatorReportWriter):
+
+    htmlLinks = True
+
+    fileExtension = "html"
+
+    def paragraph(self, txt):
+        self.stream.write("<p>" + html.escape(txt) + "</p>\n")
+
+    def authorStories(self, authorName, strings):
+        self.paragraph(authorName + ":")
+        self.stream.write(
+            '<div class="ipsSpoiler" data-ipsspoiler="">' +
+            '<div class="ipsSpoiler_header"><span>Spoiler</span></div>' +
+            '<div class="ipsSpoiler_contents">' + "<br/>\n".join(strings) + '</div>' +
+            '</div>\n')
+
+reportWriters = {
+    "text": PhabricatorReportWriter,
+    "markdown": PhabricatorMarkdownReportWriter,
+    "html": PhabricatorHTMLReportWriter
+}
@@ -3,7 +3,726 @@
 # All rights reserved.
 ###
 
+import os.path
+import json
+import socket
+import tempfile
+import threading
+import time
+import urllib.error
+import urllib.request
+
 from supybot.test import *
 
+from .plugin import PhabricatorStringFormatting, PhabricatorStoryStringConstructor, storyParser, \
+    PhabricatorWebhookListener, webhookSignature, PhabricatorStoryPrinter, ConduitAPI, AsyncConduitAPI, \
+    ConduitConnectionPool, ConduitRecorder, ConduitReplayer, PhabricatorFeedBackfill, epochToChronokey, \
+    PhabricatorStoryArchive, reportedActionRank, PhabricatorChronokeyCheckpoint, PhabricatorOutboundScheduler
+from . import plugin
+from .fake_conduit import FakeConduitData, FakeConduitServer
+
 class PhabricatorTestCase(PluginTestCase):
     plugins = ('Phabricator',)
+
+# Recorded feed story texts and the expected notifications
+class PhabricatorStoryCorpusTestCase(SupyTestCase):
+
+    def testFeedCorpus(self):
+
+        formatting = PhabricatorStringFormatting(bolding=False, obscureUsernames=False, htmlLinks=False)
+
+        with open(os.path.join(os.path.dirname(__file__), "feed_corpus.json")) as corpusFile:
+            corpus = json.load(corpusFile)
+
+        for story in corpus:
+
+            parsed = storyParser.parse(story["objType"], story["objID"], story["objTitle"], story["authorName"], story["text"])
+            self.assertEqual(parsed.operands if parsed else {}, story["operands"], story["text"])
+
+            string, action = PhabricatorStoryStringConstructor(
+                story["objType"],
+                None,
+                story["objID"],
+                story["objTitle"],
+                story["objLink"],
+                story["authorName"],
+                story["text"],
+                True,
+                True,
+                formatting,
+                False
+            ).constructStoryString()
+
+            self.assertEqual(string, story["string"], story["text"])
+            self.assertEqual(action, story["action"], story["text"])
+
+# Only signed webhook requests trigger querying the feed
+class PhabricatorWebhookTestCase(SupyTestCase):
+
+    def testSignature(self):
+
+        pushes = []
+        listener = PhabricatorWebhookListener("127.0.0.1", 0, "secret", lambda path: pushes.append(path), False)
+
+        def post(signature):
+            body = b'{"object": {"type": "DREV"}}'
+            request = urllib.request.Request("http://127.0.0.1:%d/" % listener.port, data=body, method="POST", headers={
+                PhabricatorWebhookListener.signatureHeader: signature(body)
+            })
+            try:
+                with urllib.request.urlopen(request) as response:
+                    return response.status
+            except urllib.error.HTTPError as e:
+                return e.code
+
+        try:
+            self.assertEqual(post(lambda body: webhookSignature("wrong", body)), 403)
+            self.assertEqual(pushes, [])
+
+            self.assertEqual(post(lambda body: webhookSignature("secret", body)), 200)
+            self.assertEqual(pushes, ["/"])
+        finally:
+            listener.close()
+
+# The given options replace the defaults of the story printer
+def fakeStoryPrinter(conduitAPI, asyncConduitAPI, storyLimit, historyForwards=True, chronokey=0, **options):
+
+    arguments = dict(
+        conduitAPI=conduitAPI,
+        asyncConduitAPI=asyncConduitAPI,
+        formatting=PhabricatorStringFormatting(bolding=False, obscureUsernames=False, htmlLinks=False),
+        storyLimit=storyLimit,
+        historyForwards=historyForwards,
+        timestampAfter=0,
+        timestampBefore=0,
+        sleepTime=10,
+        maxSleepTime=60,
+        newsPrefix="",
+        printDate=False,
+        ignoredUsers=[],
+        filteredUsers=[],
+        notifyCommit=True,
+        notifyRetitle=True,
+        chronokey=chronokey,
+        chronokeyFile=None,
+        verbose=False)
+
+    arguments.update(options)
+    return PhabricatorStoryPrinter(**arguments)
+
+# Serves the given data until the end of the test, returns the server and the clients
+def connectFakeConduit(testCase, data, latency=0):
+
+    server = FakeConduitServer(data, latency)
+    conduitAPI = ConduitAPI(server.url(), "token", acceptInvalidSSLCert=False, httpTimeout=10)
+    asyncConduitAPI = AsyncConduitAPI(conduitAPI)
+
+    testCase.addCleanup(server.close)
+    testCase.addCleanup(conduitAPI.close)
+    testCase.addCleanup(asyncConduitAPI.close)
+
+    return server, conduitAPI, asyncConduitAPI
+
+# Fails to resolve the authors and objects of the stories
+class UnresolvableConduitData(FakeConduitData):
+
+    def respond(self, path, params):
+        if path == "/api/phid.query":
+            return None
+        return super().respond(path, params)
+
+# A page whose stories could not be resolved must not be queried again right away
+class PhabricatorPollTestCase(SupyTestCase):
+
+    def testResolveFailure(self):
+
+        server = FakeConduitServer(UnresolvableConduitData(10))
+        conduitAPI = ConduitAPI(server.url(), "token", acceptInvalidSSLCert=False, httpTimeout=10)
+        asyncConduitAPI = AsyncConduitAPI(conduitAPI)
+        storyPrinter = fakeStoryPrinter(conduitAPI, asyncConduitAPI, 5)
+
+        try:
+            self.assertEqual(storyPrinter.pullSomeStories(), [])
+            self.assertEqual(storyPrinter.lastPageSize, 0)
+            self.assertEqual(storyPrinter.chronokey, 0)
+            self.assertEqual(storyPrinter.pollScheduler.nextDelay(storyPrinter.lastPageSize, 5), 10)
+            self.assertEqual(storyPrinter.pollScheduler.nextDelay(storyPrinter.lastPageSize, 5), 20)
+        finally:
+            asyncConduitAPI.close()
+            conduitAPI.close()
+            server.close()
+
+# The fake Conduit server of the benchmark pages through the feed like Phabricator does
+class PhabricatorFakeConduitTestCase(SupyTestCase):
+
+    def pullPages(self, historyForwards, chronokey):
+
+        data = FakeConduitData(250)
+        server = FakeConduitServer(data)
+        conduitAPI = ConduitAPI(server.url(), "token", acceptInvalidSSLCert=False, httpTimeout=10)
+        asyncConduitAPI = AsyncConduitAPI(conduitAPI)
+        storyPrinter = fakeStoryPrinter(conduitAPI, asyncConduitAPI, 100, historyForwards, chronokey)
+
+        pageSizes = []
+        try:
+            for _ in range(4):
+                if storyPrinter.pullSomeStories() is True:
+                    break
+                pageSizes.append(storyPrinter.lastPageSize)
+        finally:
+            asyncConduitAPI.close()
+            conduitAPI.close()
+            server.close()
+
+        return data, storyPrinter, pageSizes
+
+    def testForwards(self):
+        data, storyPrinter, pageSizes = self.pullPages(True, 0)
+        self.assertEqual(pageSizes, [100, 100, 50, 0])
+        self.assertEqual(storyPrinter.chronokey, int(data.stories[-1]["chronologicalKey"]))
+
+    def testBackwards(self):
+        data, storyPrinter, pageSizes = self.pullPages(False, None)
+        self.assertEqual(pageSizes, [100, 100, 50])
+        self.assertEqual(storyPrinter.chronokey, int(data.stories[0]["chronologicalKey"]))
+
+# Times out the requests of the given path, passes the others on
+class TimeoutTransport:
+
+    def __init__(self, transport, path):
+        self.transport = transport
+        self.path = path
+
+    def request(self, method, path, body, headers):
+        if path == self.path:
+            raise socket.timeout("timed out")
+        return self.transport.request(method, path, body, headers)
+
+    def close(self):
+        self.transport.close()
+
+# Recorded Conduit traffic is replayed with the same answers, errors and pacing
+class PhabricatorCassetteTestCase(SupyTestCase):
+
+    def testRoundTrip(self):
+
+        server = FakeConduitServer(FakeConduitData(10))
+        directory = tempfile.TemporaryDirectory()
+        filename = os.path.join(directory.name, "conduit.cassette.gz")
+
+        try:
+            transport = ConduitRecorder(
+                TimeoutTransport(ConduitConnectionPool(server.url(), False, 10, 1, 60), "/api/differential.query"),
+                filename)
+            conduitAPI = ConduitAPI(server.url(), "secret-token", False, 10, transport=transport)
+
+            userPHIDs = conduitAPI.queryUserPHIDs(["user1"])
+            self.assertEqual(userPHIDs, {"user1": "PHID-USER-1"})
+            time.sleep(0.2)
+            self.assertIsNone(conduitAPI.queryDifferentials(["1"]))
+            conduitAPI.close()
+            server.close()
+
+            with open(filename, "rb") as cassette:
+                self.assertNotIn(b"secret-token", cassette.read())
+
+            for realTime in (False, True):
+                replayer = ConduitReplayer(filename, realTime)
+                conduitAPI = ConduitAPI("cassette", "other-token", False, 10, transport=replayer)
+                start = time.monotonic()
+
+                self.assertEqual(conduitAPI.queryUserPHIDs(["user1"]), userPHIDs)
+                self.assertIsNone(conduitAPI.queryDifferentials(["1"]))
+                self.assertIsNone(conduitAPI.queryUserPHIDs(["user2"]))
+
+                # The timeout was recorded about 0.2 seconds after the first request
+                self.assertEqual(time.monotonic() - start >= 0.2, realTime)
+
+                conduitAPI.close()
+
+            body = replayer.recordedRequests("/api/differential.query")[0]["b"]
+            self.assertRaises(socket.timeout, replayer.request, "GET", "/api/differential.query", body, {})
+            self.assertEqual(replayer.request("GET", "/api/paste.query", "", {})[0], 404)
+        finally:
+            directory.cleanup()
+
+# Fails the given number of feed queries
+class FlakyFeedConduitData(FakeConduitData):
+
+    failures = 0
+
+    def feed(self, params):
+        with self.lock:
+            if self.failures > 0:
+                self.failures -= 1
+                return None
+        return super().feed(params)
+
+# Concurrent backfilling returns the same stories as paging through the time window one page after another
+class PhabricatorBackfillTestCase(SupyTestCase):
+
+    def setUp(self):
+        super().setUp()
+
+        # 20 hours of stories, one per minute
+        self.data = FlakyFeedConduitData(1200)
+        self.server, self.conduitAPI, self.asyncConduitAPI = connectFakeConduit(self, self.data)
+
+        self.timestampAfter = self.data.firstEpoch + 30 * 60
+        self.timestampBefore = self.data.firstEpoch + 1000 * 60
+
+    def storyPrinter(self, historyForwards, backfillWorkers):
+        return fakeStoryPrinter(self.conduitAPI, self.asyncConduitAPI, 10, historyForwards, None,
+            timestampAfter=self.timestampAfter, timestampBefore=self.timestampBefore, backfillWorkers=backfillWorkers)
+
+    def pulledStrings(self, historyForwards):
+
+        storyPrinter = self.storyPrinter(historyForwards, 1)
+        strings = []
+        while True:
+            stories = storyPrinter.pullSomeStories()
+            if stories is True:
+                return strings
+            strings += [story[0] for story in stories]
+
+    def backfilledStrings(self, historyForwards):
+        return [story[0] for stories in self.storyPrinter(historyForwards, 3).backfillStories() for story in stories]
+
+    def testSameStories(self):
+        for historyForwards in (True, False):
+            strings = self.pulledStrings(historyForwards)
+            self.assertEqual(len(strings), 971)
+            self.assertEqual(self.backfilledStrings(historyForwards), strings)
+
+    def testRetry(self):
+
+        firstChronokey = epochToChronokey(self.timestampAfter) - 1
+        lastChronokey = epochToChronokey(self.timestampBefore + 1)
+
+        backfill = PhabricatorFeedBackfill(self.conduitAPI, 10, 3, False, retryDelay=0)
+        stories = list(backfill.stories(firstChronokey, lastChronokey, True))
+        self.assertEqual(len(stories), 971)
+
+        self.data.failures = 2
+        self.assertEqual(list(backfill.stories(firstChronokey, lastChronokey, True)), stories)
+
+        # Loading the plugin in other tests executes the module again, the error class is looked up when raising
+        self.data.failures = 10 ** 6
+        with self.assertRaises(plugin.PhabricatorBackfillError):
+            list(backfill.stories(firstChronokey, lastChronokey, True))
+
+# Remembers the chronokeys that feed.query was asked for
+class RecordingConduitData(FakeConduitData):
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.queries = []
+
+    def feed(self, params):
+        with self.lock:
+            if "before" in params:
+                self.queries.append((True, int(params["before"][0])))
+            elif "after" in params:
+                self.queries.append((False, int(params["after"][0])))
+        return super().feed(params)
+
+# Returns the feed queries that started within the archived chronokeys (inclusive)
+def archivedQueries(queries, coverage):
+    return [(forwards, chronokey) for forwards, chronokey in queries
+            if (coverage[0] <= chronokey < coverage[1] if forwards else coverage[0] < chronokey <= coverage[1])]
+
+# Only the stories missing in the archive are queried from Phabricator
+class PhabricatorArchiveTestCase(SupyTestCase):
+
+    def setUp(self):
+        super().setUp()
+
+        # 10 hours of stories, one per minute
+        self.data = RecordingConduitData(600)
+        self.server, self.conduitAPI, self.asyncConduitAPI = connectFakeConduit(self, self.data)
+
+        self.directory = tempfile.TemporaryDirectory()
+        self.addCleanup(self.directory.cleanup)
+
+    def newArchive(self, name):
+        archive = PhabricatorStoryArchive(os.path.join(self.directory.name, name + ".sqlite"))
+        self.addCleanup(archive.close)
+        return archive
+
+    # Story number i was published i minutes after the first one
+    def minutes(self, count):
+        return self.data.firstEpoch + count * 60
+
+    def chronokey(self, number):
+        return int(self.data.stories[number]["chronologicalKey"])
+
+    def storyPrinter(self, after, before, historyForwards=True, archive=None, chronokey=None):
+        return fakeStoryPrinter(self.conduitAPI, self.asyncConduitAPI, 50, historyForwards, chronokey,
+            timestampAfter=self.minutes(after), timestampBefore=self.minutes(before), backfillWorkers=2, archive=archive)
+
+    def backfill(self, after, before, historyForwards=True, archive=None):
+        storyPrinter = self.storyPrinter(after, before, historyForwards, archive)
+        return [story[0] for stories in storyPrinter.backfillStories() for story in stories]
+
+    def testBackfill(self):
+
+        for historyForwards in (True, False):
+            archive = self.newArchive("backfill" + str(historyForwards))
+            expected = self.backfill(100, 499, historyForwards)
+            self.assertEqual(len(expected), 400)
+
+            middle = self.backfill(200, 299, historyForwards, archive)
+            self.assertEqual(middle, expected[100:200] if historyForwards else expected[200:300])
+
+            # The window is archived from its first second to its last one
+            coverage = archive.coverage()
+            self.assertEqual(coverage, (epochToChronokey(self.minutes(200)), epochToChronokey(self.minutes(299) + 1) - 1))
+
+            self.data.queries = []
+            self.assertEqual(self.backfill(100, 499, historyForwards, archive), expected)
+            self.assertEqual(archivedQueries(self.data.queries, coverage), [])
+
+            # Both the head and the tail were queried
+            self.assertTrue(any(chronokey < coverage[0] for _, chronokey in self.data.queries))
+            self.assertTrue(any(chronokey > coverage[1] for _, chronokey in self.data.queries))
+            self.assertEqual(archive.coverage(), (epochToChronokey(self.minutes(100)), epochToChronokey(self.minutes(499) + 1) - 1))
+
+            # Now nothing is missing
+            self.data.queries = []
+            self.assertEqual(self.backfill(100, 499, historyForwards, archive), expected)
+            self.assertEqual(self.data.queries, [])
+
+    def testPaging(self):
+
+        archive = self.newArchive("paging")
+        storyPrinter = fakeStoryPrinter(self.conduitAPI, self.asyncConduitAPI, 50, True, self.chronokey(99), archive=archive)
+        while storyPrinter.pullSomeStories() != [] or storyPrinter.lastPageSize != 0:
+            pass
+
+        # Pages cover the chronokeys following the one they were queried with
+        self.assertEqual(archive.coverage(), (self.chronokey(99) + 1, self.chronokey(599)))
+
+        expected = self.backfill(200, 299)
+        self.data.queries = []
+        self.assertEqual(self.backfill(200, 299, True, archive), expected)
+        self.assertEqual(self.data.queries, [])
+
+# Progress reports rank the complete days by their aggregates and the partial days at both ends by their stories
+class PhabricatorAggregateTestCase(SupyTestCase):
+
+    def setUp(self):
+        super().setUp()
+
+        # 5 days of stories, one per hour, by few authors on few objects
+        self.data = RecordingConduitData(120, userCount=3, differentialCount=5, storyInterval=3600)
+        self.server, self.conduitAPI, self.asyncConduitAPI = connectFakeConduit(self, self.data)
+
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.archive = PhabricatorStoryArchive(os.path.join(directory.name, "stories.sqlite"))
+        self.addCleanup(self.archive.close)
+
+    def hours(self, count):
+        return self.data.firstEpoch + count * 3600
+
+    def storyPrinter(self, after, before):
+        return fakeStoryPrinter(self.conduitAPI, self.asyncConduitAPI, 50, True, None,
+            timestampAfter=self.hours(after), timestampBefore=self.hours(before), backfillWorkers=2, archive=self.archive)
+
+    # Ranks every archived story between the given chronokeys (exclusive)
+    def mostSignificantChronokeys(self, firstChronokey, lastChronokey):
+
+        best = {}
+        for row in self.archive.stories(firstChronokey, lastChronokey, True):
+            rank = reportedActionRank(*row[4:])
+            if rank is not None:
+                key = (row[6], row[8])
+                best[key] = min(best.get(key, (rank, row[1])), (rank, row[1]))
+
+        return sorted(chronokey for _, chronokey in best.values())
+
+    def assertMostSignificant(self, firstChronokey, lastChronokey):
+        rows = self.archive.mostSignificantStories(firstChronokey, lastChronokey)
+        self.assertEqual([row[1] for row in rows], self.mostSignificantChronokeys(firstChronokey, lastChronokey))
+        self.assertTrue(rows)
+
+    def testPartialDays(self):
+
+        # Archive the middle of the window, so that the report has to fetch the head and tail
+        for _ in self.storyPrinter(30, 60).backfillStories():
+            pass
+
+        coverage = self.archive.coverage()
+        self.data.queries = []
+
+        strings = [story[0] for stories in self.storyPrinter(5, 100).aggregatedStories() for story in stories]
+        self.assertTrue(strings)
+        self.assertTrue(self.data.queries)
+        self.assertEqual(archivedQueries(self.data.queries, coverage), [])
+
+        # The window starts and ends in the middle of a day
+        self.assertMostSignificant(epochToChronokey(self.hours(5)) - 1, epochToChronokey(self.hours(100) + 1))
+
+        # The window lies within one day
+        self.assertMostSignificant(epochToChronokey(self.hours(24)) - 1, epochToChronokey(self.hours(30) + 1))
+
+        # The window consists of complete days
+        firstDay = self.hours(0) // 86400 + 1
+        self.assertMostSignificant(epochToChronokey(firstDay * 86400) - 1, epochToChronokey((firstDay + 2) * 86400))
+        self.assertMostSignificant(epochToChronokey(firstDay * 86400), epochToChronokey((firstDay + 2) * 86400) - 1)
+
+# Reports are written by the owner only, one at a time
+class PhabricatorReportTestCase(PluginTestCase):
+    plugins = ('Phabricator',)
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        conf.supybot.plugins.Phabricator.reportDirectory.setValue(self.directory.name)
+        super().setUp()
+
+    def tearDown(self):
+        super().tearDown()
+        conf.supybot.plugins.Phabricator.reportDirectory.setValue("")
+        self.directory.cleanup()
+
+    def testOwnerOnly(self):
+        # Capabilities are only checked for hosts marked __no_testcap__
+        self.assertError("phabreport 2017-07-14", frm="stranger!stranger@__no_testcap__")
+        self.assertEqual(os.listdir(self.directory.name), [])
+
+    def testOneAtATime(self):
+        with self.irc.getCallback("Phabricator").reportLock:
+            self.assertRegexp("phabreport 2017-07-14", "already")
+
+# The chronokey file is written once per interval or page and recovers from damaged lines
+class PhabricatorChronokeyCheckpointTestCase(SupyTestCase):
+
+    def setUp(self):
+        super().setUp()
+
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.filename = os.path.join(directory.name, "chronokey.txt")
+
+    def checkpoint(self, historySize=5):
+        return PhabricatorChronokeyCheckpoint(self.filename, 60000, False, historySize, False)
+
+    def savedChronokeys(self):
+        with open(self.filename, "r") as checkpointFile:
+            return [int(line) for line in checkpointFile.read().split()]
+
+    def writeFile(self, content):
+        with open(self.filename, "w") as checkpointFile:
+            checkpointFile.write(content)
+
+    def testCoalescing(self):
+
+        checkpoint = self.checkpoint()
+        checkpoint.update(1)
+        checkpoint.flush()
+        self.assertEqual(self.savedChronokeys(), [1])
+
+        # Updates within the interval are not written until the next flush
+        checkpoint.update(2)
+        checkpoint.update(3)
+        self.assertEqual(self.savedChronokeys(), [1])
+
+        checkpoint.flush()
+        self.assertEqual(self.savedChronokeys(), [3, 1])
+
+        # Nothing new, nothing written
+        checkpoint.flush()
+        self.assertEqual(self.savedChronokeys(), [3, 1])
+
+    def testOneWritePerPage(self):
+
+        data = FakeConduitData(250)
+        server, conduitAPI, asyncConduitAPI = connectFakeConduit(self, data)
+        storyPrinter = fakeStoryPrinter(conduitAPI, asyncConduitAPI, 100, True, 0,
+            chronokeyFile=self.filename, chronokeySaveInterval=60000, chronokeyFsync=False, chronokeyHistory=10)
+
+        # Start the interval, so that only the pages save the chronokey
+        storyPrinter.checkpoint.update(0)
+        storyPrinter.checkpoint.flush()
+
+        while storyPrinter.pullSomeStories() is not True and storyPrinter.lastPageSize:
+            self.assertEqual(self.savedChronokeys()[0], storyPrinter.chronokey)
+
+        chronokeys = [int(data.stories[number]["chronologicalKey"]) for number in (249, 199, 99)]
+        self.assertEqual(self.savedChronokeys(), chronokeys + [0])
+
+    def testDamagedLine(self):
+
+        self.writeFile("12x4\n200\n100\n")
+        checkpoint = self.checkpoint()
+        self.assertEqual(checkpoint.load(), 200)
+
+        checkpoint.update(300)
+        checkpoint.flush()
+        self.assertEqual(self.savedChronokeys(), [300, 200, 100])
+
+    def testHistorySize(self):
+
+        checkpoint = self.checkpoint(3)
+        for chronokey in range(1, 6):
+            checkpoint.update(chronokey)
+            checkpoint.flush()
+
+        self.assertEqual(self.savedChronokeys(), [5, 4, 3])
+
+        self.writeFile("".join(str(chronokey) + "\n" for chronokey in range(10, 0, -1)))
+        checkpoint = self.checkpoint(3)
+        self.assertEqual(checkpoint.load(), 10)
+        self.assertEqual(checkpoint.history, [10, 9, 8])
+
+    def testSingleLineFile(self):
+
+        # Written by versions without the history
+        self.writeFile("4242")
+        checkpoint = self.checkpoint()
+        self.assertEqual(checkpoint.load(), 4242)
+
+        checkpoint.update(4343)
+        checkpoint.flush()
+        self.assertEqual(self.savedChronokeys(), [4343, 4242])
+
+# Bursts of actions of one author on one object are sent as one line
+class PhabricatorDigestTestCase(SupyTestCase):
+
+    def stringConstructor(self):
+        return PhabricatorStoryStringConstructor(
+            "Differential Revision", None, "D1", "Fix ships", "https://phabricator.test/D1", "user0", "", True, True,
+            PhabricatorStringFormatting(bolding=False, obscureUsernames=False, htmlLinks=False), False)
+
+    def testDigestString(self):
+
+        stringConstructor = self.stringConstructor()
+
+        # Only the last phrase keeps its preposition
+        self.assertEqual(
+            stringConstructor.constructDigestString(["updated the diff for", "added inline comments to", "requested changes to"]),
+            "user0 updated the diff, added inline comments, requested changes to D1 (Fix ships) https://phabricator.test/D1")
+
+        self.assertEqual(
+            stringConstructor.constructDigestString(["accepted", "closed"]),
+            "user0 accepted, closed D1 (Fix ships) https://phabricator.test/D1")
+
+        self.assertEqual(
+            stringConstructor.constructDigestString(["added a comment to"]),
+            "user0 added a comment to D1 (Fix ships) https://phabricator.test/D1")
+
+    def testWindow(self):
+
+        # One story per minute by the same author on the same revision
+        data = FakeConduitData(10, userCount=1, differentialCount=1, commitRatio=0)
+        server, conduitAPI, asyncConduitAPI = connectFakeConduit(self, data)
+
+        def strings(digestWindow):
+            storyPrinter = fakeStoryPrinter(conduitAPI, asyncConduitAPI, 100, True, 0, digestWindow=digestWindow)
+            return [story[0] for story in storyPrinter.pullSomeStories()]
+
+        self.assertEqual(len(strings(0)), 10)
+
+        # Stories join the digest while they are within the window of its first story
+        digests = strings(120)
+        self.assertEqual(len(digests), 4)
+        self.assertTrue(digests[0].startswith("user0 closed, added inline comments, requested changes to D1 "))
+
+        # Repeated actions are listed once
+        digests = strings(1000)
+        self.assertEqual(len(digests), 1)
+        self.assertTrue(digests[0].startswith(
+            "user0 closed, added inline comments, requested changes, accepted, planned changes, created, added a comment to D1 "))
+
+# Records the messages the scheduler hands to the bot for one network
+class FakeOutboundIrc:
+
+    def __init__(self, network, supported):
+        self.network = network
+        self.supported = supported
+        self.state = self
+        self.zombie = False
+
+        # Messages waiting in the send queue of the bot, the scheduler holds back while it isn't empty
+        self.queue = []
+        self.sent = []
+
+    def queueMsg(self, msg):
+        self.sent.append(msg)
+
+# Messages are grouped by the target limits of the server, replies overtake news and networks don't hold each other back
+class PhabricatorOutboundTestCase(SupyTestCase):
+
+    def scheduler(self, rate=1000, burst=1000, highWaterMark=100):
+        scheduler = PhabricatorOutboundScheduler(rate, burst, highWaterMark, False)
+        self.addCleanup(scheduler.stop)
+        return scheduler
+
+    def waitForMessages(self, irc, count):
+        deadline = time.monotonic() + 5
+        while len(irc.sent) < count and time.monotonic() < deadline:
+            time.sleep(0.01)
+        time.sleep(0.1)
+        return [(msg.args[0], msg.args[1]) for msg in irc.sent]
+
+    def testTargets(self):
+
+        channels = ["#a", "#b", "#c", "#d", "#e"]
+        for supported, expected in (
+                ({}, ["#a", "#b", "#c", "#d", "#e"]),
+                ({"maxtargets": 2}, ["#a,#b", "#c,#d", "#e"]),
+                ({"targmax": "NAMES:1,PRIVMSG:3,NOTICE:3"}, ["#a,#b,#c", "#d,#e"]),
+                ({"targmax": "PRIVMSG:,NOTICE:"}, ["#a,#b,#c,#d,#e"]),
+                ({"targmax": "NAMES:1", "maxtargets": 4}, ["#a", "#b", "#c", "#d", "#e"])):
+
+            irc = FakeOutboundIrc("net", supported)
+            self.scheduler().sendNews(irc, channels, "news")
+            self.assertEqual([targets for targets, _ in self.waitForMessages(irc, len(expected))], expected, supported)
+
+        # Targets don't exceed the line length
+        irc = FakeOutboundIrc("net", {"targmax": "PRIVMSG:"})
+        string = "x" * 490
+        self.scheduler().sendNews(irc, channels, string)
+        messages = self.waitForMessages(irc, 2)
+        self.assertEqual([targets for targets, _ in messages], ["#a,#b,#c", "#d,#e"])
+        self.assertTrue(all(len(("PRIVMSG " + targets + " :" + string + "\r\n").encode()) <= 512 for targets, _ in messages))
+
+    def testReplyPriority(self):
+
+        irc = FakeOutboundIrc("net", {})
+        irc.queue.append("busy")
+
+        scheduler = self.scheduler()
+        scheduler.sendNews(irc, ["#a"], "news 1")
+        scheduler.sendNews(irc, ["#a"], "news 2")
+        scheduler.sendReply(irc, "#a", "reply")
+        time.sleep(0.3)
+        self.assertEqual(irc.sent, [])
+
+        irc.queue.clear()
+        self.assertEqual([string for _, string in self.waitForMessages(irc, 3)], ["reply", "news 1", "news 2"])
+
+    def testNetworks(self):
+
+        busy = FakeOutboundIrc("busy", {})
+        busy.queue.append("busy")
+        idle = FakeOutboundIrc("idle", {})
+
+        # Every network has its own bucket of one message per 10 seconds
+        scheduler = self.scheduler(rate=0.1, burst=1, highWaterMark=2)
+        scheduler.sendNews(busy, ["#a"], "news")
+        scheduler.sendNews(idle, ["#a"], "news 1")
+        scheduler.sendNews(idle, ["#a"], "news 2")
+        self.assertEqual([string for _, string in self.waitForMessages(idle, 1)], ["news 1"])
+        self.assertEqual(busy.sent, [])
+
+        busy.queue.clear()
+        self.assertEqual([string for _, string in self.waitForMessages(busy, 1)], ["news"])
+
+        # The news waiting for one network don't pause the feed for another
+        scheduler.sendNews(idle, ["#a"], "news 3")
+        for irc, paused in ((idle, True), (busy, False)):
+            capacity = threading.Thread(target=scheduler.waitForCapacity, args=(irc,), daemon=True)
+            capacity.start()
+            capacity.join(1)
+            self.assertEqual(capacity.is_alive(), paused, irc.network)
@@ -6,7 +6,6 @@ formatting = PhabricatorStringFormatting(bolding=False, obscureUsernames=False,
 # Allows testing the querying and string construction without connecting to IRC
 storyPrinter = PhabricatorStoryPrinter(
     conduitAPI=conduitAPI,
-    channels=None,
     formatting=formatting,
     storyLimit=5,
     historyForwards=True,
@@ -23,7 +22,7 @@ storyPrinter = PhabricatorStoryPrinter(
     chronokeyFile=None,
     verbose=True
 )
-storyPrinter.printStoriesForever(irc=None)
+storyPrinter.printStoriesForever(subscribers=None)
 
 replyPrinter = PhabricatorReplyPrinter(
     txt=":P",
@@ -33,6 +32,9 @@ replyPrinter = PhabricatorReplyPrinter(
 
 print(replyPrinter.getReplies())
 
+storyPrinter.close()
+replyPrinter.close()
+
 # some chronokeys (all n-1):
 # 6377663121088159957 tests acceptance of a commit
 # 6370393125263759849 tests raising of a concern of a commit
@@ -1,152 +1,10 @@
+import argparse
 import datetime
-from plugin import ConduitAPI, PhabricatorStringFormatting, PhabricatorStoryPrinter
+import sys
+from plugin import ConduitAPI, PhabricatorStoryArchive, writeProgressReport
+from report import reportWriters
 
-# Prints a generic HTML progress report for Wildfire Games development without connecting to IRC
-
-useHTML = True
-
-newlineSeparator = "<br/>\n" if useHTML else "\n"
-
-def printParagraph(txt):
-    if not useHTML:
-        print(txt)
-    print("<p>" + txt + "</p>")
-
-def printSpoiler(txt):
-    if not useHTML:
-        print(txt)
-        return
-
-    print(
-        '<div class="ipsSpoiler" data-ipsspoiler="">' +
-        '<div class="ipsSpoiler_header"><span>Spoiler</span></div>' +
-        '<div class="ipsSpoiler_contents">' + txt + '</div>' +
-        '</div>')
-
-def printAuthorStories(previousAuthor, authorName, currentAuthorStories, handledObjIDs):
-
-    if previousAuthor != authorName:
-        if previousAuthor is not None:
-            printParagraph(previousAuthor + ":")
-            printSpoiler(newlineSeparator.join(currentAuthorStories))
-
-        previousAuthor = authorName
-        handledObjIDs = []
-        currentAuthorStories = []
-
-    return previousAuthor, handledObjIDs, currentAuthorStories
-
-
-def progressReport(authorNames, start, end):
-
-    storyPrinter = PhabricatorStoryPrinter(
-        conduitAPI = ConduitAPI("code.wildfiregames.com", "insert-api-token-here", acceptInvalidSSLCert=False, httpTimeout=60),
-        channels=None,
-        formatting = PhabricatorStringFormatting(bolding=False, obscureUsernames=False, htmlLinks=useHTML),
-        storyLimit=200,
-        historyForwards=False,
-        timestampAfter=start.timestamp(),
-        timestampBefore=end.timestamp(),
-        sleepTime=5,
-        newsPrefix="",
-        printDate=True,
-        ignoredUsers=["Harbormaster", "Vulcan", "autobuild", "php-admin"],
-        filteredUsers=authorNames,
-        notifyCommit=True,
-        notifyRetitle=False,
-        chronokey=None,
-        chronokeyFile=None,
-        verbose=False
-    )
-
-    # TODO: via https://code.wildfiregames.com/api/project.query
-    teamMembers = [
-        "Itms",
-        "trompetin17",
-        "enrique",
-        "Yves",
-        "elexis",
-        "Gallaecio",
-        "LordGood",
-        "Pureon",
-        "fcxSanya",
-        "FeXoR",
-        "fabio",
-        "scythetwirler",
-        "Imarok",
-        "niektb",
-        "mimo",
-        "leper",
-        "fatherbushido",
-        "wraitii",
-        "sanderd17",
-        "s0600204",
-        "bb"
-    ]
-
-    objTypes = ["Differential Revision", "Diffusion Commit"]
-
-    actionOrder = [
-        "committed",
-        "abandoned",
-        "closed",
-        "created",
-        "updated the diff for",
-        "planned changes to",
-        "accepted",
-        "requested changes to",
-        "raised a concern with",
-        "added a comment to",
-        "added inline comments to",
-        "abandoned",
-    ]
-
-    actionOrder = ({key: i for i, key in enumerate(actionOrder)})
-
-    # Pull all stories in the given interval and
-    # only keep those of the given object types and actions
-    allStories = []
-    while True:
-        stories = storyPrinter.pullSomeStories()
-
-        if stories is True:
-            break
-
-        for story in stories:
-            string, authorName, objID, objType, action = story
-
-            if objType in objTypes and action in actionOrder:
-                allStories.append((authorName, objID, action, string))
-
-    printParagraph("Generic Progress Report for Wildfire Games in the time between " + start.strftime("%c") + " and " + end.strftime("%c"))
-
-    # Sort stories by team member status, author, then by significance of action
-    allStories = sorted(allStories, key=lambda story: (story[0] not in teamMembers, story[0].lower(), actionOrder[story[2]]))
-
-    # Grab team member stories first, then non-team member stories
-    currentAuthorStories = []
-    previousAuthor = None
-    handledObjIDs = []
-    printedNonTeamMembers = False
-    for story in allStories:
-
-        authorName, objID, action, string = story
-
-        previousAuthor, handledObjIDs, currentAuthorStories = \
-            printAuthorStories(previousAuthor, authorName, currentAuthorStories, handledObjIDs);
-
-        if not printedNonTeamMembers and authorName not in teamMembers:
-            print("Progress by non-team members:")
-            printedNonTeamMembers = True
-
-        # Only show the most important action for each object
-        if objID in handledObjIDs:
-            continue
-
-        currentAuthorStories.append(string + newlineSeparator)
-        handledObjIDs.append(objID)
-
-    printAuthorStories(authorName, "", currentAuthorStories, []);
+# Prints a generic progress report for Wildfire Games development without connecting to IRC
 
 meetDates = [
     datetime.datetime(2016, 12, 18, 1, 49),
@@ -170,9 +28,25 @@ meetDates = [
     datetime.datetime(2017, 5, 22, 6, 00), #18
 ]
 
-targetMeeting = len(meetDates) - 1;
+targetMeeting = len(meetDates) - 1
+
+parser = argparse.ArgumentParser(description="Prints a progress report of the Phabricator activity between two meetings")
+parser.add_argument("--meeting", type=int, default=targetMeeting, help="number of the meeting that ends the reported time window")
+parser.add_argument("--format", choices=sorted(reportWriters), default="html")
+parser.add_argument("--token", default="insert-api-token-here")
+parser.add_argument("--project", default="", help="Phabricator project whose members are listed first")
+parser.add_argument("--archive", default="stories.sqlite", help="SQLite archive of previously pulled stories")
+arguments = parser.parse_args()
+
+conduitAPI = ConduitAPI("code.wildfiregames.com", arguments.token, acceptInvalidSSLCert=False, httpTimeout=60)
+
+writeProgressReport(
+    conduitAPI=conduitAPI,
+    archive=PhabricatorStoryArchive(arguments.archive),
+    writer=reportWriters[arguments.format](sys.stdout),
+    start=meetDates[arguments.meeting - 1],
+    end=meetDates[arguments.meeting],
+    projectName=arguments.project,
+    ignoredUsers=["Harbormaster", "Vulcan", "autobuild", "php-admin"])
 
-start = meetDates[targetMeeting - 1]
-end = meetDates[targetMeeting]
-progressReport(None, start, end)
-#progressReport("some dev", datetime.datetime(2016, 10, 1, 1, 1), datetime.datetime.now())
+conduitAPI.close()
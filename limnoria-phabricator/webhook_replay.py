@@ -0,0 +1,56 @@
+import argparse
+import json
+import time
+import urllib.request
+from plugin import PhabricatorWebhookListener, webhookSignature
+
+# Stands in for Phabricator by posting recorded webhook payloads to the listener of the plugin,
+# signed with the shared secret like Phabricator does.
+# Without payload files, a minimal Herald webhook payload is posted.
+
+samplePayload = {
+    "object": {
+        "type": "DREV",
+        "phid": "PHID-DREV-0000000000000000000"
+    },
+    "triggers": [
+        {"phid": "PHID-HWBH-0000000000000000000"}
+    ],
+    "action": {
+        "test": False,
+        "silent": False,
+        "secure": False,
+        "epoch": 0
+    },
+    "transactions": [
+        {"phid": "PHID-XACT-DREV-000000000000000"}
+    ]
+}
+
+parser = argparse.ArgumentParser(description="Posts recorded Phabricator webhook payloads to the webhook listener of the plugin")
+parser.add_argument("payloads", nargs="*", help="JSON files containing one recorded payload each")
+parser.add_argument("--url", default="http://127.0.0.1:8080/", help="address of the webhook listener, ending with the name of the instance for further instances")
+parser.add_argument("--secret", required=True, help="HMAC key configured in webhookSecret")
+parser.add_argument("--interval", type=float, default=1.0, help="seconds between two requests")
+arguments = parser.parse_args()
+
+bodies = []
+for filename in arguments.payloads:
+    with open(filename, "rb") as payloadFile:
+        bodies.append(payloadFile.read())
+
+if not bodies:
+    bodies.append(json.dumps(samplePayload).encode())
+
+for i, body in enumerate(bodies):
+
+    if i > 0:
+        time.sleep(arguments.interval)
+
+    request = urllib.request.Request(arguments.url, data=body, method="POST", headers={
+        "Content-Type": "application/json",
+        PhabricatorWebhookListener.signatureHeader: webhookSignature(arguments.secret, body)
+    })
+
+    with urllib.request.urlopen(request) as response:
+        print(response.status, arguments.payloads[i] if arguments.payloads else "sample payload")